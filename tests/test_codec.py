@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""test_codec
+
+`codec.FrameDecoder`的单元测试: 拆分的帧,合并的帧,帧头之前的无效数据,校验失败的帧以及末尾单独的`f5`.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from userver.codec import COMMAND_LENGTHS, FrameDecoder, build, encode
+
+HEARTBEAT = build("f5aa0101")
+"""str: 心跳响应(类型1,5字节)"""
+
+SWITCH = build("f5aa0301000000")
+"""str: 开关响应(类型3,8字节)"""
+
+TEMPERATURE = build("f5aa0401010203f0")
+"""str: 温度湿度响应(类型4,9字节)"""
+
+REPORT = build("f5aa08010f")
+"""str: 上报信息(类型8,6字节)"""
+
+
+def corrupt(frame):
+
+    """
+
+    :param frame: 完整帧
+    :return: 校验和错误的同一个帧
+
+    """
+
+    return frame[:-1] + chr((ord(frame[-1]) + 1) & 0xff)
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.decoder = FrameDecoder()
+
+    def feed(self, *chunks):
+
+        """依次放入每一段数据,返回得到的全部帧"""
+
+        frames = []
+
+        for chunk in chunks:
+
+            frames.extend(self.decoder.feed(chunk))
+
+        return frames
+
+    def test_single_frame(self):
+
+        self.assertEqual(self.feed(TEMPERATURE), [TEMPERATURE])
+
+        self.assertEqual(self.decoder.stats(), {"frames": 1, "resyncs": 0, "bad_frames": 0, "buffered": 0})
+
+    def test_split_frame(self):
+
+        self.assertEqual(self.decoder.feed(TEMPERATURE[:2]), [])
+
+        self.assertEqual(self.decoder.feed(TEMPERATURE[2:7]), [])
+
+        self.assertEqual(self.decoder.feed(TEMPERATURE[7:]), [TEMPERATURE])
+
+        self.assertEqual(self.decoder.stats()["buffered"], 0)
+
+    def test_byte_by_byte(self):
+
+        data = SWITCH + REPORT
+
+        self.assertEqual(self.feed(*[data[i] for i in xrange(len(data))]), [SWITCH, REPORT])
+
+        self.assertEqual(self.decoder.resyncs, 0)
+
+    def test_merged_frames(self):
+
+        data = HEARTBEAT + SWITCH + TEMPERATURE + REPORT
+
+        self.assertEqual(self.decoder.feed(data + HEARTBEAT[:3]), [HEARTBEAT, SWITCH, TEMPERATURE, REPORT])
+
+        self.assertEqual(self.decoder.feed(HEARTBEAT[3:]), [HEARTBEAT])
+
+        self.assertEqual(self.decoder.frames, 5)
+
+    def test_garbage_before_header(self):
+
+        self.assertEqual(self.feed("\x00\x13\xaa" + SWITCH), [SWITCH])
+
+        self.assertEqual(self.decoder.resyncs, 1)
+
+        self.assertEqual(self.feed("\xff\xff", REPORT), [REPORT])
+
+        self.assertEqual(self.decoder.resyncs, 2)
+
+        self.assertEqual(self.decoder.stats()["buffered"], 0)
+
+    def test_garbage_between_frames(self):
+
+        self.assertEqual(self.feed(HEARTBEAT + "\x01\x02\x03" + REPORT), [HEARTBEAT, REPORT])
+
+        self.assertEqual(self.decoder.resyncs, 1)
+
+    def test_bad_checksum(self):
+
+        bad = corrupt(SWITCH)
+
+        self.assertEqual(self.feed(bad + REPORT), [bad, REPORT])
+
+        self.assertEqual((self.decoder.bad_frames, self.decoder.resyncs), (1, 0))
+
+    def test_bad_checksum_nested_header(self):
+
+        # 误判的帧头: 类型3需要8字节,其中又出现了真正的帧头
+        data = "\xf5\xaa\x03" + HEARTBEAT
+
+        self.assertEqual(self.feed(data), [HEARTBEAT])
+
+        self.assertEqual((self.decoder.bad_frames, self.decoder.resyncs), (0, 1))
+
+    def test_unknown_type(self):
+
+        self.assertEqual(self.feed("\xf5\xaa\x09\x01" + REPORT), ["\xf5\xaa\x09\x01", REPORT])
+
+        self.assertEqual(self.decoder.bad_frames, 1)
+
+    def test_trailing_f5(self):
+
+        self.assertEqual(self.decoder.feed("\x00\x01\xf5"), [])
+
+        self.assertEqual(self.decoder.stats()["buffered"], 1)
+
+        self.assertEqual(self.decoder.feed(SWITCH[1:]), [SWITCH])
+
+        self.assertEqual(self.decoder.resyncs, 1)
+
+    def test_trailing_f5_after_frame(self):
+
+        self.assertEqual(self.decoder.feed(REPORT + "\xf5"), [REPORT])
+
+        self.assertEqual(self.decoder.feed("\xaa"), [])
+
+        self.assertEqual(self.decoder.feed(HEARTBEAT[2:]), [HEARTBEAT])
+
+        self.assertEqual(self.decoder.resyncs, 0)
+
+    def test_lone_f5_discarded(self):
+
+        self.assertEqual(self.feed("\xf5", "\x00", REPORT), [REPORT])
+
+        self.assertEqual(self.decoder.resyncs, 1)
+
+    def test_command_lengths(self):
+
+        decoder = FrameDecoder(COMMAND_LENGTHS)
+
+        data = encode("f5aa04") + encode("f5aa030103") + encode("f5aa0801")
+
+        self.assertEqual(decoder.feed(data), [encode("f5aa04"), encode("f5aa030103"), encode("f5aa0801")])
+
+
+if __name__ == "__main__":
+
+    unittest.main()
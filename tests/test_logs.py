@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""test_logs
+
+`logs.RateLimiter`的单元测试: 每个时间窗口内同一个键的前`burst`条全部输出,之后每`sample`条输出一条,不同的键分别计数,新的时间窗口重新计数,以及写入线程输出的抑制数量汇总.
+
+日志记录的`created`由测试给出,代替真实的时钟.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+from StringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from userver.logs import BackgroundHandler, RateLimiter
+
+START = 1000000.0
+"""float: 第一个时间窗口的开始时间戳(`interval`为10秒时恰好是窗口的边界)"""
+
+
+def record(msg, args=(), created=START):
+
+    """
+
+    :param msg: 消息模板
+    :param args: 参数
+    :param created: 日志的时间戳
+    :return: 日志记录
+
+    """
+
+    result = logging.LogRecord("test", logging.INFO, __file__, 0, msg, args, None)
+
+    result.created = created
+
+    return result
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.limiter = RateLimiter(interval=10, burst=3, sample=5)
+
+    def allowed(self, records):
+
+        """
+
+        :param records: 日志记录列表
+        :return: 每条日志记录是否输出的列表
+
+        """
+
+        return [self.limiter.allow(item) for item in records]
+
+    def test_burst_then_sample(self):
+
+        allowed = self.allowed([record("%s 上线", ("A",), START + i * 0.1) for i in xrange(12)])
+
+        # 第1到3条全部输出,之后只输出第5和第10条
+        self.assertEqual([i + 1 for i, ok in enumerate(allowed) if ok], [1, 2, 3, 5, 10])
+
+        self.assertEqual(self.limiter.stats(), 7)
+
+    def test_sample_disabled(self):
+
+        self.limiter.sample = 0
+
+        self.assertEqual(self.allowed([record("%s 上线", ("A",))] * 12).count(True), 3)
+
+    def test_keys_counted_separately(self):
+
+        self.allowed([record("%s 上线", ("A",))] * 3)
+
+        self.assertEqual(self.allowed([record("%s 上线", ("B",)), record("%s 下线", ("A",))]), [True, True])
+
+        self.assertEqual(self.allowed([record("%s 上线", ("A",))]), [False])
+
+        self.assertEqual(self.limiter.drain(), {("%s 上线", "A"): 1})
+
+    def test_non_string_argument_shares_key(self):
+
+        self.allowed([record("队列长度 %d", (i,)) for i in xrange(4)])
+
+        self.assertEqual(self.limiter.drain(), {("队列长度 %d", None): 1})
+
+    def test_new_window_resets(self):
+
+        self.assertEqual(self.allowed([record("%s 上线", ("A",), START + 9.9)] * 4).count(True), 3)
+
+        self.assertEqual(self.allowed([record("%s 上线", ("A",), START + 10)] * 4).count(True), 3)
+
+        self.assertEqual(self.limiter.stats(), 2)
+
+    def test_drain(self):
+
+        self.allowed([record("%s 上线", ("A",))] * 6)
+
+        self.assertEqual(self.limiter.drain(), {("%s 上线", "A"): 2})
+
+        self.assertEqual(self.limiter.drain(), {})
+
+        self.assertEqual(self.limiter.stats(), 2)
+
+    def test_summary_written(self):
+
+        stream = StringIO()
+
+        handler = BackgroundHandler(stream, limiter=self.limiter)
+
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+
+        self.allowed([record("%s 上线", ("A",))] * 6)
+
+        self.assertEqual(handler.write(), 0)
+
+        self.assertEqual(handler.write(True), 1)
+
+        self.assertEqual(stream.getvalue(), "WARNING 2 条日志被抑制: A %s 上线\n")
+
+
+if __name__ == "__main__":
+
+    unittest.main()
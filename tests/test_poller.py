@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""test_poller
+
+`poller.Poller`的单元测试: 首次到期时间按照物理地址分散在间隔内,到期之后重新安排到下一个间隔,超过一圈的间隔,同一个会话同时到期的监控命令合并为一次放入,关闭的会话在到期时丢弃,以及轮询循环落后时连续前进追上.
+
+时间轮直接调用`advance`前进;轮询循环使用一个假的时钟,`time.time`和`gevent.sleep`都由它代替.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from userver import poller
+from userver.poller import Poller, spread
+
+
+class FakeSession(object):
+
+    """记录每次放入的监控命令类型的会话替身"""
+
+    def __init__(self, MAC):
+
+        self.MAC = MAC
+
+        self.closed = False
+
+        self.calls = []
+
+    def put_probes(self, kinds):
+
+        self.calls.append(sorted(kinds))
+
+
+class Stop(Exception):
+
+    """假的时钟到达终点"""
+
+
+class FakeClock(object):
+
+    """`time()`返回当前的假时间,`sleep()`直接把假时间向前推进,到达`end`之后抛出`Stop`结束轮询循环
+
+    `stalls`中的秒数依次加在每次休眠之后,模拟阻塞事件循环的协程
+
+    """
+
+    def __init__(self, end, stalls=()):
+
+        self.now = 1000.0
+
+        self.end = self.now + end
+
+        self.stalls = list(stalls)
+
+    def time(self):
+
+        return self.now
+
+    def sleep(self, seconds):
+
+        self.now += seconds + (self.stalls.pop(0) if self.stalls else 0)
+
+        if self.now >= self.end:
+
+            raise Stop()
+
+
+def fired_at(wheel, session, ticks):
+
+    """
+
+    :param wheel: 轮询器
+    :param session: 会话替身
+    :param ticks: 前进的槽数
+    :return: 会话收到监控命令时的槽序号(从1开始)到命令类型的列表
+
+    """
+
+    fired = []
+
+    for tick in xrange(1, ticks + 1):
+
+        count = len(session.calls)
+
+        wheel.advance()
+
+        fired.extend((tick, kinds) for kinds in session.calls[count:])
+
+    return fired
+
+
+class PollerTest(unittest.TestCase):
+
+    def test_spread(self):
+
+        MACs = ["5E%010X" % i for i in xrange(200)]
+
+        offsets = [spread(MAC, 60) for MAC in MACs]
+
+        self.assertEqual(offsets, [spread(MAC, 60) for MAC in MACs])
+
+        self.assertTrue(all(0 <= offset < 60 for offset in offsets))
+
+        self.assertTrue(len(set(offsets)) > 30)
+
+        self.assertEqual(spread("5E0000000001", 0), 0)
+
+    def test_first_fire_spread_then_interval(self):
+
+        session = FakeSession("5E0000000001")
+
+        wheel = Poller({2: 10})
+
+        wheel.add(session)
+
+        first = spread(session.MAC, 10) or 10
+
+        self.assertEqual(fired_at(wheel, session, first + 20), [(first, [2]), (first + 10, [2]), (first + 20, [2])])
+
+    def test_interval_longer_than_wheel(self):
+
+        session = FakeSession("5E0000000001")
+
+        wheel = Poller({4: 30}, slots=4)
+
+        wheel.add(session)
+
+        first = spread(session.MAC, 30) or 30
+
+        self.assertEqual(fired_at(wheel, session, first + 60), [(first, [4]), (first + 30, [4]), (first + 60, [4])])
+
+        self.assertEqual(wheel.stats()["entries"], 1)
+
+    def test_tick_longer_than_one_second(self):
+
+        session = FakeSession("5E0000000001")
+
+        wheel = Poller({2: 10}, tick=5)
+
+        wheel.add(session)
+
+        first = max(int(round((spread(session.MAC, 10) or 10) / 5.0)), 1)
+
+        self.assertEqual(fired_at(wheel, session, first + 2), [(first, [2]), (first + 2, [2])])
+
+    def test_same_interval_merged(self):
+
+        session = FakeSession("5E0000000001")
+
+        wheel = Poller({2: 10, 4: 10, 7: 20})
+
+        wheel.add(session)
+
+        fired = fired_at(wheel, session, 40)
+
+        # 间隔相同的类型总是在同一次调用中放入,每个槽最多调用一次
+        self.assertEqual([2 in kinds for _, kinds in fired], [4 in kinds for _, kinds in fired])
+
+        self.assertEqual(len([kinds for _, kinds in fired if 2 in kinds]), 4)
+
+        self.assertEqual(len(set(tick for tick, _ in fired)), len(fired))
+
+        self.assertEqual(wheel.stats()["fired"], sum(len(kinds) for _, kinds in fired))
+
+    def test_closed_session_dropped(self):
+
+        session = FakeSession("5E0000000001")
+
+        wheel = Poller({2: 10, 6: 20})
+
+        wheel.add(session)
+
+        self.assertEqual(wheel.stats()["entries"], 2)
+
+        session.closed = True
+
+        self.assertEqual(fired_at(wheel, session, 20), [])
+
+        self.assertEqual(wheel.stats(), {"entries": 0, "fired": 0, "lag": 0.0})
+
+    def test_other_sessions_unaffected(self):
+
+        closed, alive = FakeSession("5E0000000001"), FakeSession("5E0000000001")
+
+        wheel = Poller({2: 10})
+
+        wheel.add(closed)
+
+        wheel.add(alive)
+
+        closed.closed = True
+
+        fired_at(wheel, alive, 10)
+
+        self.assertEqual((closed.calls, alive.calls), ([], [[2]]))
+
+        self.assertEqual(wheel.stats()["entries"], 1)
+
+
+class PollerRunTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.modules = poller.time, poller.gevent
+
+    def tearDown(self):
+
+        poller.time, poller.gevent = self.modules
+
+    def run_for(self, wheel, clock):
+
+        # 假的时钟同时代替轮询器使用的`time`和`gevent`模块
+        poller.time = poller.gevent = clock
+
+        advance, ticks = wheel.advance, []
+
+        def counted():
+
+            ticks.append(clock.now)
+
+            return advance()
+
+        wheel.advance = counted
+
+        self.assertRaises(Stop, wheel.run)
+
+        return ticks
+
+    def test_one_tick_per_interval(self):
+
+        clock = FakeClock(10.5)
+
+        ticks = self.run_for(Poller({2: 10}), clock)
+
+        self.assertEqual(len(ticks), 10)
+
+    def test_catch_up_after_stall(self):
+
+        # 第一次休眠之后事件循环被阻塞了3.5秒
+        clock = FakeClock(10.5, [3.5])
+
+        wheel = Poller({2: 10})
+
+        ticks = self.run_for(wheel, clock)
+
+        self.assertEqual(len(ticks), 10)
+
+        self.assertEqual(ticks[:5], [1004.5] * 4 + [1005.0])
+
+        self.assertEqual(wheel.stats()["lag"], 0)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""test_scheduler
+
+`scheduler.TimerScheduler`的单元测试: 到期之后重新安排到下一天的同一时刻,修改以及删除之后旧版本的条目在出堆时丢弃,没有变化的修改不增加条目,错过的触发时间只触发一次.
+
+使用固定的当前时间代替`datetime.now()`,所有时间戳都由测试给出.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import time
+import unittest
+
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from userver import scheduler
+from userver.scheduler import TimerScheduler, next_fire
+
+DAY = 24 * 60 * 60
+"""int: 一天的秒数"""
+
+TODAY = datetime(2026, 10, 18)
+"""datetime: 测试使用的日期"""
+
+
+def timestamp(hour, minute=0, second=0, days=0):
+
+    """
+
+    :param hour: 小时
+    :param minute: 分钟
+    :param second: 秒
+    :param days: 相对`TODAY`的天数
+    :return: 这个本地时间的时间戳
+
+    """
+
+    return time.mktime((TODAY + timedelta(days=days, hours=hour, minutes=minute, seconds=second)).timetuple())
+
+
+class FakeDatetime(datetime):
+
+    """`now`返回测试设置的时间"""
+
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+
+        return cls.current
+
+
+class TimerSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.datetime = scheduler.datetime
+
+        scheduler.datetime = FakeDatetime
+
+        FakeDatetime.current = TODAY + timedelta(hours=7)
+
+        self.scheduler = TimerScheduler()
+
+    def tearDown(self):
+
+        scheduler.datetime = self.datetime
+
+    def test_next_fire(self):
+
+        now = TODAY + timedelta(hours=9)
+
+        self.assertEqual(next_fire(datetime(2020, 1, 1, 8, 30), now), timestamp(8, 30, days=1))
+
+        self.assertEqual(next_fire(datetime(2020, 1, 1, 9, 30), now), timestamp(9, 30))
+
+        # 恰好在触发时刻计算时安排到下一天
+        self.assertEqual(next_fire(datetime(2020, 1, 1, 9), now), timestamp(9, days=1))
+
+    def test_fire_and_rearm_next_day(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.assertEqual(self.scheduler.delay(timestamp(7)), 60 * 60)
+
+        self.assertEqual(self.scheduler.due(timestamp(7, 59, 59)), [])
+
+        self.assertEqual(self.scheduler.due(timestamp(8)), [("A", 30)])
+
+        self.assertEqual(self.scheduler.delay(timestamp(8)), DAY)
+
+        self.assertEqual(self.scheduler.due(timestamp(12)), [])
+
+        self.assertEqual(self.scheduler.due(timestamp(8, days=1)), [("A", 30)])
+
+        self.assertEqual(self.scheduler.stats(), {"timers": 1, "heap": 1, "fired": 2})
+
+    def test_missed_fire_only_once(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.assertEqual(self.scheduler.due(timestamp(8, 5)), [("A", 30)])
+
+        self.assertEqual(self.scheduler.due(timestamp(8, 6)), [])
+
+        self.assertEqual(self.scheduler.delay(timestamp(8, 5)), DAY - 5 * 60)
+
+    def test_modified_entry_replaces_old_version(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 9), 45)
+
+        self.assertEqual(self.scheduler.stats()["heap"], 2)
+
+        # 旧版本的条目在8点出堆,直接丢弃,不会重新安排
+        self.assertEqual(self.scheduler.due(timestamp(8)), [])
+
+        self.assertEqual(self.scheduler.stats()["heap"], 1)
+
+        self.assertEqual(self.scheduler.due(timestamp(9)), [("A", 45)])
+
+        self.assertEqual(self.scheduler.due(timestamp(8, days=1)), [])
+
+        self.assertEqual(self.scheduler.due(timestamp(9, days=1)), [("A", 45)])
+
+    def test_duration_change_keeps_time(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 60)
+
+        self.assertEqual(self.scheduler.due(timestamp(8)), [("A", 60)])
+
+        self.assertEqual(self.scheduler.stats()["heap"], 1)
+
+    def test_unchanged_set_ignored(self):
+
+        for _ in xrange(3):
+
+            self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.assertEqual(self.scheduler.stats()["heap"], 1)
+
+    def test_removed_entry_dropped(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.scheduler.remove("A")
+
+        self.assertEqual(self.scheduler.due(timestamp(8)), [])
+
+        self.assertEqual(self.scheduler.stats(), {"timers": 0, "heap": 0, "fired": 0})
+
+    def test_removed_then_set_again(self):
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.scheduler.remove("A")
+
+        self.scheduler.set("A", datetime(2020, 1, 1, 8), 30)
+
+        self.assertEqual(self.scheduler.due(timestamp(8)), [("A", 30)])
+
+        self.assertEqual(self.scheduler.stats()["heap"], 1)
+
+    def test_sync(self):
+
+        self.scheduler.sync({"A": (datetime(2020, 1, 1, 8), 30), "B": (datetime(2020, 1, 1, 8), 40)})
+
+        self.scheduler.sync({"B": (datetime(2020, 1, 1, 8), 40), "C": (datetime(2020, 1, 1, 8), 50)})
+
+        self.assertEqual(sorted(self.scheduler.due(timestamp(8))), [("B", 40), ("C", 50)])
+
+        self.assertEqual(self.scheduler.stats(), {"timers": 2, "heap": 2, "fired": 2})
+
+
+if __name__ == "__main__":
+
+    unittest.main()
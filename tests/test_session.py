@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""test_session
+
+`session.enqueue`的单元测试: 用户命令和控制命令按照到达顺序放入`tasks`,监控命令只放入`probes`,用户命令达到`limit`条之后拒绝而控制命令总是放入,已经在等待的监控命令类型直接合并,以及无法解析的命令.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from userver.session import PROBE_KINDS, Session, enqueue
+
+
+def command(kind, **fields):
+
+    """
+
+    :param kind: 命令类型
+    :param fields: 其它字段
+    :return: 分发器从`redis`取出的命令字符串
+
+    """
+
+    fields["type"] = kind
+
+    return repr(fields)
+
+
+class EnqueueTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.session = Session("5E0000000001", None, limit=2)
+
+    def test_tasks_keep_arrival_order(self):
+
+        for task in (command(1, data="01"), command(-1), command(0, data="02")):
+
+            self.assertEqual(enqueue(self.session, task, 8), "queued")
+
+        self.assertEqual([task["type"] for task in self.session.tasks], [1, -1, 0])
+
+    def test_probes_in_separate_lane(self):
+
+        self.assertEqual(enqueue(self.session, command(4), 8), "queued")
+
+        self.assertEqual(enqueue(self.session, command(1, data="01"), 8), "queued")
+
+        self.assertEqual(enqueue(self.session, command(2), 8), "queued")
+
+        self.assertEqual([task["type"] for task in self.session.tasks], [1])
+
+        self.assertEqual(self.session.probes, set([2, 4]))
+
+    def test_user_commands_rejected_at_limit(self):
+
+        self.assertEqual(enqueue(self.session, command(1, data="01"), 2), "queued")
+
+        self.assertEqual(enqueue(self.session, command(0, data="02"), 2), "queued")
+
+        self.assertEqual(enqueue(self.session, command(1, data="03"), 2), "rejected")
+
+        self.assertEqual(len(self.session.tasks), 2)
+
+    def test_control_commands_never_rejected(self):
+
+        enqueue(self.session, command(1, data="01"), 1)
+
+        self.assertEqual(enqueue(self.session, command(-2), 1), "queued")
+
+        self.assertEqual(enqueue(self.session, command(-1), 1), "queued")
+
+        self.assertEqual([task["type"] for task in self.session.tasks], [1, -2, -1])
+
+    def test_probe_coalesced(self):
+
+        self.assertEqual(enqueue(self.session, command(6), 8), "queued")
+
+        self.assertEqual(enqueue(self.session, command(6), 8), "coalesced")
+
+        self.assertEqual(enqueue(self.session, command(5, probes=[6]), 8), "coalesced")
+
+        self.assertEqual(enqueue(self.session, command(5, probes=[6, 7]), 8), "queued")
+
+        self.assertEqual(self.session.probes, set([6, 7]))
+
+    def test_batch_probe_without_kinds(self):
+
+        self.assertEqual(enqueue(self.session, command(5), 8), "queued")
+
+        self.assertEqual(self.session.probes, set(PROBE_KINDS))
+
+        for kind in PROBE_KINDS:
+
+            self.assertEqual(enqueue(self.session, command(kind), 8), "coalesced")
+
+    def test_probes_not_limited(self):
+
+        enqueue(self.session, command(1, data="01"), 1)
+
+        self.assertEqual(enqueue(self.session, command(2), 1), "queued")
+
+    def test_invalid(self):
+
+        for task in ("", "{'type': ", "[1, 2]", "{'data': '01'}", "__import__('os')"):
+
+            self.assertEqual(enqueue(self.session, task, 8), "invalid")
+
+        self.assertEqual((self.session.tasks, self.session.probes), ([], set()))
+
+    def test_put_task_uses_session_limit(self):
+
+        self.assertEqual(self.session.put_task(command(1, data="01")), "queued")
+
+        self.assertEqual(self.session.put_task(command(1, data="02")), "queued")
+
+        self.assertEqual(self.session.put_task(command(1, data="03")), "rejected")
+
+        self.assertTrue(self.session.wait(0))
+
+
+if __name__ == "__main__":
+
+    unittest.main()
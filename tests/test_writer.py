@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""test_writer
+
+`writer.StateWriter`的单元测试: 丢弃没有变化的更新,合并同一设备的多个字段,立刻写入时带上尚未写入的字段,按照`batch_size`分批写入,写入失败之后重新标记为脏,以及会话结束之后忘记最后写入的状态.
+
+运行方法: `python -m unittest discover tests`
+
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymysql import OperationalError
+
+from userver.writer import StateWriter
+
+
+class FakePool(object):
+
+    """记录每条语句的链接池替身,`failures`条之后的语句正常执行"""
+
+    def __init__(self, failures=0):
+
+        self.statements = []
+
+        self.failures = failures
+
+    def execute(self, sql, args=None, idempotent=False):
+
+        if self.failures:
+
+            self.failures -= 1
+
+            raise OperationalError(2013, "Lost connection to MySQL server during query")
+
+        self.statements.append((sql, list(args)))
+
+        return ()
+
+
+def rows(sql, args):
+
+    """把一条批量语句还原为物理地址到字段的字典
+
+    :param sql: `StateWriter._write`生成的语句
+    :param args: 语句参数
+    :return: 物理地址到{字段: 值}的字典
+
+    """
+
+    result = {}
+
+    position = 0
+
+    for assignment in sql.split(" SET ", 1)[1].split(" WHERE ")[0].split(", "):
+
+        if assignment == "utime = NOW()":
+
+            continue
+
+        field = assignment.split(" = ")[0]
+
+        for _ in xrange(assignment.count("WHEN")):
+
+            MAC, value = args[position], args[position + 1]
+
+            result.setdefault(MAC, {})[field] = value
+
+            position += 2
+
+    return result
+
+
+class StateWriterTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.pool = FakePool()
+
+        self.writer = StateWriter(self.pool, batch_size=2)
+
+        # 写入失败的用例会记录预期之中的异常
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+
+        logging.disable(logging.NOTSET)
+
+    def test_unchanged_update_dropped(self):
+
+        self.writer.update("A", power=1, dosage=0)
+
+        self.writer.flush()
+
+        self.writer.update("A", power=1, dosage=0)
+
+        self.writer.flush()
+
+        self.assertEqual(len(self.pool.statements), 1)
+
+        self.assertEqual(self.writer.stats()["dropped"], 1)
+
+    def test_updates_merged_into_one_row(self):
+
+        self.writer.update("A", power=1)
+
+        self.writer.update("A", dosage=0)
+
+        self.writer.update("A", power=2)
+
+        self.writer.flush()
+
+        self.assertEqual(len(self.pool.statements), 1)
+
+        self.assertEqual(rows(*self.pool.statements[0]), {"A": {"power": 2, "dosage": 0}})
+
+    def test_only_changed_fields_written(self):
+
+        self.writer.update("A", power=1, dosage=0)
+
+        self.writer.flush()
+
+        self.writer.update("A", power=1, dosage=-1)
+
+        self.writer.flush()
+
+        self.assertEqual(rows(*self.pool.statements[1]), {"A": {"dosage": -1}})
+
+    def test_commit_carries_pending_fields(self):
+
+        self.writer.update("A", dosage=0)
+
+        self.writer.commit("A", online=0)
+
+        sql, args = self.pool.statements[0]
+
+        self.assertIn("utime = NOW()", sql)
+
+        self.assertEqual(rows(sql, args), {"A": {"dosage": 0, "online": 0}})
+
+        self.assertEqual(self.writer.stats()["pending"], 0)
+
+        self.writer.flush()
+
+        self.assertEqual(len(self.pool.statements), 1)
+
+    def test_commit_failure_keeps_row_pending(self):
+
+        self.writer.update("A", dosage=0)
+
+        self.pool.failures = 1
+
+        self.assertRaises(OperationalError, self.writer.commit, "A", online=1)
+
+        self.writer.flush()
+
+        self.assertEqual(rows(*self.pool.statements[0]), {"A": {"dosage": 0, "online": 1}})
+
+    def test_flush_batches(self):
+
+        for i in xrange(5):
+
+            self.writer.update("%012X" % i, power=i)
+
+        self.writer.flush()
+
+        self.assertEqual(len(self.pool.statements), 3)
+
+        written = {}
+
+        for sql, args in self.pool.statements:
+
+            written.update(rows(sql, args))
+
+        self.assertEqual(written, dict(("%012X" % i, {"power": i}) for i in xrange(5)))
+
+        self.assertEqual((self.writer.stats()["rows"], self.writer.stats()["statements"]), (5, 3))
+
+    def test_failed_batch_marked_dirty_again(self):
+
+        self.writer.update("A", power=1)
+
+        self.pool.failures = 1
+
+        self.writer.flush()
+
+        self.assertEqual(self.writer.stats()["pending"], 1)
+
+        self.writer.update("A", dosage=0)
+
+        self.writer.flush()
+
+        self.assertEqual(rows(*self.pool.statements[0]), {"A": {"power": 1, "dosage": 0}})
+
+    def test_discarded_device_not_written(self):
+
+        self.writer.update("A", power=1)
+
+        self.writer.discard("A")
+
+        self.writer.flush()
+
+        self.assertEqual(self.pool.statements, [])
+
+    def test_forget_writes_same_value_again(self):
+
+        self.writer.update("A", power=1)
+
+        self.writer.flush()
+
+        self.writer.forget("A")
+
+        self.writer.update("A", power=1)
+
+        self.writer.flush()
+
+        self.assertEqual(len(self.pool.statements), 2)
+
+        self.assertEqual(rows(*self.pool.statements[1]), {"A": {"power": 1}})
+
+    def test_forget_keeps_pending_row(self):
+
+        self.writer.update("A", power=1)
+
+        self.writer.forget("A")
+
+        self.pool.failures = 1
+
+        self.writer.flush()
+
+        self.writer.flush()
+
+        self.assertEqual(rows(*self.pool.statements[0]), {"A": {"power": 1}})
+
+    def test_forget_pending_drops_row(self):
+
+        self.writer.update("A", power=1)
+
+        self.writer.forget("A", True)
+
+        self.writer.flush()
+
+        self.assertEqual(self.pool.statements, [])
+
+    def test_forget_pending_during_failed_flush(self):
+
+        self.writer.update("A", power=1)
+
+        def execute(sql, args=None, idempotent=False):
+
+            # 写入期间设备被其它进程接管,之后这次写入失败
+            self.writer.forget("A", True)
+
+            raise OperationalError(2013, "Lost connection to MySQL server during query")
+
+        self.pool.execute = execute
+
+        self.writer.flush()
+
+        self.assertEqual(self.writer.stats()["pending"], 0)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
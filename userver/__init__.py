@@ -6,11 +6,26 @@
 
 """
 
+import os
+import sys
+
 from gevent import monkey
 
-monkey.patch_all()
+ENGINE = os.environ.get("USERVER_ENGINE", "gevent") if os.path.basename(getattr(sys, "argv", [''])[0]) == "tcp_server.py" else "gevent"
+"""str: `tcp_server`使用的服务器引擎,启动时由环境变量`USERVER_ENGINE`选择
 
-import sys
+    gevent: 默认值,替换标准库之后每个链接一个协程
+    asyncio: 基于`asyncio`(Python 2使用`trollius`,安装了`uvloop`时使用`uvloop`)的回调式引擎,不替换标准库(参见`engine`)
+
+这个环境变量只对`tcp_server`生效,`monitor`以及`test`等其它程序依赖`gevent`,总是替换标准库
+
+"""
+
+if ENGINE == "gevent":
+
+    monkey.patch_all()
+
+import platform
 import logging
 
 import redis
@@ -18,9 +33,131 @@ import pymysql
 
 pymysql.install_as_MySQLdb()
 
+from gevent.lock import BoundedSemaphore
+
+from userver.pool import ConnectionPool, ThreadSemaphore
+from userver.writer import StateWriter
+from userver.history import TelemetryHistory
+from userver.logs import setup as setup_logging
+
 redis_client = redis.Redis("", 6379, password="", db=0)
 
-logging.basicConfig(format="%(asctime)s - %(funcName)s - %(levelname)s - %(message)s", stream=sys.stdout, level=logging.INFO)
+MYSQL_POOL_SIZE = 32
+"""int: 数据库链接池的容量
+
+所有设备链接共享这些数据库链接,这个值应该远小于MySQL的`max_connections`
+
+"""
+
+mysql_pool = ConnectionPool(MYSQL_POOL_SIZE, semaphore=ThreadSemaphore if ENGINE == "asyncio" else BoundedSemaphore, host="", user="", passwd="", db="")
+
+STATE_FLUSH_INTERVAL = 5
+"""int: 设备状态批量写入的间隔秒数"""
+
+STATE_BATCH_SIZE = 500
+"""int: 每条批量写入语句最多包含的设备数量"""
+
+HISTORY_PATH = "history"
+"""str: 遥测数据历史记录文件所在的目录"""
+
+HISTORY_CAPACITY = 64
+"""int: 每台设备在内存中保留的遥测样本数量"""
+
+HISTORY_FLUSH_INTERVAL = 60
+"""int: 遥测样本追加写入文件的间隔秒数"""
+
+history = TelemetryHistory(HISTORY_PATH, HISTORY_CAPACITY, HISTORY_FLUSH_INTERVAL)
+
+state_writer = StateWriter(mysql_pool, STATE_FLUSH_INTERVAL, STATE_BATCH_SIZE, history)
+
+DISPATCH_WORKERS = 16
+"""int: 命令分发器中使用`BRPOP`阻塞等待命令的协程数量"""
+
+DISPATCH_TIMEOUT = 30
+"""int: 命令分发器每次`BRPOP`的超时秒数,设备注册或者注销时会立刻唤醒等待的协程,这个值只决定唤醒消息丢失时的最长延迟"""
+
+SEND_TIMEOUT = 5
+"""int: 向设备发送数据的最长秒数,设备停止接收数据时发送命令的协程最多阻塞这么久,之后关闭链接"""
+
+QUEUE_LIMIT = 64
+"""int: 每个会话尚未执行的用户命令数量上限,超过之后新的打开/关闭命令立刻返回执行失败;监控命令按照类型合并,不占用这个数量"""
+
+PROBE_TYPES = [2, 4, 6, 7]
+"""list: 每次监控设备状态需要执行的命令类型: 心跳,温度湿度,状态查询,药量"""
+
+PROBE_PIPELINE = True
+"""bool: 是否把一次监控的所有命令连续写入链接(批量发送)"""
+
+PROBE_SEQUENTIAL = set()
+"""set: 固件不支持批量发送的设备物理地址,这些设备的监控命令逐条发送"""
+
+MONITOR_INTERVAL = 60
+"""int: 监控周期的秒数"""
+
+MONITOR_BATCH_SIZE = 1000
+"""int: `monitor`每个`redis`管道最多包含的命令数量"""
+
+POLL_IN_SERVER = False
+"""bool: 是否由`tcp_server`进程内的轮询器定期监控设备状态,为`True`时`monitor`不再生成批量监控命令,只负责定时模式"""
+
+PROBE_INTERVALS = dict((kind, MONITOR_INTERVAL) for kind in PROBE_TYPES)
+"""dict: 进程内轮询时每种监控命令类型的间隔秒数,默认全部等于`MONITOR_INTERVAL`,间隔相同的监控命令批量发送"""
+
+POLL_TICK = 1
+"""int: 进程内轮询器时间轮每个槽的秒数"""
+
+DEVICE_REBUILD_INTERVAL = 3600
+"""int: `monitor`全量加载设备索引的间隔秒数,增量同步无法发现被删除的设备,`0`表示只在启动时以及收到`SIGHUP`信号时全量加载"""
+
+RESULT_TTL = 600
+"""int: 用户命令执行结果列表的过期秒数,移动应用后台没有取走的结果在这个时间之后自动删除"""
+
+RESULT_CHANNEL = "userver:results"
+"""str: 发布用户命令执行结果的频道,消息为包含`id`,`code`,`msg`的JSON对象,移动应用后台订阅这个频道即可立刻得到结果,不需要轮询结果列表"""
+
+METRICS_PORT = 9100
+"""int: `tcp_server`导出运行指标的本地HTTP端口,`0`表示不导出"""
+
+MONITOR_METRICS_PORT = 9101
+"""int: `monitor`导出运行指标的本地HTTP端口,`0`表示不导出"""
+
+WATCHDOG_THRESHOLD = 0.1
+"""float: 事件循环没有切换协程的最长秒数,超过之后记录阻塞的协程及其调用栈(参见`watchdog`),`0`表示不检测"""
+
+PREFORK_WORKERS = 1
+"""int: `tcp_server`的工作进程数量,`1`表示单进程模式,`0`表示等于CPU核心数量(参见`prefork`)"""
+
+PREFORK_REUSEPORT = True
+"""bool: 多进程模式下工作进程是否使用`SO_REUSEPORT`各自监听,为`False`时继承主进程的监听链接"""
+
+PREFORK_AFFINITY = False
+"""bool: 多进程模式下是否把每个工作进程绑定到一个CPU核心"""
+
+CLUSTER_DIRECTORY = True
+"""bool: 是否使用`redis`中的集群会话目录记录每台设备的所有者(参见`directory`),多节点或者多进程部署时必须打开.`asyncio`引擎不支持,使用这个引擎时必须关闭,`monitor`读取同一个配置,随之把所有命令放入以物理地址命名的列表"""
+
+NODE_NAME = platform.node()
+"""str: 节点名称,集群内唯一"""
+
+SESSION_LEASE = 30
+"""int: 会话所有权的租期秒数,进程异常退出之后,它持有的设备最多在这个时间之后可以被其它进程接管(设备重新接入时立刻接管)"""
+
+LOG_STRUCTURED = False
+"""bool: 日志是否输出为每行一个JSON对象,否则使用原来的文本格式"""
+
+LOG_QUEUE_SIZE = 10000
+"""int: 等待后台线程写入的日志数量上限,超过之后丢弃新的日志"""
+
+LOG_RATE_INTERVAL = 10
+"""int: 日志限流的时间窗口秒数,每个窗口输出一次被抑制的日志数量"""
+
+LOG_RATE_BURST = 20
+"""int: 每个时间窗口内同一条消息(同一台设备)全部输出的日志数量,`0`表示不限流"""
+
+LOG_SAMPLE = 100
+"""int: 超过`LOG_RATE_BURST`之后每多少条日志输出一条,`0`表示全部抑制"""
+
+log_handler = setup_logging(LOG_STRUCTURED, LOG_QUEUE_SIZE, LOG_RATE_INTERVAL, LOG_RATE_BURST, LOG_SAMPLE, logging.INFO, sys.stdout)
 
 # connection = pymysql.connect(host="", user="", passwd="", db="")
 #
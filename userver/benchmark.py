@@ -0,0 +1,774 @@
+# -*- coding: utf-8 -*-
+
+"""benchmark
+
+性能测试: 帧编解码以及热点路径的回归测试,`gevent`与`asyncio`引擎的对比,会话内存.回归测试每项取多轮耗时的中位数,保存为JSON(每次操作的微秒数),与基准比较时任何一项慢超过阈值(默认20%)则以非零状态退出;基准与机器相关,应该在运行比较的同一台机器上生成.
+
+运行方法:
+
+    python benchmark.py [循环次数]                              # 新旧帧编解码对比
+    python benchmark.py suite [结果文件] [基准文件] [阈值]        # 回归测试,例如 suite benchmark_baseline.json 更新基准
+    python benchmark.py compare [基准文件] [阈值]                 # 只与基准比较,不保存结果
+    python benchmark.py engines [设备数量] [持续秒数] [并发数量]  # 引擎对比,需要本机的redis以及数据库
+    python benchmark.py memory [链接数量] [步长] [状态]           # 会话内存,状态为0时不计入设备状态,链接较多时先提高`ulimit -n`
+
+"""
+
+import os
+import gc
+import ast
+import sys
+import json
+import logging
+import time
+import random
+import struct
+import platform
+import subprocess
+import timeit
+import socket
+import shutil
+import resource
+import tempfile
+
+from binascii import hexlify
+from datetime import datetime
+
+sys.path.append("../")
+
+import gevent
+
+from gevent.server import StreamServer
+
+from userver import HISTORY_CAPACITY
+from userver.codec import COMMAND_LENGTHS, FrameDecoder, checksum_ok, encode, payload
+from userver.session import Session, SessionRegistry
+from userver.writer import StateWriter
+from userver.history import TelemetryHistory
+
+
+def legacy_translate(data, flag="server"):
+
+    """原来的`tcp_server.translate`"""
+
+    if flag == "client":
+
+        data = hexlify(data)
+
+    tmp = []
+
+    for i in xrange(len(data) / 2):
+
+        tmp.append(int(data[i * 2: i * 2 + 2], 16))
+
+    return tmp
+
+
+def legacy_get_checksum(data):
+
+    """原来的`tcp_server.get_checksum`"""
+
+    data = legacy_translate(data, "client")
+
+    checksum = sum(data[:-1]) & 0xff
+
+    return 1 if data[-1] == checksum else 0
+
+
+def legacy_set_checksum(data):
+
+    """原来的`tcp_server.set_checksum`"""
+
+    data = legacy_translate(data)
+
+    checksum = sum(data) & 0xff
+
+    data.append(checksum)
+
+    sequence = map(lambda x: struct.pack("!B", x), data)
+
+    return ''.join(sequence)
+
+
+RESPONSE = encode("f5aa0300000100")
+"""str: 用于测试的状态查询响应帧"""
+
+CASES = [
+    ("set_checksum", lambda: legacy_set_checksum("f5aa030000"), lambda: encode("f5aa030000")),
+    ("get_checksum", lambda: legacy_get_checksum(RESPONSE), lambda: checksum_ok(RESPONSE)),
+    ("translate", lambda: legacy_translate(RESPONSE, "client")[3:-1], lambda: payload(RESPONSE)),
+]
+"""list: 测试项目,每一项包括名称,原来的实现以及新的实现"""
+
+
+def run(number=100000):
+
+    """运行所有测试项目,输出每次调用的耗时以及加速比
+
+    :param number: 每个测试项目的循环次数
+    :return: 测试项目名称到(原来的耗时, 新的耗时)的字典,单位微秒
+
+    """
+
+    results = {}
+
+    for name, legacy, current in CASES:
+
+        assert legacy() == current()
+
+        before = min(timeit.repeat(legacy, number=number, repeat=3)) / number * 1e6
+
+        after = min(timeit.repeat(current, number=number, repeat=3)) / number * 1e6
+
+        results[name] = (before, after)
+
+        print("%-14s %8.3f us -> %8.3f us  x%.1f" % (name, before, after, before / after))
+
+    return results
+
+
+TASK = "{'type': 1, 'id': 'AABBCCDDEEFF+2016-06-01 12:00:00', 'time': 3}"
+"""str: 用于测试命令解码的用户命令"""
+
+MONITOR_ROWS = (1000, 10000, 100000)
+"""tuple: 监控周期测试使用的设备表行数"""
+
+
+class MemoryPool(object):
+
+    """返回固定结果行的链接池替身,相当于内存中的设备表"""
+
+    def __init__(self, rows):
+
+        self.rows = rows
+
+    def execute(self, sql, args=None, idempotent=False):
+
+        return self.rows
+
+
+class MemoryRedis(object):
+
+    """只计数不发送的`redis`客户端替身,管道就是客户端本身"""
+
+    def __init__(self):
+
+        self.commands = 0
+
+    def pipeline(self, transaction=True):
+
+        return self
+
+    def execute(self):
+
+        return []
+
+    def lpush(self, key, *values):
+
+        self.commands += len(values)
+
+    def expire(self, key, seconds):
+
+        pass
+
+    def mget(self, keys):
+
+        return [None] * len(keys)
+
+    def register_script(self, script):
+
+        return None
+
+
+def device_table(rows):
+
+    """
+
+    :param rows: 行数
+    :return: 与`monitor`查询结果格式相同的设备表,全部在线,十分之一为定时模式
+
+    """
+
+    now = datetime.now()
+
+    return [("%012X" % i, 1 if i % 10 == 0 else 0, now if i % 10 == 0 else None, random.randint(1, 8), 1, now) for i in xrange(rows)]
+
+
+def fake_device(client):
+
+    """本地模拟设备,按照协议回复收到的每一条命令(参见`test.Device`)
+
+    :param client: 模拟设备一端的链接
+    :return: 无返回值
+
+    """
+
+    from userver.test import Device
+
+    device = Device("AABBCCDDEEFF", None)
+
+    decoder = FrameDecoder(COMMAND_LENGTHS)
+
+    while 1:
+
+        data = client.recv(4096)
+
+        if not data:
+
+            return
+
+        for frame in decoder.feed(data):
+
+            response = device.answer(frame)
+
+            if response is not None:
+
+                client.sendall(response)
+
+
+def suite_cases():
+
+    """准备性能回归测试的所有项目,准备过程不计入耗时
+
+    :return: 由(名称, 被测函数, 每轮循环次数, 轮数)组成的列表
+
+    """
+
+    import tcp_server
+
+    import monitor
+
+    from userver.index import DeviceIndex
+    from userver.directory import SessionDirectory
+
+    MAC = "AABBCCDDEEFF"
+
+    server, client = socket.socketpair()
+
+    session = Session(MAC, server)
+
+    session.start()
+
+    gevent.spawn(fake_device, client)
+
+    cases = [
+        ("codec.translate", lambda: tcp_server.translate(RESPONSE, "client"), 100000, 5),
+        ("codec.get_checksum", lambda: tcp_server.get_checksum(RESPONSE), 100000, 5),
+        ("codec.set_checksum", lambda: tcp_server.set_checksum("f5aa030000"), 100000, 5),
+        ("parse.temperature_humidity", lambda: tcp_server.on_temperature_humidity(MAC, [0, 0x81, 0x0a, 0x02, 0x58]), 20000, 5),
+        ("parse.remaining_potion", lambda: tcp_server.on_remaining_potion(MAC, [0, 10, 30]), 20000, 5),
+        ("dispatch.decode_task", lambda: ast.literal_eval(TASK), 20000, 5),
+        ("roundtrip.check_status", lambda: tcp_server.check_status(MAC, session), 2000, 5),
+    ]
+
+    for rows in MONITOR_ROWS:
+
+        def cycle(table=device_table(rows)):
+
+            monitor.index = DeviceIndex(MemoryPool(table))
+
+            monitor.redis_client = MemoryRedis()
+
+            monitor.directory = SessionDirectory(MemoryRedis(), None, "benchmark", 30)
+
+            monitor.index.rebuild()
+
+            monitor.scheduler.sync(monitor.timers())
+
+            for commands in monitor.plan(monitor.index.online_devices()):
+
+                monitor.enqueue(commands)
+
+        cases.append(("monitor.cycle.%d" % rows, cycle, max(1, 10000 // rows), 9))
+
+    return cases
+
+
+def host():
+
+    """
+
+    :return: 机器以及Python版本的标志,基准与这次运行的标志相同时不按照校准结果换算
+
+    """
+
+    return "%s %s %s" % (platform.node(), platform.machine(), platform.python_version())
+
+
+def median(values):
+
+    """
+
+    :param values: 数值列表
+    :return: 中位数
+
+    """
+
+    values = sorted(values)
+
+    middle = len(values) // 2
+
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def calibrate():
+
+    """
+
+    :return: 一段固定的纯Python代码的耗时(微秒),用来换算不同时间,不同机器上的测试结果
+
+    """
+
+    def loop():
+
+        total = 0
+
+        for i in xrange(1000):
+
+            total += i * i % 7
+
+        return total
+
+    return median(timeit.repeat(loop, number=200, repeat=5)) / 200 * 1e6
+
+
+def measure(function, number, repeat):
+
+    """
+
+    :param function: 被测函数
+    :param number: 每轮循环次数
+    :param repeat: 轮数,每轮开始之前回收垃圾(`timeit`在计时期间关闭垃圾回收,否则前几轮的循环引用会留到后面几轮)
+    :return: 每轮每次操作耗时的中位数(微秒)
+
+    """
+
+    return median(timeit.repeat(function, setup=gc.collect, number=number, repeat=repeat)) / number * 1e6
+
+
+def suite(output=None, baseline=None, threshold=0.2, confirm=2):
+
+    """运行性能回归测试,保存结果,与基准比较
+
+    :param output: 结果文件,`None`表示不保存
+    :param baseline: 基准文件,`None`表示不比较
+    :param threshold: 比基准慢多少视为回归(比例)
+    :param confirm: 超过阈值的项目重新测量的次数,取所有测量中最快的一次,只有持续变慢才视为回归
+    :return: 回归的项目名称列表
+
+    """
+
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+
+    calibration = calibrate()
+
+    print("%-28s %14.3f us" % ("calibration", calibration))
+
+    reference = scale = None
+
+    if baseline is not None:
+
+        with open(baseline) as stream:
+
+            reference = json.load(stream)
+
+        scale = calibration / reference["calibration"] if reference.get("calibration") and reference.get("host") != host() else 1.0
+
+    try:
+
+        for name, function, number, repeat in suite_cases():
+
+            function()
+
+            results[name] = measure(function, number, repeat)
+
+            for _ in xrange(confirm if reference is not None and name in reference["results"] else 0):
+
+                if results[name] <= reference["results"][name] * scale * (1 + threshold):
+
+                    break
+
+                results[name] = min(results[name], measure(function, number, repeat))
+
+            print("%-28s %14.3f us" % (name, results[name]))
+
+    finally:
+
+        logging.disable(logging.NOTSET)
+
+    if output is not None:
+
+        with open(output, "w") as stream:
+
+            json.dump({"python": platform.python_version(), "host": host(), "time": int(time.time()), "calibration": calibration, "results": results}, stream, indent=1, sort_keys=True)
+
+    if reference is None:
+
+        return []
+
+    return compare(results, reference["results"], threshold, scale)
+
+
+def compare(results, reference, threshold=0.2, scale=1.0):
+
+    """逐项比较测试结果与基准
+
+    :param results: 名称到每次操作微秒数的字典
+    :param reference: 基准,格式相同
+    :param threshold: 比基准慢多少视为回归(比例)
+    :param scale: 这次运行的校准耗时与基准的校准耗时之比,比例按照这个值换算,同一台机器上为`1`
+    :return: 回归的项目名称列表,基准中没有的项目不参与比较
+
+    """
+
+    regressions = []
+
+    print("%-28s %14s %14s %8s  (calibration x%.2f)" % ("case", "baseline us", "current us", "ratio", scale))
+
+    for name in sorted(results):
+
+        if name not in reference:
+
+            continue
+
+        ratio = results[name] / (reference[name] * scale) if reference[name] else 1.0
+
+        regressed = ratio > 1 + threshold
+
+        if regressed:
+
+            regressions.append(name)
+
+        print("%-28s %14.3f %14.3f %7.2fx%s" % (name, reference[name], results[name], ratio, "  REGRESSION" if regressed else ''))
+
+    return regressions
+
+
+ENGINES = ("gevent", "asyncio")
+"""tuple: 参与对比测试的服务器引擎"""
+
+
+def cpu(pid):
+
+    """
+
+    :param pid: 进程号
+    :return: 进程累计使用的CPU秒数(用户态加内核态)
+
+    """
+
+    with open("/proc/%s/stat" % pid) as stat:
+
+        fields = stat.read().rpartition(')')[2].split()
+
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def engines(devices=1000, duration=30, concurrency=50, port=9009):
+
+    """使用同一组模拟设备以及同样的命令负载依次测试每个服务器引擎
+
+    :param devices: 模拟设备数量
+    :param duration: 每个引擎发送命令的秒数
+    :param concurrency: 并发的命令数量
+    :param port: `tcp_server`监听的端口
+    :return: 引擎名称到测试结果(参见`test.drive`,另外包括服务器的CPU占用比例以及常驻内存MB)的字典
+
+    """
+
+    from userver import redis_client, CLUSTER_DIRECTORY, POLL_IN_SERVER
+    from userver import test
+
+    if CLUSTER_DIRECTORY or POLL_IN_SERVER:
+
+        print("asyncio引擎不支持集群会话目录以及进程内轮询器,对比测试之前需要在userver中关闭CLUSTER_DIRECTORY以及POLL_IN_SERVER")
+
+        return {}
+
+    MACs = test.fleet("5E0000", devices)
+
+    ramp = min(10.0, devices / 200.0)
+
+    results = {}
+
+    for engine in ENGINES:
+
+        for key in test.stats:
+
+            test.stats[key] = 0
+
+        with open(os.devnull, "w") as devnull:
+
+            server = subprocess.Popen([sys.executable, "tcp_server.py"], env=dict(os.environ, USERVER_ENGINE=engine), stdout=devnull, stderr=subprocess.STDOUT)
+
+        try:
+
+            deadline = time.time() + 10
+
+            while 1:
+
+                try:
+
+                    socket.create_connection(("127.0.0.1", port), 1).close()
+
+                    break
+
+                except socket.error:
+
+                    if time.time() > deadline or server.poll() is not None:
+
+                        raise RuntimeError("%s 引擎启动失败" % engine)
+
+                    gevent.sleep(0.2)
+
+            fleet = test.simulate(MACs, ("127.0.0.1", port), ramp)
+
+            gevent.sleep(ramp + 2)
+
+            begin, used = time.time(), cpu(server.pid)
+
+            result = test.drive(redis_client, MACs, concurrency, duration)
+
+            result["cpu"] = (cpu(server.pid) - used) / (time.time() - begin)
+
+            result["rss"] = rss(server.pid) / 1024.0
+
+            results[engine] = result
+
+            gevent.killall(fleet)
+
+        finally:
+
+            server.terminate()
+
+            server.wait()
+
+    print("%-8s %10s %10s %10s %9s %6s %8s" % ("engine", "commands/s", "p50 ms", "p99 ms", "timeouts", "cpu", "RSS MB"))
+
+    for engine in ENGINES:
+
+        result = results[engine]
+
+        print("%-8s %10.1f %10.1f %10.1f %9d %5.0f%% %8.1f" % (engine, result["throughput"], result["p50"] * 1000, result["p99"] * 1000, result["timeouts"], result["cpu"] * 100, result["rss"]))
+
+    return results
+
+
+def rss(pid):
+
+    """
+
+    :param pid: 进程号
+    :return: 进程的常驻内存(KB)
+
+    """
+
+    with open("/proc/%s/status" % pid) as status:
+
+        for line in status:
+
+            if line.startswith("VmRSS:"):
+
+                return int(line.split()[1])
+
+    return 0
+
+
+def raise_nofile():
+
+    """把文件描述符数量上限提高到系统允许的最大值
+
+    :return: 提高之后的上限
+
+    """
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+
+def idle_server(port, path=None):
+
+    """只包含会话层的服务器,每个链接上报物理地址之后创建会话并且等待,直到链接断开
+
+    :param port: 监听端口
+    :param path: 遥测数据历史记录的临时目录,`None`表示不保存设备状态
+    :return: 无返回值
+
+    """
+
+    raise_nofile()
+
+    sessions = SessionRegistry()
+
+    history = TelemetryHistory(path, HISTORY_CAPACITY, 1) if path else None
+
+    writer = StateWriter(None, history=history)
+
+    def handle(client, address):
+
+        MAC = client.recv(12)
+
+        session = Session(MAC, client)
+
+        session.start()
+
+        sessions.add(session)
+
+        if history is not None:
+
+            writer.update(MAC, online=1, power=0, temperature=25.0, humidity=50.0, dosage=1.0)
+
+        try:
+
+            while not session.closed:
+
+                session.wait()
+
+                while session.reports:
+
+                    if not session.reports.pop(0):
+
+                        session.close("empty")
+
+        finally:
+
+            session.close()
+
+            sessions.remove(session)
+
+    server = StreamServer(("127.0.0.1", port), handle, backlog=4096)
+
+    if history is not None:
+
+        history.start()
+
+    gc.collect()
+
+    server.serve_forever()
+
+
+def memory(connections=100000, step=10000, state=1, port=9019):
+
+    """建立大量空闲链接,输出服务器进程的常驻内存
+
+    :param connections: 链接数量
+    :param step: 每建立多少个链接输出一次
+    :param state: 是否同时计入设备状态以及遥测样本,`0`表示只测量会话
+    :param port: 服务器监听端口
+    :return: 链接数量到(常驻内存, 平均每个会话占用的内存)的字典,单位KB
+
+    """
+
+    limit = raise_nofile()
+
+    if connections + 64 > limit:
+
+        print("文件描述符上限为 %s,链接数量减少为 %s" % (limit, limit - 64))
+
+        connections = limit - 64
+
+    path = tempfile.mkdtemp(prefix="userver-history-") if state else None
+
+    pid = os.fork()
+
+    if pid == 0:
+
+        try:
+
+            idle_server(port, path)
+
+        finally:
+
+            os._exit(0)
+
+    gevent.sleep(1)
+
+    baseline = rss(pid)
+
+    print("%8s %10s %10s" % ("sessions", "RSS MB", "KB/session"))
+
+    print("%8d %10.1f %10s" % (0, baseline / 1024.0, '-'))
+
+    clients = []
+
+    results = {}
+
+    try:
+
+        while len(clients) < connections:
+
+            for index in xrange(len(clients), min(len(clients) + step, connections)):
+
+                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+                client.bind(("127.%d.%d.%d" % (1 + index // 62500, index // 250 % 250, 1 + index % 250), 0))
+
+                client.connect(("127.0.0.1", port))
+
+                client.send("%012X" % index)
+
+                clients.append(client)
+
+            while len(os.listdir("/proc/%s/fd" % pid)) < len(clients):
+
+                gevent.sleep(0.1)
+
+            gevent.sleep(1)
+
+            current = rss(pid)
+
+            results[len(clients)] = (current, (current - baseline) / float(len(clients)))
+
+            print("%8d %10.1f %10.2f" % (len(clients), current / 1024.0, results[len(clients)][1]))
+
+    finally:
+
+        for client in clients:
+
+            client.close()
+
+        os.kill(pid, 9)
+
+        os.waitpid(pid, 0)
+
+        if path:
+
+            shutil.rmtree(path, True)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "memory":
+
+        memory(*[int(argument) for argument in sys.argv[2:5]])
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "engines":
+
+        engines(*[int(argument) for argument in sys.argv[2:5]])
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "suite":
+
+        arguments = sys.argv[2:]
+
+        if suite(arguments[0] if len(arguments) > 0 else None, arguments[1] if len(arguments) > 1 else None, float(arguments[2]) if len(arguments) > 2 else 0.2):
+
+            sys.exit(1)
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "compare":
+
+        arguments = sys.argv[2:]
+
+        if suite(None, arguments[0] if len(arguments) > 0 else "benchmark_baseline.json", float(arguments[1]) if len(arguments) > 1 else 0.2):
+
+            sys.exit(1)
+
+    else:
+
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""codec
+
+这个模块负责设备通信协议的帧处理.
+
+所有计算直接在二进制串上进行,不再经过十六进制字符串的转换.程序发送的命令几乎都是固定的,这些命令连同校验和在导入时一次性生成,保存在`FRAMES`中.
+
+TCP是字节流,一次`recv`可能包含多个帧,也可能只包含半个帧.`FrameDecoder`缓存收到的数据,查找`f5 aa`帧头,根据命令类型确定帧长度,每次返回所有完整的帧,不完整的部分留到下次接收.
+
+"""
+
+from binascii import unhexlify
+
+HEADER = '\xf5\xaa'
+"""str: 帧头"""
+
+FRAME_LENGTHS = {1: 5, 3: 8, 4: 9, 7: 7, 8: 6}
+"""dict: 设备发送的各类帧的长度(包含帧头,命令类型以及校验和)
+
+    1: 心跳/测试链接响应
+    3: 开关/状态查询响应
+    4: 温度湿度响应
+    7: 药量响应
+    8: 上报信息
+
+"""
+
+COMMAND_LENGTHS = {1: 6, 3: 6, 4: 4, 7: 4, 8: 5}
+"""dict: 程序发送的各类命令帧的长度(包含校验和),设备模拟器使用这个映射解码(参见`test`)
+
+    1: 心跳/测试链接
+    3: 开关/状态查询
+    4: 读取温度湿度
+    7: 读取药量
+    8: 回复上报信息
+
+"""
+
+COMMANDS = [
+    "f5aa010000",
+    "f5aa010001",
+    "f5aa030000",
+    "f5aa030100",
+    "f5aa04",
+    "f5aa07",
+    "f5aa0800",
+    "f5aa0801",
+    "f5aa0802",
+] + ["f5aa03010%d" % time for time in xrange(1, 9)]
+"""list: 程序发送的所有固定命令(不含校验和),包括心跳,测试链接,状态查询,关闭,温度湿度,药量,三个上报回复以及八个加热时长的打开命令"""
+
+counters = {"frames": 0, "resyncs": 0, "bad_frames": 0}
+"""dict: 所有解码器的累计统计: 完整帧数量,重新同步次数,校验失败或者类型未知的帧数量"""
+
+
+def checksum(data):
+
+    """计算校验和: 所有字节求和,与`0xff`做位与操作
+
+    :param data: 二进制串
+    :return: 校验和(整数)
+
+    """
+
+    return sum(bytearray(data)) & 0xff
+
+
+def build(command):
+
+    """把十六进制命令转换为二进制串,并附加校验和
+
+    :param command: 十六进制命令
+    :return: 带有校验和的二进制串
+
+    """
+
+    data = unhexlify(command)
+
+    return data + chr(checksum(data))
+
+
+FRAMES = dict((command, build(command)) for command in COMMANDS)
+"""dict: 固定命令到带有校验和的二进制串的映射"""
+
+
+def encode(command):
+
+    """获得待发送命令的二进制串,固定命令直接查表
+
+    :param command: 十六进制命令
+    :return: 带有校验和的二进制串
+
+    """
+
+    frame = FRAMES.get(command)
+
+    return frame if frame is not None else build(command)
+
+
+def payload(frame):
+
+    """提取响应帧的有效数据(删除帧头,命令类型以及校验和)
+
+    :param frame: 完整帧(二进制串)
+    :return: 有效数据的整数列表
+
+    """
+
+    return list(bytearray(frame[3:-1]))
+
+
+def checksum_ok(frame):
+
+    """检验一个完整帧的校验和(除最后一个字节之外所有字节求和,与`0xff`做位与操作,结果等于最后一个字节)
+
+    等价于全部字节之和减去两倍的最后一个字节,低八位为零,这样不需要复制切片
+
+    :param frame: 完整帧(二进制串)
+    :return: 校验通过返回`True`,否则返回`False`
+
+    """
+
+    data = bytearray(frame)
+
+    return len(data) > 1 and (sum(data) - 2 * data[-1]) & 0xff == 0
+
+
+class FrameDecoder(object):
+
+    """增量帧解码器
+
+    帧头之前的无效数据会被丢弃,记为一次重新同步;校验失败的帧如果内部还含有帧头,说明当前帧头是误判,从下一个帧头重新同步,否则仍然返回这个帧,由调用者按照协议回复校验错误
+
+    命令类型未知的帧无法确定长度,把下一个帧头之前(或者已经收到的全部)数据作为一个帧返回,由调用者按照协议回复类型错误
+
+    """
+
+    __slots__ = ("lengths", "buffer", "frames", "resyncs", "bad_frames")
+
+    def __init__(self, lengths=FRAME_LENGTHS):
+
+        """
+
+        :param lengths: 命令类型到帧长度的映射
+
+        """
+
+        self.lengths = lengths
+
+        self.buffer = bytearray()
+
+        self.frames = 0
+
+        self.resyncs = 0
+
+        self.bad_frames = 0
+
+    def feed(self, data):
+
+        """放入一次接收到的数据,返回其中所有完整的帧
+
+        :param data: 接收到的数据(二进制串)
+        :return: 完整帧(二进制串)组成的列表
+
+        """
+
+        if not self.buffer and len(data) > 2 and data[:2] == HEADER and self.lengths.get(ord(data[2])) == len(data) and checksum_ok(data):
+
+            self.frames += 1
+
+            counters["frames"] += 1
+
+            return [data]
+
+        self.buffer.extend(data)
+
+        frames = []
+
+        buffer = self.buffer
+
+        while 1:
+
+            start = buffer.find(HEADER)
+
+            if start < 0:
+
+                if buffer:
+
+                    keep = 1 if buffer[-1] == 0xf5 else 0
+
+                    if len(buffer) > keep:
+
+                        self._resync()
+
+                    del buffer[:len(buffer) - keep]
+
+                break
+
+            if start > 0:
+
+                self._resync()
+
+                del buffer[:start]
+
+            if len(buffer) < 3:
+
+                break
+
+            length = self.lengths.get(buffer[2])
+
+            if length is None:
+
+                end = buffer.find(HEADER, 2)
+
+                end = len(buffer) if end < 0 else end
+
+                frames.append(str(buffer[:end]))
+
+                self._bad()
+
+                del buffer[:end]
+
+                continue
+
+            if len(buffer) < length:
+
+                break
+
+            frame = str(buffer[:length])
+
+            if not checksum_ok(frame):
+
+                nested = buffer.find(HEADER, 2)
+
+                if 0 < nested < length:
+
+                    self._resync()
+
+                    del buffer[:nested]
+
+                    continue
+
+                self._bad()
+
+            frames.append(frame)
+
+            self.frames += 1
+
+            counters["frames"] += 1
+
+            del buffer[:length]
+
+        return frames
+
+    def _resync(self):
+
+        self.resyncs += 1
+
+        counters["resyncs"] += 1
+
+    def _bad(self):
+
+        self.bad_frames += 1
+
+        counters["bad_frames"] += 1
+
+    def stats(self):
+
+        """
+
+        :return: 包含完整帧数量,重新同步次数,无效帧数量以及缓存字节数的字典
+
+        """
+
+        return {
+            "frames": self.frames,
+            "resyncs": self.resyncs,
+            "bad_frames": self.bad_frames,
+            "buffered": len(self.buffer),
+        }
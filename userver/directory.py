@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""directory
+
+这个模块实现集群范围的设备会话目录.
+
+设备重新接入时可能被负载均衡分配到任何一个节点(或者同一个节点的任何一个工作进程),原来的会话如果还没有发现链接断开,会继续等待同一个命令列表,和新的会话争抢命令.会话目录在`redis`中为每台设备保存一个带有租期的所有者记录:
+
+    owner:<MAC> = "<节点名称>:<进程号> <会话标志>"  (过期时间为租期)
+
+新的会话接入时取代所有者记录,如果原来的所有者是另一个进程,向它的收件箱发送驱逐消息,原来的会话立刻关闭.每个进程定期续租自己持有的所有会话,续租时发现记录已经被别人取代(或者已经过期被别人取得)的会话同样关闭.会话结束时只删除仍然属于自己的记录,只有这时才把设备标记为离线.
+
+每个进程有一个收件箱`inbox:<节点名称>:<进程号>`,由这个进程的命令分发器等待.`monitor`根据所有者记录把命令直接放入所有者的收件箱;没有所有者的设备以及用户命令仍然放入以物理地址命名的列表,只有所有者会等待这个列表.
+
+"""
+
+import os
+import logging
+
+import redis
+import gevent
+
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+"""str: 续租脚本,只有记录仍然属于这个会话时才延长过期时间"""
+
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+"""str: 释放脚本,只有记录仍然属于这个会话时才删除"""
+
+
+class SessionDirectory(object):
+
+    """基于`redis`的集群会话目录"""
+
+    def __init__(self, client, sessions, node, lease=30):
+
+        """
+
+        :param client: `redis`客户端
+        :param sessions: 这个进程的会话注册表,`monitor`只用来查询所有者时为`None`
+        :param node: 节点名称,同一个集群内唯一
+        :param lease: 所有者记录的租期秒数,每隔三分之一租期续租一次
+
+        """
+
+        self.client = client
+
+        self.sessions = sessions
+
+        self.node = node
+
+        self.lease = lease
+
+        self._renew = client.register_script(RENEW)
+
+        self._release = client.register_script(RELEASE)
+
+        self._greenlet = None
+
+        self._claims = 0
+
+        self._evictions = 0
+
+        self._lost = 0
+
+    @property
+    def owner(self):
+
+        """这个进程的所有者名称,每次读取进程号,多进程模式下在工作进程中得到各自的名称"""
+
+        return "%s:%s" % (self.node, os.getpid())
+
+    @property
+    def inbox(self):
+
+        """这个进程的收件箱"""
+
+        return "inbox:%s" % self.owner
+
+    @staticmethod
+    def key(MAC):
+
+        return "owner:%s" % MAC
+
+    def value(self, session):
+
+        return "%s %s" % (self.owner, session.token)
+
+    def claim(self, session):
+
+        """取得设备的所有权,如果原来的所有者是另一个进程,通知它关闭原来的会话
+
+        :param session: 新的设备会话
+        :return: 原来的所有者名称,没有所有者时返回`None`
+
+        """
+
+        pipe = self.client.pipeline()
+
+        pipe.getset(self.key(session.MAC), self.value(session))
+
+        pipe.expire(self.key(session.MAC), self.lease)
+
+        previous, _ = pipe.execute()
+
+        self._claims += 1
+
+        if not previous:
+
+            return None
+
+        owner, _, token = previous.partition(' ')
+
+        if owner != self.owner:
+
+            logging.warning("%s 从 %s 接管设备", session.MAC, owner)
+
+            self.deliver(owner, "evict %s %s" % (session.MAC, token))
+
+            self._evictions += 1
+
+        return owner
+
+    def release(self, session):
+
+        """释放设备的所有权
+
+        :param session: 结束的设备会话
+        :return: 记录仍然属于这个会话并且已经删除返回`True`;已经被别人取代返回`False`,此时不应该把设备标记为离线
+
+        """
+
+        try:
+
+            return bool(self._release(keys=[self.key(session.MAC)], args=[self.value(session)]))
+
+        except redis.RedisError:
+
+            logging.exception("%s 释放所有权失败", session.MAC)
+
+            return True
+
+    def renew(self):
+
+        """续租这个进程持有的所有会话,已经被别人取代的会话立刻关闭
+
+        :return: 失去所有权的会话数量
+
+        """
+
+        held = [session for session in self.sessions if not session.closed]
+
+        if not held:
+
+            return 0
+
+        pipe = self.client.pipeline(transaction=False)
+
+        for session in held:
+
+            self._renew(keys=[self.key(session.MAC)], args=[self.value(session), self.lease], client=pipe)
+
+        lost = 0
+
+        for session, renewed in zip(held, pipe.execute()):
+
+            if not renewed and not session.closed:
+
+                logging.warning("%s 失去所有权", session.MAC)
+
+                session.close("evicted")
+
+                lost += 1
+
+        self._lost += lost
+
+        return lost
+
+    def owners(self, MACs):
+
+        """批量查询设备的所有者
+
+        :param MACs: 设备的物理地址列表
+        :return: 与`MACs`一一对应的所有者名称列表,没有所有者为`None`
+
+        """
+
+        if not MACs:
+
+            return []
+
+        return [value.partition(' ')[0] if value else None for value in self.client.mget([self.key(MAC) for MAC in MACs])]
+
+    def deliver(self, owner, message, pipe=None):
+
+        """向一个进程的收件箱放入一条消息,并把收件箱的过期时间设置为两个租期,已经退出的进程的收件箱会自动删除
+
+        :param owner: 所有者名称
+        :param message: 消息
+        :param pipe: `redis`管道,如果指定,消息写入管道,由调用者统一执行
+        :return: 无返回值
+
+        """
+
+        target = pipe or self.client.pipeline(transaction=False)
+
+        target.lpush("inbox:%s" % owner, message)
+
+        target.expire("inbox:%s" % owner, 2 * self.lease)
+
+        if pipe is None:
+
+            target.execute()
+
+    def route(self, MAC, task, owner=None, pipe=None):
+
+        """投递一条命令,有所有者时放入所有者的收件箱,否则放入以物理地址命名的列表
+
+        :param MAC: 设备的物理地址
+        :param task: 命令
+        :param owner: 所有者名称(参见`owners`)
+        :param pipe: `redis`管道,如果指定,命令写入管道,由调用者统一执行
+        :return: 无返回值
+
+        """
+
+        if owner:
+
+            self.deliver(owner, "%s %s" % (MAC, task), pipe)
+
+        else:
+
+            (pipe or self.client).lpush(MAC, task)
+
+    def _run(self):
+
+        while 1:
+
+            gevent.sleep(self.lease / 3.0)
+
+            try:
+
+                self.renew()
+
+            except redis.RedisError:
+
+                logging.exception("续租失败")
+
+    def start(self):
+
+        """启动续租协程"""
+
+        if self._greenlet is None:
+
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+
+        """停止续租协程"""
+
+        if self._greenlet is not None:
+
+            self._greenlet.kill()
+
+            self._greenlet = None
+
+    def stats(self):
+
+        """
+
+        :return: 包含取得所有权次数,驱逐其它进程的会话次数,续租时失去所有权的会话数量的字典
+
+        """
+
+        return {
+            "claims": self._claims,
+            "evictions": self._evictions,
+            "lost": self._lost,
+        }
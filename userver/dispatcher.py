@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+"""dispatcher
+
+这个模块实现集中的`redis`命令分发器.
+
+用户命令以及监控命令仍然放入以设备物理地址命名的列表.分发器把所有在线设备的物理地址分成若干组,每组由一个协程使用`BRPOP`同时阻塞等待,取到命令之后放入对应会话的命令队列.空闲设备不再产生任何`redis`请求,命令到达之后几毫秒之内就会被处理.
+
+每次`BRPOP`都要让`redis`解析并登记这一组的全部列表,所以等待的超时时间较长(默认30秒),而不是定期重新等待.每组另外等待一个唤醒列表,设备注册或者注销之后向这一组的唤醒列表放入一个元素,正在等待的协程立刻返回,使用新的列表重新等待;同一次等待期间只唤醒一次.
+
+会话按照通道放入命令(参见`session.enqueue`),重复的监控命令直接合并;用户命令在会话的命令通道已满时被拒绝,由`reject`立刻返回执行失败,不让移动应用后台一直等到超时.
+
+使用集群会话目录(参见`directory`)时,第一组同时等待这个进程的收件箱.收件箱中的命令带有物理地址前缀,驱逐消息带有会话标志,标志相同的会话立刻关闭.
+
+"""
+
+import os
+import time
+import logging
+import platform
+
+import redis
+import gevent
+
+from userver.metrics import REDIS_SECONDS
+
+RETRY_DELAY = 1
+"""int: 等待或者分发命令失败之后重试之前的秒数"""
+
+
+class Dispatcher(object):
+
+    """`redis`命令分发器"""
+
+    def __init__(self, client, sessions, workers=16, timeout=30, reject=None):
+
+        """
+
+        :param client: `redis`客户端
+        :param sessions: 会话注册表,用来查找命令对应的会话
+        :param workers: 阻塞等待的协程数量,每个协程使用一个`redis`链接
+        :param timeout: 每次`BRPOP`的超时秒数,唤醒消息丢失(例如`redis`短暂不可用)时,新注册的设备最迟在这个时间之后开始接收命令
+        :param reject: 命令通道已满时调用的函数,参数为物理地址以及被拒绝的命令(字符串)
+
+        """
+
+        self.client = client
+
+        self.sessions = sessions
+
+        self.workers = workers
+
+        self.timeout = timeout
+
+        self._keys = [set() for _ in xrange(workers)]
+
+        self.inbox = None
+
+        self._greenlets = []
+
+        self._spawn = gevent.spawn
+
+        self._sleep = gevent.sleep
+
+        self._wakeups = []
+
+        self._waking = [False] * workers
+
+        self._routed = 0
+
+        self._requeued = 0
+
+        self.reject = reject
+
+        self._coalesced = 0
+
+        self._rejected = 0
+
+        self._invalid = 0
+
+    def register(self, session):
+
+        """开始等待这个会话的命令,会话需要已经加入会话注册表
+
+        :param session: 设备会话
+        :return: 无返回值
+
+        """
+
+        index = hash(session.MAC) % self.workers
+
+        self._keys[index].add(session.MAC)
+
+        self._wake(index)
+
+    def unregister(self, session):
+
+        """停止等待这个会话的命令,如果这个物理地址已经被新的会话注册,不做任何操作.需要在会话从注册表注销之前调用
+
+        :param session: 设备会话
+        :return: 无返回值
+
+        """
+
+        if self.sessions.get(session.MAC) is session:
+
+            index = hash(session.MAC) % self.workers
+
+            self._keys[index].discard(session.MAC)
+
+            self._wake(index)
+
+    def _wake(self, index):
+
+        """让一组正在等待的协程立刻返回,使用新的列表重新等待,同一次等待期间只唤醒一次"""
+
+        if not self._wakeups or self._waking[index]:
+
+            return
+
+        self._waking[index] = True
+
+        self._spawn(self._push, index)
+
+    def _push(self, index):
+
+        pipe = self.client.pipeline(transaction=False)
+
+        pipe.lpush(self._wakeups[index], 1)
+
+        pipe.expire(self._wakeups[index], 2 * self.timeout)
+
+        try:
+
+            pipe.execute()
+
+        except redis.RedisError:
+
+            logging.exception("唤醒第 %s 组失败", index)
+
+    def _run(self, index, inbox=None):
+
+        keys = self._keys[index]
+
+        wakeup = self._wakeups[index]
+
+        failed = None
+
+        while 1:
+
+            # 从这里开始注册或者注销的设备需要重新唤醒
+            self._waking[index] = False
+
+            item = None
+
+            try:
+
+                item = self.client.brpop(list(keys) + [wakeup] + ([inbox] if inbox else []), self.timeout)
+
+                if item is not None and item[0] != wakeup:
+
+                    self._route(item, inbox)
+
+                    failed = None
+
+            except Exception:
+
+                # 任何一次失败(等待命令,退回命令,放入会话)都不能结束这个协程,否则这一组设备再也收不到命令
+
+                logging.exception("分发命令失败: %s", item)
+
+                if item is not None and item[0] != wakeup:
+
+                    failed = self._restore(item, failed)
+
+                self._sleep(RETRY_DELAY)
+
+    def _restore(self, item, failed):
+
+        """把分发失败的命令放回原来的列表,下次最先取到,同一条命令连续失败两次则丢弃,避免一条无法处理的命令一直占用这一组
+
+        :param item: (列表名称, 命令)
+        :param failed: 上一次放回的命令
+        :return: 这次放回的命令,丢弃或者放回失败时返回`None`
+
+        """
+
+        if item == failed:
+
+            logging.error("%s 命令再次分发失败,丢弃: %s", *item)
+
+            return None
+
+        try:
+
+            self.client.rpush(*item)
+
+        except redis.RedisError:
+
+            logging.exception("%s 放回命令失败,丢弃: %s", *item)
+
+            return None
+
+        return item
+
+    def _route(self, item, inbox=None):
+
+        """把`BRPOP`取到的一条命令交给对应的会话,会话不在这个进程时放回列表
+
+        :param item: (列表名称, 命令)
+        :param inbox: 这个进程的收件箱
+        :return: 无返回值
+
+        """
+
+        MAC, task = item
+
+        if MAC == inbox:
+
+            if task.startswith("evict "):
+
+                self._evict(*task.split(' ')[1:3])
+
+                return
+
+            MAC, _, task = task.partition(' ')
+
+        session = self.sessions.get(MAC)
+
+        if session is None:
+
+            begin = time.time()
+
+            self.client.rpush(MAC, task)
+
+            REDIS_SECONDS.labels("requeue").observe(time.time() - begin)
+
+            self._requeued += 1
+
+            return
+
+        status = session.put_task(task)
+
+        self._routed += 1
+
+        if status is not None and status != "queued":
+
+            self.settle(MAC, task, status)
+
+    def _evict(self, MAC, token):
+
+        session = self.sessions.get(MAC)
+
+        if session is not None and session.token == token:
+
+            logging.warning("%s 会话被其它进程接管", MAC)
+
+            session.close("evicted")
+
+    def settle(self, MAC, task, status):
+
+        """统计没有放入命令通道的命令,被拒绝的用户命令交给`reject`
+
+        :param MAC: 设备的物理地址
+        :param task: 命令(字符串)
+        :param status: 放入结果(参见`session.enqueue`)
+        :return: 无返回值
+
+        """
+
+        if status == "coalesced":
+
+            self._coalesced += 1
+
+        elif status == "rejected":
+
+            self._rejected += 1
+
+            logging.warning("%s 命令通道已满,拒绝命令: %s", MAC, task)
+
+            if self.reject is not None:
+
+                try:
+
+                    self.reject(MAC, task)
+
+                except redis.RedisError:
+
+                    logging.exception("%s 返回拒绝结果失败", MAC)
+
+        elif status == "invalid":
+
+            self._invalid += 1
+
+            logging.error("%s 无法解析的命令: %s", MAC, task)
+
+    def requeue(self, session):
+
+        """把会话中尚未执行的用户命令以及控制命令按照原来的顺序放回以物理地址命名的列表,会话结束时调用,下一个会话(可能在其它进程)继续执行,监控命令由下一个监控周期重新产生
+
+        :param session: 结束的设备会话
+        :return: 放回的命令数量
+
+        """
+
+        tasks = list(session.tasks)
+
+        del session.tasks[:]
+
+        if not tasks:
+
+            return 0
+
+        pipe = self.client.pipeline(transaction=False)
+
+        for task in reversed(tasks):
+
+            pipe.rpush(session.MAC, str(task))
+
+        try:
+
+            pipe.execute()
+
+        except redis.RedisError:
+
+            logging.exception("%s 放回命令失败: %s", session.MAC, tasks)
+
+            return 0
+
+        self._requeued += len(tasks)
+
+        return len(tasks)
+
+    def start(self, spawn=gevent.spawn, sleep=gevent.sleep):
+
+        """启动阻塞等待命令的协程,`inbox`需要在这之前设置
+
+        唤醒列表的名称包含进程号,需要在工作进程中调用(参见`prefork`)
+
+        :param spawn: 启动等待循环以及发送唤醒消息的函数,参数与`gevent.spawn`相同.`asyncio`引擎(参见`engine`)使用系统线程,这时会话的`put_task`需要是线程安全的,并且不能调用`stop`
+        :param sleep: 等待循环出错之后使用的等待函数,系统线程中为`time.sleep`
+        :return: 无返回值
+
+        """
+
+        if not self._greenlets:
+
+            self._spawn = spawn
+
+            self._sleep = sleep
+
+            self._wakeups = ["dispatch:%s:%s:%s" % (platform.node(), os.getpid(), i) for i in xrange(self.workers)]
+
+            self._greenlets = [spawn(self._run, i, self.inbox if i == 0 else None) for i in xrange(self.workers)]
+
+    def stop(self):
+
+        """停止阻塞等待命令的协程"""
+
+        gevent.killall(self._greenlets)
+
+        self._greenlets = []
+
+        self._wakeups = []
+
+    def depths(self):
+
+        """每组设备每条命令通道的总长度
+
+        :return: (组号, 通道)到这组在线会话中尚未执行的命令数量的字典,通道为`user`(用户命令以及控制命令)或者`probe`(监控命令类型)
+
+        """
+
+        depths = {}
+
+        for i, keys in enumerate(self._keys):
+
+            tasks = probes = 0
+
+            for MAC in list(keys):
+
+                session = self.sessions.get(MAC)
+
+                if session is not None:
+
+                    tasks += len(session.tasks)
+
+                    probes += len(session.probes)
+
+            depths[(str(i), "user")] = tasks
+
+            depths[(str(i), "probe")] = probes
+
+        return depths
+
+    def deepest(self):
+
+        """
+
+        :return: 单个在线会话尚未执行的用户命令以及控制命令的最大数量
+
+        """
+
+        return max([len(session.tasks) for session in self.sessions] or [0])
+
+    def stats(self):
+
+        """分发器的运行统计
+
+        :return: 包含等待命令的设备数量,分发命令数量,退回命令数量,合并的监控命令数量,拒绝的用户命令数量以及无法解析的命令数量的字典
+
+        """
+
+        return {
+            "keys": sum(len(keys) for keys in self._keys),
+            "routed": self._routed,
+            "requeued": self._requeued,
+            "coalesced": self._coalesced,
+            "rejected": self._rejected,
+            "invalid": self._invalid,
+        }
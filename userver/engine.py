@@ -0,0 +1,782 @@
+# -*- coding: utf-8 -*-
+
+"""engine
+
+这个模块实现`tcp_server`的第二个服务器引擎,基于`asyncio`的传输和协议(Python 2使用`trollius`,安装了`uvloop`时使用`uvloop`的事件循环).
+
+`gevent`引擎为每个链接保留一个协程,命令处理函数按照顺序阻塞等待响应.这个引擎不替换标准库(`tcp_server`在`USERVER_ENGINE=asyncio`时不调用`monkey.patch_all`),每个链接只是一个`DeviceProtocol`对象,收发数据以及等待响应都是事件循环中的回调:
+
+    命令按照与`gevent`引擎相同的优先级(用户命令,监控命令,上报信息)逐条执行,发送之后登记期望的响应类型以及超时定时器,响应到达或者超时之后重发或者结束;
+    响应的解析以及设备状态的更新使用`tcp_server`中两个引擎共用的`on_*`函数;
+    数据库和`redis`的调用会阻塞,全部交给一个专门的线程按照顺序执行,事件循环从不等待它们,数据库链接池使用系统线程的信号量(参见`pool.ThreadSemaphore`);
+    命令分发器(参见`dispatcher`)的等待循环运行在系统线程中,使用`time.sleep`等待,通过`call_soon_threadsafe`把命令交给事件循环;
+    设备状态以及遥测数据历史记录由事件循环定时交给上述线程写入.
+
+这个引擎暂不支持集群会话目录,进程内轮询器以及阻塞检测,这些功能依赖`gevent`.打开`CLUSTER_DIRECTORY`或者`POLL_IN_SERVER`时拒绝启动(参见`unsupported`): 这个引擎的会话不写入所有者记录,`monitor`却根据所有者记录把监控命令以及定时命令放入收件箱,没有进程等待这些收件箱.`monitor`读取同一个`CLUSTER_DIRECTORY`,关闭之后所有命令都放入以物理地址命名的列表.
+
+运行方法: `USERVER_ENGINE=asyncio python tcp_server.py`
+
+"""
+
+import os
+import re
+import time
+import signal
+import socket
+import logging
+import threading
+
+from binascii import hexlify
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+
+    import asyncio
+
+except ImportError:
+
+    import trollius as asyncio
+
+try:
+
+    import uvloop
+
+except ImportError:
+
+    uvloop = None
+
+from userver.codec import FrameDecoder
+from userver.logs import Hex
+from userver.session import enqueue
+from userver.metrics import application
+
+
+class DeviceProtocol(asyncio.Protocol):
+
+    """一个设备链接,同时也是会话(提供会话注册表,命令分发器以及状态查看使用的属性和方法)"""
+
+    def __init__(self, server):
+
+        """
+
+        :param server: 所属的`AsyncServer`
+
+        """
+
+        self.server = server
+
+        self.handlers = server.handlers
+
+        self.loop = server.loop
+
+        self.MAC = None
+
+        self.transport = None
+
+        self.address = None
+
+        self.token = None
+
+        self.tasks = []
+
+        self.reports = []
+
+        self.probes = set()
+
+        self.decoder = FrameDecoder()
+
+        self.closed = False
+
+        self.reason = None
+
+        self.connected_at = time.time()
+
+        self.last_seen = self.connected_at
+
+        self.task = None
+
+        self.task_started = None
+
+        self.pipeline = True
+
+        self.busy = False
+
+        self._pending = {}
+
+        self._responses = {}
+
+        self._commands = []
+
+        self._attempt = 0
+
+        self._times = 0
+
+        self._sent_at = 0
+
+        self._timer = None
+
+        self._callback = None
+
+    def connection_made(self, transport):
+
+        self.transport = transport
+
+        self.address = transport.get_extra_info("peername")
+
+        self.handlers.ACCEPTS.inc()
+
+        self._timer = self.loop.call_later(socket.getdefaulttimeout() or 5, self._handshake_timeout)
+
+    def _handshake_timeout(self):
+
+        if self.MAC is None:
+
+            logging.critical("接收数据失败")
+
+            self.handlers.DISCONNECTS.labels("handshake").inc()
+
+            self.closed = True
+
+            self.transport.close()
+
+    def data_received(self, data):
+
+        if self.MAC is None:
+
+            self._timer.cancel()
+
+            self._timer = None
+
+            if not re.match("[0-9A-F]{12}", data):
+
+                logging.critical("物理地址无效: %s", data)
+
+                self.handlers.DISCONNECTS.labels("handshake").inc()
+
+                self.closed = True
+
+                self.transport.close()
+
+                return
+
+            self._accept(data)
+
+            return
+
+        self.last_seen = time.time()
+
+        for frame in self.decoder.feed(data):
+
+            response_type = ord(frame[2]) if len(frame) > 2 else None
+
+            if response_type in self._pending:
+
+                self._response(response_type, frame)
+
+            else:
+
+                self.reports.append(frame)
+
+        self._next()
+
+    def connection_lost(self, exc):
+
+        if self.MAC is None:
+
+            return
+
+        if self.reason is None:
+
+            self.reason = "error" if exc is not None else "empty"
+
+        self.closed = True
+
+        if self._timer is not None:
+
+            self._timer.cancel()
+
+            self._timer = None
+
+        if self._callback is not None:
+
+            self._settle()
+
+        self.server.release(self)
+
+    def _accept(self, MAC):
+
+        """通过物理地址检测之后注册会话,接管同一台设备原来的会话,然后确定设备的具体情况"""
+
+        handlers = self.handlers
+
+        logging.info("物理地址: %s", MAC)
+
+        self.MAC = MAC
+
+        self.token = hexlify(os.urandom(6))
+
+        self.pipeline = handlers.PROBE_PIPELINE and MAC not in handlers.PROBE_SEQUENTIAL
+
+        replaced = handlers.sessions.add(self)
+
+        if replaced is not None:
+
+            handlers.TAKEOVERS.inc()
+
+            logging.warning("%s 重新接入,接管原来的会话", MAC)
+
+            self.tasks[:0] = replaced.tasks
+
+            del replaced.tasks[:]
+
+            self.probes.update(replaced.probes)
+
+            replaced.probes.clear()
+
+            replaced.close("replaced")
+
+        handlers.dispatcher.register(self)
+
+        if replaced is not None:
+
+            logging.info("旧的设备重新接入: %s", MAC)
+
+            return
+
+        self.busy = True
+
+        self.server.io(handlers.known_device, MAC).add_done_callback(self._admitted)
+
+    def _admitted(self, future):
+
+        if future.exception() is not None or self.closed:
+
+            self._finish()
+
+            return
+
+        if future.result():
+
+            logging.info("旧的设备: %s", self.MAC)
+
+            self.server.io(self.handlers.state_writer.commit, self.MAC, online=1)
+
+            self._finish()
+
+            return
+
+        logging.info("新的设备: %s", self.MAC)
+
+        def tested(responses):
+
+            logging.info("%s 测试链接%s", self.MAC, "成功" if 1 in responses else "失败")
+
+            self.server.io(self.handlers.register_device, self.MAC, self.address[0] if self.address else '')
+
+            self._finish()
+
+        self.execute([("f5aa010001", 5, 1)], tested)
+
+    def put_task(self, task):
+
+        """放入一条命令,由命令分发器的线程调用"""
+
+        self.loop.call_soon_threadsafe(self._put, task)
+
+    def _put(self, task):
+
+        handlers = self.handlers
+
+        status = enqueue(self, task, handlers.QUEUE_LIMIT)
+
+        if status == "rejected":
+
+            self.server.io(handlers.dispatcher.settle, self.MAC, task, status)
+
+        elif status != "queued":
+
+            handlers.dispatcher.settle(self.MAC, task, status)
+
+        if self.closed:
+
+            self.server.io(self.handlers.dispatcher.requeue, self)
+
+            return
+
+        self._next()
+
+    def send(self, data):
+
+        self.transport.write(data)
+
+    def close(self, reason=None):
+
+        """关闭链接,之后事件循环调用`connection_lost`执行清理"""
+
+        if self.reason is None:
+
+            self.reason = reason or "closed"
+
+        self.closed = True
+
+        self.transport.close()
+
+    def execute(self, commands, callback, times=5):
+
+        """发送一组命令并且等待响应,响应类型不能重复
+
+        会话允许批量发送(参见`PROBE_PIPELINE`)时所有命令连续写入链接,否则逐条发送.每次发送之后最多等待`socket.getdefaulttimeout()`秒,没有收到有效响应的命令重新发送,`times`次之后仍然没有收到有效响应则关闭会话(与`send_command`相同)
+
+        :param commands: 由(待发送的命令, 响应长度, 响应类型)组成的列表
+        :param callback: 全部命令结束之后调用,参数为响应类型到有效响应数据的字典
+        :param times: 每条命令的发送次数
+        :return: 无返回值
+
+        """
+
+        if not self.pipeline and len(commands) > 1:
+
+            responses = {}
+
+            def step(index, partial=None):
+
+                responses.update(partial or {})
+
+                if index == len(commands) or self.closed:
+
+                    callback(responses)
+
+                else:
+
+                    self.execute([commands[index]], lambda result: step(index + 1, result), times)
+
+            step(0)
+
+            return
+
+        self._commands = commands
+
+        self._responses = {}
+
+        self._callback = callback
+
+        self._attempt = 0
+
+        self._times = times
+
+        self._send()
+
+    def _send(self):
+
+        handlers = self.handlers
+
+        waiting = [command for command in self._commands if command[2] not in self._responses]
+
+        if self._attempt:
+
+            for command, _, _ in waiting:
+
+                handlers.COMMAND_RETRIES_BY_TYPE[command[4:6]].inc()
+
+        self._attempt += 1
+
+        self._pending = dict((response_type, (command[4:6], length)) for command, length, response_type in waiting)
+
+        self._sent_at = time.time()
+
+        self.send(''.join(handlers.set_checksum(command) for command, _, _ in waiting))
+
+        self._timer = self.loop.call_later(socket.getdefaulttimeout() or 5, self._settle)
+
+    def _response(self, response_type, frame):
+
+        kind, length = self._pending.pop(response_type)
+
+        handlers = self.handlers
+
+        logging.info("%s 发送 %s", self.MAC, Hex(frame[:length]))
+
+        if handlers.get_checksum(frame[:length]):
+
+            handlers.COMMAND_SECONDS_BY_TYPE[kind].observe(time.time() - self._sent_at)
+
+            self._responses[response_type] = handlers.translate(frame, "client")[3:-1]
+
+        else:
+
+            logging.error("%s 响应校验出错", self.MAC)
+
+        if not self._pending:
+
+            self._timer.cancel()
+
+            self._settle()
+
+    def _settle(self):
+
+        """一次发送的所有响应到达或者超时之后调用,决定重发或者结束"""
+
+        self._timer = None
+
+        self._pending = {}
+
+        callback = self._callback
+
+        if len(self._responses) < len(self._commands) and not self.closed:
+
+            if self._attempt < self._times:
+
+                self._send()
+
+                return
+
+            logging.critical("%s 等待响应超时", self.MAC)
+
+            self.close("timeout")
+
+        self._callback = None
+
+        callback(self._responses)
+
+    def _next(self):
+
+        """空闲时按照用户命令,监控命令,上报信息的优先级开始处理下一项"""
+
+        if self.busy or self.closed or self.MAC is None:
+
+            return
+
+        handlers = self.handlers
+
+        MAC = self.MAC
+
+        io = self.server.io
+
+        if self.tasks:
+
+            task = self.tasks.pop(0)
+
+            logging.info("%s 命令: %s", self.MAC, task)
+
+            self.busy = True
+
+            self.task = task
+
+            self.task_started = time.time()
+
+            kind = task["type"]
+
+            if kind == -2:
+
+                logging.info("%s 设备被要求下线", MAC)
+
+                self.close("offline")
+
+            elif kind == -1:
+
+                handlers.dispatcher.unregister(self)
+
+                handlers.sessions.remove(self)
+
+                io(handlers.remove_device, MAC, task)
+
+                self.close("delete")
+
+            elif kind == 0:
+
+                self.execute([("f5aa030100", 8, 3)], lambda responses: self._finish(handlers.on_turnof, MAC, task, responses.get(3)))
+
+            elif kind == 1:
+
+                if task["time"] not in [1, 2, 3, 4, 5, 6, 7, 8]:
+
+                    logging.error("%s 加热持续时间超出预定范围", MAC)
+
+                    self._finish(handlers.return_status, task["id"], 1, "%s 加热持续时间超出预定范围" % MAC)
+
+                else:
+
+                    self.execute([("f5aa03010%d" % task["time"], 8, 3)], lambda responses: self._finish(handlers.on_turnon, MAC, task, responses.get(3)))
+
+            elif kind == 5:
+
+                self._probe([handlers.PROBES[probe] for probe in task.get("probes", sorted(handlers.PROBES)) if probe in handlers.PROBES])
+
+            elif kind in (2, 4, 6, 7):
+
+                self._probe([handlers.PROBES[kind]])
+
+            else:
+
+                self._finish()
+
+        elif self.probes:
+
+            task = {"type": 5, "probes": sorted(self.probes)}
+
+            self.probes.clear()
+
+            self.busy = True
+
+            self.task = task
+
+            self.task_started = time.time()
+
+            self._probe([handlers.PROBES[probe] for probe in task["probes"] if probe in handlers.PROBES])
+
+        elif self.reports:
+
+            frame = self.reports.pop(0)
+
+            self.busy = True
+
+            io(handlers.on_report, MAC, frame).add_done_callback(self._reported)
+
+    def _probe(self, probes):
+
+        def done(responses):
+
+            for _, _, response_type, apply in probes:
+
+                self.server.io(apply, self.MAC, responses.get(response_type))
+
+            self._finish()
+
+        self.execute([(command, length, response_type) for command, length, response_type, _ in probes], done)
+
+    def _reported(self, future):
+
+        if future.exception() is None and not self.closed:
+
+            command, refresh = future.result()
+
+            self.send(self.handlers.set_checksum(command))
+
+            if refresh:
+
+                self.probes.add(7)
+
+        self._finish()
+
+    def _finish(self, function=None, *args):
+
+        """当前一项处理完毕,把结果交给线程处理,然后开始下一项
+
+        :param function: 处理结果的函数,例如`on_turnon`,在执行数据库和`redis`调用的线程中运行
+        :param args: 函数的参数
+        :return: 无返回值
+
+        """
+
+        if function is not None:
+
+            self.server.io(function, *args)
+
+        self.busy = False
+
+        self.task = None
+
+        self._next()
+
+    def info(self):
+
+        """会话的当前状态,格式与`session.Session.info`相同"""
+
+        return {
+            "mac": self.MAC,
+            "connected_at": self.connected_at,
+            "last_seen": self.last_seen,
+            "task": self.task,
+            "busy": time.time() - self.task_started if self.task is not None and self.task_started else None,
+            "waiting": sorted(self._pending),
+            "depth": len(self.tasks),
+            "probes": sorted(self.probes),
+            "reason": self.reason,
+        }
+
+
+def unsupported(handlers):
+
+    """
+
+    :param handlers: `tcp_server`模块
+    :return: 这个引擎不支持却已经打开的配置项名称列表
+
+    """
+
+    return [name for name in ("CLUSTER_DIRECTORY", "POLL_IN_SERVER") if getattr(handlers, name)]
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+
+        pass
+
+
+class AsyncServer(object):
+
+    """`asyncio`引擎的服务器"""
+
+    def __init__(self, handlers, address=("0.0.0.0", 9009), backlog=256):
+
+        """
+
+        :param handlers: `tcp_server`模块,提供两个引擎共用的命令处理函数,会话注册表,命令分发器,状态写入器以及指标
+        :param address: 监听地址以及端口
+        :param backlog: 等待接受的链接数量上限
+
+        """
+
+        if uvloop is not None:
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        self.handlers = handlers
+
+        self.address = address
+
+        self.backlog = backlog
+
+        self.loop = asyncio.new_event_loop()
+
+        asyncio.set_event_loop(self.loop)
+
+        self.executor = ThreadPoolExecutor(1)
+
+    def io(self, function, *args, **kwargs):
+
+        """在执行数据库和`redis`调用的线程中运行一个函数
+
+        :param function: 函数
+        :param args: 位置参数
+        :param kwargs: 关键字参数
+        :return: `asyncio`的`Future`,可以在事件循环中添加完成回调
+
+        """
+
+        future = self.loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+        future.add_done_callback(self._check)
+
+        return future
+
+    @staticmethod
+    def _check(future):
+
+        error = future.exception()
+
+        if error is not None:
+
+            logging.error("后台调用失败: %r", error)
+
+    def release(self, session):
+
+        """会话结束之后的清理,与`tcp_server.handle`结束时相同"""
+
+        handlers = self.handlers
+
+        handlers.dispatcher.unregister(session)
+
+        handlers.DISCONNECTS.labels(session.reason or "closed").inc()
+
+        self.io(handlers.dispatcher.requeue, session)
+
+        if handlers.sessions.remove(session):
+
+            self.io(handlers.state_writer.commit, session.MAC, online=0)
+
+            self.io(handlers.state_writer.forget, session.MAC)
+
+    def every(self, interval, function):
+
+        """每隔`interval`秒在线程中调用一次`function`"""
+
+        def tick():
+
+            self.io(function)
+
+            self.loop.call_later(interval, tick)
+
+        self.loop.call_later(interval, tick)
+
+    def thread(self, function, *args):
+
+        """在后台系统线程中运行一个函数,用于命令分发器的等待循环(参见`dispatcher.Dispatcher.start`)"""
+
+        worker = threading.Thread(target=function, args=args)
+
+        worker.daemon = True
+
+        worker.start()
+
+        return worker
+
+    def run(self, listener=None, metrics_port=0):
+
+        """启动服务,直到收到`SIGTERM`或者`SIGINT`信号
+
+        :param listener: 已经开始监听的链接(多进程模式),`None`时自己监听`address`
+        :param metrics_port: 导出指标的端口,`0`表示不导出
+        :return: 无返回值
+        :raise ValueError: 打开了这个引擎不支持的配置项(参见`unsupported`)
+
+        """
+
+        handlers = self.handlers
+
+        if unsupported(handlers):
+
+            raise ValueError("asyncio引擎不支持 %s,需要在userver中关闭" % ", ".join(unsupported(handlers)))
+
+        if listener is not None:
+
+            server = self.loop.run_until_complete(self.loop.create_server(lambda: DeviceProtocol(self), sock=listener, backlog=self.backlog))
+
+        else:
+
+            server = self.loop.run_until_complete(self.loop.create_server(lambda: DeviceProtocol(self), self.address[0], self.address[1], backlog=self.backlog))
+
+        handlers.dispatcher.start(self.thread, time.sleep)
+
+        if metrics_port:
+
+            self.thread(make_server("127.0.0.1", metrics_port, application, handler_class=QuietHandler).serve_forever)
+
+            logging.info("指标导出端口: 127.0.0.1:%s", metrics_port)
+
+        handlers.history.check()
+
+        self.every(handlers.STATE_FLUSH_INTERVAL, handlers.state_writer.flush)
+
+        self.every(handlers.HISTORY_FLUSH_INTERVAL, handlers.history.flush)
+
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+
+        self.loop.add_signal_handler(signal.SIGINT, self.loop.stop)
+
+        logging.info("asyncio引擎启动: %s", type(self.loop).__module__)
+
+        try:
+
+            self.loop.run_forever()
+
+        finally:
+
+            server.close()
+
+            for session in list(handlers.sessions):
+
+                session.close("closed")
+
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+
+            self.loop.run_until_complete(self.io(handlers.state_writer.close))
+
+            self.loop.run_until_complete(self.io(handlers.history.close))
+
+            self.executor.shutdown(True)
+
+            self.loop.close()
@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+
+"""history
+
+这个模块实现设备遥测数据(温度,湿度,药量,开关状态)的历史记录.
+
+`device`表每台设备只有一行,每次读取都覆盖上一次的值,历史数据只能通过反复查询数据库重建.`TelemetryHistory`在内存中为每台设备保存一个定长的环形缓冲区,每个字段使用一个`array`,定期把新的样本追加写入数据文件,同时生成1分钟,1小时,1天三种粒度的汇总.
+
+数据文件只追加不修改,由若干数据块组成,每个数据块是一次写入的全部样本,按列存放:
+
+    块头: 魔数`UTSB`, 样本数量n, 最早时间, 最晚时间 (struct格式`<4sIdd`)
+    物理地址列: n * 12字节
+    时间列: n * double
+    温度, 湿度, 药量列: 各 n * float
+    开关状态列: n * int8
+
+每列都是定长的,可以直接`mmap`读取;查询时根据块头的时间范围跳过无关的数据块,块内按照物理地址排序,同一设备的样本是连续的.缺失的字段记为`NaN`(开关状态记为`-1`).
+
+后台写入协程不在事件循环中访问文件: 取出尚未写入的样本以及更新汇总每处理`FLUSH_CHUNK`台设备(或者样本)让出一次,排序,打包以及写入文件交给`gevent`的线程池.
+
+"""
+
+import os
+import glob
+import mmap
+import time
+import struct
+import logging
+
+import gevent
+
+from array import array
+
+HEADER = struct.Struct("<4sIdd")
+"""struct.Struct: 数据块头"""
+
+MAGIC = "UTSB"
+"""str: 数据块魔数"""
+
+FIELDS = ("temperature", "humidity", "dosage")
+"""tuple: 浮点类型的遥测字段"""
+
+ROLLUPS = (60, 3600, 86400)
+"""tuple: 汇总粒度的秒数: 1分钟, 1小时, 1天"""
+
+NAN = float("nan")
+"""float: 缺失值"""
+
+FLUSH_CHUNK = 1000
+"""int: 后台写入协程每处理这么多台设备(或者样本)让出一次事件循环"""
+
+
+class Series(object):
+
+    """一台设备的环形缓冲区,`pending`是尚未写入文件的样本数量"""
+
+    __slots__ = ("times", "temperature", "humidity", "dosage", "power", "pos", "size", "pending", "last")
+
+    def __init__(self, capacity):
+
+        self.times = array('d', [0.0] * capacity)
+
+        self.temperature = array('f', [NAN] * capacity)
+
+        self.humidity = array('f', [NAN] * capacity)
+
+        self.dosage = array('f', [NAN] * capacity)
+
+        self.power = array('b', [-1] * capacity)
+
+        self.pos = 0
+
+        self.size = 0
+
+        self.pending = 0
+
+        self.last = [NAN, NAN, NAN, -1]
+
+    def append(self, now, merge):
+
+        """追加一个样本,样本的值是设备当前已知的全部字段;如果上一个样本尚未写入文件并且在`merge`秒之内,直接覆盖上一个样本
+
+        :return: 覆盖的旧样本被挤出缓冲区而没有写入文件时返回`True`
+
+        """
+
+        capacity = len(self.times)
+
+        if self.pending and now - self.times[(self.pos - 1) % capacity] < merge:
+
+            i = (self.pos - 1) % capacity
+
+            lost = False
+
+        else:
+
+            i = self.pos
+
+            self.pos = (self.pos + 1) % capacity
+
+            self.size = min(self.size + 1, capacity)
+
+            lost = self.pending == capacity
+
+            self.pending = min(self.pending + 1, capacity)
+
+        self.times[i] = now
+
+        self.temperature[i], self.humidity[i], self.dosage[i], self.power[i] = self.last
+
+        return lost
+
+    def samples(self, count=None):
+
+        """
+
+        :param count: 最近的样本数量,默认为缓冲区中的全部样本
+        :return: 由(时间, 温度, 湿度, 药量, 开关状态)组成的列表,按照时间排序
+
+        """
+
+        capacity = len(self.times)
+
+        count = self.size if count is None else min(count, self.size)
+
+        result = []
+
+        for k in xrange(count, 0, -1):
+
+            i = (self.pos - k) % capacity
+
+            result.append((self.times[i], self.temperature[i], self.humidity[i], self.dosage[i], self.power[i]))
+
+        return result
+
+
+def key(MAC):
+
+    """
+
+    :param MAC: 设备的物理地址
+    :return: 数据文件中物理地址列的12字节定长值
+
+    """
+
+    return MAC[:12].ljust(12, '\0')
+
+
+def public(sample):
+
+    """
+
+    :param sample: 内部格式的样本
+    :return: 缺失的字段替换为`None`之后的样本
+
+    """
+
+    return (sample[0],) + tuple(None if value != value else value for value in sample[1:4]) + (None if sample[4] < 0 else sample[4],)
+
+
+def write_block(stream, rows):
+
+    """把一组样本按列写入一个数据块
+
+    :param stream: 以追加方式打开的文件
+    :param rows: 由(物理地址, 时间, 温度, 湿度, 药量, 开关状态)组成的列表
+    :return: 无返回值
+
+    """
+
+    if not rows:
+
+        return
+
+    rows = sorted(rows)
+
+    times = array('d', [row[1] for row in rows])
+
+    parts = [HEADER.pack(MAGIC, len(rows), min(times), max(times)), ''.join(key(row[0]) for row in rows), times.tostring()]
+
+    for column in xrange(2, 5):
+
+        parts.append(array('f', [row[column] for row in rows]).tostring())
+
+    parts.append(array('b', [row[5] for row in rows]).tostring())
+
+    stream.write(''.join(parts))
+
+    stream.flush()
+
+
+def block_size(count):
+
+    return HEADER.size + count * (12 + 8 + 4 * len(FIELDS) + 1)
+
+
+def repair(path):
+
+    """截断文件末尾不完整的数据块(进程在写入过程中退出)
+
+    :param path: 数据文件路径
+    :return: 无返回值
+
+    """
+
+    if not os.path.exists(path):
+
+        return
+
+    size = os.path.getsize(path)
+
+    offset = 0
+
+    with open(path, "rb") as stream:
+
+        while offset + HEADER.size <= size:
+
+            stream.seek(offset)
+
+            magic, count, _, _ = HEADER.unpack(stream.read(HEADER.size))
+
+            if magic != MAGIC or offset + block_size(count) > size:
+
+                break
+
+            offset += block_size(count)
+
+    if offset != size:
+
+        logging.warning("%s 截断不完整的数据: %s 字节", path, size - offset)
+
+        with open(path, "r+b") as stream:
+
+            stream.truncate(offset)
+
+
+def read_blocks(path, MAC, start, end):
+
+    """使用`mmap`读取数据文件中一台设备在时间范围内的样本
+
+    :param path: 数据文件路径
+    :param MAC: 设备的物理地址
+    :param start: 起始时间戳(包含)
+    :param end: 结束时间戳(包含)
+    :return: 由(时间, 温度, 湿度, 药量, 开关状态)组成的列表
+
+    """
+
+    if not os.path.exists(path) or not os.path.getsize(path):
+
+        return []
+
+    result = []
+
+    with open(path, "rb") as stream:
+
+        buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+
+            offset = 0
+
+            while offset + HEADER.size <= len(buffer):
+
+                magic, count, first, last = HEADER.unpack_from(buffer, offset)
+
+                if magic != MAGIC or offset + block_size(count) > len(buffer):
+
+                    break
+
+                if first <= end and last >= start:
+
+                    result.extend(_scan(buffer, offset + HEADER.size, count, MAC, start, end))
+
+                offset += block_size(count)
+
+        finally:
+
+            buffer.close()
+
+    result.sort()
+
+    return result
+
+
+def _scan(buffer, base, count, MAC, start, end):
+
+    MAC = key(MAC)
+
+    macs = buffer[base: base + 12 * count]
+
+    i = macs.find(MAC)
+
+    while i >= 0 and i % 12:
+
+        i = macs.find(MAC, i + 1)
+
+    if i < 0:
+
+        return []
+
+    times = base + 12 * count
+
+    columns = [times + 8 * count + 4 * count * k for k in xrange(len(FIELDS))]
+
+    powers = times + (8 + 4 * len(FIELDS)) * count
+
+    result = []
+
+    for row in xrange(i // 12, count):
+
+        if macs[12 * row: 12 * row + 12] != MAC:
+
+            break
+
+        moment = struct.unpack_from("<d", buffer, times + 8 * row)[0]
+
+        if start <= moment <= end:
+
+            values = [struct.unpack_from("<f", buffer, column + 4 * row)[0] for column in columns]
+
+            result.append(tuple([moment] + values + [struct.unpack_from("<b", buffer, powers + row)[0]]))
+
+    return result
+
+
+class TelemetryHistory(object):
+
+    """设备遥测数据的历史记录
+
+    原始样本写入`raw.tsb`,各粒度的汇总写入`<秒数>.tsb`,多进程模式下文件名中加入工作进程编号(例如`raw.0.tsb`),每个文件只有一个写入者.汇总样本的时间是时间段的起点,浮点字段是时间段内的平均值(忽略缺失值),开关状态是最大值;只有已经结束的时间段才会写入文件,程序退出时尚未结束的时间段也会写入,重启之后同一时间段可能出现两条汇总
+
+    """
+
+    def __init__(self, path, capacity=64, interval=60, merge=1):
+
+        """
+
+        :param path: 数据文件所在的目录
+        :param capacity: 每台设备在内存中保留的样本数量
+        :param interval: 两次写入文件之间的秒数
+        :param merge: 同一台设备在这个秒数之内的多次更新合并为一个样本(批量监控的几个响应几乎同时到达)
+
+        """
+
+        self.path = path
+
+        self.capacity = capacity
+
+        self.interval = interval
+
+        self.merge = merge
+
+        self.worker = None
+
+        self._series = {}
+
+        self._rollups = dict((resolution, {}) for resolution in ROLLUPS)
+
+        self._greenlet = None
+
+        self._writing = None
+
+        self._samples = 0
+
+        self._written = 0
+
+        self._lost = 0
+
+        self._last_flush = 0.0
+
+    def _file(self, resolution):
+
+        if self.worker is None:
+
+            return os.path.join(self.path, "%s.tsb" % (resolution or "raw"))
+
+        return os.path.join(self.path, "%s.%s.tsb" % (resolution or "raw", self.worker))
+
+    def _files(self, resolution):
+
+        """
+
+        :param resolution: 粒度秒数,`0`表示原始样本
+        :return: 这个粒度的所有数据文件,包括多进程模式下其它工作进程写入的文件(设备重新接入之后可能由另一个工作进程持有)
+
+        """
+
+        name = resolution or "raw"
+
+        return glob.glob(os.path.join(self.path, "%s.tsb" % name)) + glob.glob(os.path.join(self.path, "%s.*.tsb" % name))
+
+    def record(self, MAC, **fields):
+
+        """记录设备状态的变化,不属于遥测数据的字段直接忽略
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param fields: 字段名以及对应的新值
+        :return: 无返回值
+
+        """
+
+        series = self._series.get(MAC)
+
+        if series is None:
+
+            series = self._series[MAC] = Series(self.capacity)
+
+        changed = False
+
+        for k, field in enumerate(FIELDS):
+
+            if field in fields:
+
+                series.last[k] = float(fields[field])
+
+                changed = True
+
+        if "power" in fields:
+
+            series.last[3] = int(fields["power"])
+
+            changed = True
+
+        if not changed:
+
+            return
+
+        self._samples += 1
+
+        if series.append(time.time(), self.merge):
+
+            self._lost += 1
+
+    def discard(self, MAC):
+
+        """忘记设备在内存中的样本,删除设备时调用,已经写入文件的样本不受影响
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: 无返回值
+
+        """
+
+        self._series.pop(MAC, None)
+
+        for buckets in self._rollups.itervalues():
+
+            buckets.pop(MAC, None)
+
+    def flush(self, final=False):
+
+        """把所有尚未写入的样本追加到原始数据文件,并更新汇总,在调用者所在的协程(或者线程)中直接写入文件
+
+        :param final: 为`True`时尚未结束的汇总时间段也写入文件,程序退出时使用
+        :return: 无返回值
+
+        """
+
+        self._append(self._collect(final))
+
+    def _collect(self, final, pause=None):
+
+        """取出所有尚未写入的样本并更新汇总
+
+        :param final: 为`True`时尚未结束的汇总时间段也取出
+        :param pause: 每处理`FLUSH_CHUNK`台设备(或者样本)调用一次,用于让出事件循环
+        :return: 由(汇总粒度, 样本列表)组成的列表,原始样本的粒度为`0`
+
+        """
+
+        rows = []
+
+        for count, (MAC, series) in enumerate(self._series.items()):
+
+            if series.pending:
+
+                for sample in series.samples(series.pending):
+
+                    rows.append((MAC,) + sample)
+
+                series.pending = 0
+
+            if pause is not None and count % FLUSH_CHUNK == FLUSH_CHUNK - 1:
+
+                pause()
+
+        now = time.time()
+
+        return [(0, rows)] + [(resolution, self._rollup(resolution, rows, now, final, pause)) for resolution in ROLLUPS]
+
+    def _append(self, blocks):
+
+        """把`_collect`取出的样本追加到各个数据文件,可以在线程池中运行"""
+
+        if not os.path.isdir(self.path):
+
+            os.makedirs(self.path)
+
+        for resolution, rows in blocks:
+
+            with open(self._file(resolution), "ab") as stream:
+
+                write_block(stream, rows)
+
+        self._written += len(blocks[0][1])
+
+        self._last_flush = time.time()
+
+    def _rollup(self, resolution, rows, now, final, pause=None):
+
+        """把样本加入汇总,返回已经结束的时间段的汇总样本
+
+        每台设备每个粒度只保存一个正在进行的时间段: [起点, 三个字段的和, 三个字段的数量, 开关状态最大值]
+
+        """
+
+        buckets = self._rollups[resolution]
+
+        closed = []
+
+        for count, row in enumerate(rows):
+
+            if pause is not None and count % FLUSH_CHUNK == FLUSH_CHUNK - 1:
+
+                pause()
+
+            bucket = row[1] - row[1] % resolution
+
+            current = buckets.get(row[0])
+
+            if current is not None and current[0] != bucket:
+
+                closed.append(self._close(row[0], current))
+
+                current = None
+
+            if current is None:
+
+                current = buckets[row[0]] = [bucket, [0.0] * len(FIELDS), [0] * len(FIELDS), -1]
+
+            for k in xrange(len(FIELDS)):
+
+                value = row[2 + k]
+
+                if value == value:
+
+                    current[1][k] += value
+
+                    current[2][k] += 1
+
+            current[3] = max(current[3], row[5])
+
+        for MAC in [MAC for MAC, current in buckets.iteritems() if final or current[0] + resolution <= now]:
+
+            closed.append(self._close(MAC, buckets.pop(MAC)))
+
+        return closed
+
+    def _close(self, MAC, current):
+
+        bucket, sums, counts, power = current
+
+        return (MAC, bucket) + tuple(sums[k] / counts[k] if counts[k] else NAN for k in xrange(len(FIELDS))) + (power,)
+
+    def query(self, MAC, start=0, end=None, resolution=0):
+
+        """查询一台设备在时间范围内的历史数据,不访问数据库
+
+        原始数据包括已经写入文件的样本以及内存中尚未写入的样本;汇总数据只包括已经结束的时间段
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param start: 起始时间戳(包含)
+        :param end: 结束时间戳(包含),默认为当前时间
+        :param resolution: 粒度秒数,`0`表示原始样本,其它取值参见`ROLLUPS`
+        :return: 由(时间, 温度, 湿度, 药量, 开关状态)组成的列表,按照时间排序,缺失的字段为`None`
+
+        """
+
+        if resolution and resolution not in ROLLUPS:
+
+            raise ValueError("不支持的粒度: %s" % resolution)
+
+        end = time.time() if end is None else end
+
+        samples = []
+
+        for path in self._files(resolution):
+
+            samples.extend(read_blocks(path, MAC, start, end))
+
+        series = self._series.get(MAC)
+
+        if not resolution and series is not None and series.pending:
+
+            samples.extend(sample for sample in series.samples(series.pending) if start <= sample[0] <= end)
+
+        samples.sort()
+
+        return [public(sample) for sample in samples]
+
+    def recent(self, MAC, count=None):
+
+        """
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param count: 最近的样本数量,默认为内存中的全部样本
+        :return: 内存中最近的样本,格式同`query`
+
+        """
+
+        series = self._series.get(MAC)
+
+        if series is None:
+
+            return []
+
+        return [public(sample) for sample in series.samples(count)]
+
+    def _run(self):
+
+        while 1:
+
+            gevent.sleep(self.interval)
+
+            try:
+
+                self._writing = gevent.get_hub().threadpool.spawn(self._append, self._collect(False, lambda: gevent.sleep(0)))
+
+                self._writing.get()
+
+            except Exception:
+
+                # 任何一次失败都不能结束这个协程,否则之后的样本只留在内存中,再也不会写入文件
+
+                logging.exception("历史数据写入失败")
+
+    def check(self):
+
+        """检查数据文件,截掉程序异常退出时没有写完的块"""
+
+        for resolution in (0,) + ROLLUPS:
+
+            repair(self._file(resolution))
+
+    def start(self):
+
+        """检查数据文件并启动后台写入协程"""
+
+        self.check()
+
+        if self._greenlet is None:
+
+            self._greenlet = gevent.spawn(self._run)
+
+    def close(self):
+
+        """停止后台写入协程,等待线程池中正在进行的写入结束,然后写入所有尚未写入的样本以及尚未结束的汇总,程序退出时调用"""
+
+        if self._greenlet is not None:
+
+            self._greenlet.kill()
+
+            self._greenlet = None
+
+        if self._writing is not None:
+
+            self._writing.wait()
+
+            self._writing = None
+
+        self.flush(True)
+
+    def stats(self):
+
+        """
+
+        :return: 包含设备数量,累计样本数量,写入文件的样本数量,未写入就被覆盖的样本数量的字典
+
+        """
+
+        return {
+            "devices": len(self._series),
+            "samples": self._samples,
+            "written": self._written,
+            "lost": self._lost,
+            "last_flush": self._last_flush,
+        }
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""index
+
+这个模块实现`monitor`使用的设备表内存索引.
+
+原来`monitor`每个周期都新建数据库链接,全表查询在线设备,把结果全部读入内存之后再关闭链接.索引只在启动时(以及按需)全量加载一次,之后每个周期只查询`utime`不早于上次同步的行.
+
+为了节省内存,每个字段使用一个`array`保存,物理地址到数组下标的映射使用一个字典,删除设备时把最后一个设备移动到空出的位置.
+
+"""
+
+import time
+
+from array import array
+from datetime import datetime
+
+
+class DeviceIndex(object):
+
+    """设备表的增量内存索引"""
+
+    __slots__ = ("pool", "macs", "modes", "starts", "lasts", "online", "synced_at", "_positions", "_mark", "_rebuilds", "_rows")
+
+    COLUMNS = "mac, mode, start, last, online, utime"
+
+    def __init__(self, pool):
+
+        """
+
+        :param pool: 数据库链接池
+
+        """
+
+        self.pool = pool
+
+        self.synced_at = 0.0
+
+        self._rebuilds = 0
+
+        self._rows = 0
+
+        self._reset()
+
+    def _reset(self):
+
+        self.macs = []
+
+        self.modes = array('b')
+
+        self.starts = array('d')
+
+        self.lasts = array('i')
+
+        self.online = array('b')
+
+        self._positions = {}
+
+        self._mark = None
+
+    def rebuild(self):
+
+        """全量加载设备表
+
+        :return: 所有设备的物理地址列表
+
+        """
+
+        rows = self.pool.execute("SELECT %s FROM device" % self.COLUMNS, idempotent=True)
+
+        self._reset()
+
+        self._apply(rows)
+
+        self._rebuilds += 1
+
+        return list(self.macs)
+
+    def sync(self):
+
+        """增量同步,只查询`utime`不早于上次同步时最大`utime`的行(同一秒内的更新会被重复读取,但不会遗漏)
+
+        被删除的设备不会出现在增量结果中,需要定期或者按需调用`rebuild`
+
+        :return: 发生变化的设备的物理地址列表
+
+        """
+
+        if self._mark is None:
+
+            return self.rebuild()
+
+        rows = self.pool.execute("SELECT %s FROM device WHERE utime >= %%s" % self.COLUMNS, self._mark, idempotent=True)
+
+        self._apply(rows)
+
+        return [row[0] for row in rows]
+
+    def _apply(self, rows):
+
+        for MAC, mode, start, last, online, utime in rows:
+
+            i = self._positions.get(MAC)
+
+            if i is None:
+
+                i = self._positions[MAC] = len(self.macs)
+
+                self.macs.append(MAC)
+
+                self.modes.append(0)
+
+                self.starts.append(0.0)
+
+                self.lasts.append(0)
+
+                self.online.append(0)
+
+            self.modes[i] = mode or 0
+
+            self.starts[i] = time.mktime(start.timetuple()) + start.microsecond / 1e6 if start else 0.0
+
+            self.lasts[i] = last or 0
+
+            self.online[i] = 1 if online else 0
+
+            if utime is not None and (self._mark is None or utime > self._mark):
+
+                self._mark = utime
+
+        self._rows += len(rows)
+
+        self.synced_at = time.time()
+
+    def remove(self, MAC):
+
+        """从索引中删除设备
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: 无返回值
+
+        """
+
+        i = self._positions.pop(MAC, None)
+
+        if i is None:
+
+            return
+
+        j = len(self.macs) - 1
+
+        if i != j:
+
+            self.macs[i] = self.macs[j]
+
+            self.modes[i] = self.modes[j]
+
+            self.starts[i] = self.starts[j]
+
+            self.lasts[i] = self.lasts[j]
+
+            self.online[i] = self.online[j]
+
+            self._positions[self.macs[i]] = i
+
+        self.macs.pop()
+
+        self.modes.pop()
+
+        self.starts.pop()
+
+        self.lasts.pop()
+
+        self.online.pop()
+
+    def get(self, MAC):
+
+        """
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: (模式, 定时开始时间, 加热时长, 是否在线),定时开始时间为空时返回`None`;设备不存在返回`None`
+
+        """
+
+        i = self._positions.get(MAC)
+
+        if i is None:
+
+            return None
+
+        start = datetime.fromtimestamp(self.starts[i]) if self.starts[i] else None
+
+        return self.modes[i], start, self.lasts[i], self.online[i]
+
+    def online_devices(self):
+
+        """
+
+        :return: 所有在线设备的物理地址列表
+
+        """
+
+        online = self.online
+
+        return [MAC for i, MAC in enumerate(self.macs) if online[i]]
+
+    def __len__(self):
+
+        return len(self.macs)
+
+    def __contains__(self, MAC):
+
+        return MAC in self._positions
+
+    def stats(self):
+
+        """
+
+        :return: 包含设备数量,在线设备数量,距离上次同步的秒数(同步延迟),全量加载次数以及累计读取行数的字典
+
+        """
+
+        return {
+            "devices": len(self.macs),
+            "online": sum(self.online),
+            "lag": time.time() - self.synced_at if self.synced_at else None,
+            "rebuilds": self._rebuilds,
+            "rows": self._rows,
+        }
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+"""logs
+
+这个模块实现不阻塞事件循环的日志输出.
+
+原来每条日志在调用处用`%`立刻格式化,然后在事件循环中同步写入标准输出,负载较高时日志是最大的CPU以及延迟开销之一.现在调用处使用`logging.info("%s 发送 %s", MAC, Hex(data))`的形式传递参数,级别不够的日志不会格式化;级别足够的日志由`BackgroundHandler`放入一个线程安全的`deque`,格式化以及写入都由一个独立的系统线程(不受`monkey.patch_all`影响)完成.参数在写入线程中才格式化,所以不要传入之后会被修改的对象.
+
+`RateLimiter`按照(消息模板, 第一个参数)限制日志数量.热点路径的日志第一个参数总是设备的物理地址,所以一台频繁断线重连的设备只会抑制它自己的日志: 每个时间窗口内同一个键的前`burst`条日志全部输出,之后每`sample`条输出一条,其余计入抑制数量,写入线程每个时间窗口输出一次"N 条日志被抑制"的汇总.
+
+队列满时丢弃新的日志并计数,不会阻塞事件循环.输出可以是原来的文本格式,也可以是每行一个JSON对象(参见`JSONFormatter`).
+
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+
+from binascii import hexlify
+from collections import deque
+
+from gevent import monkey
+
+try:
+
+    start_new_thread, allocate_lock = monkey.get_original("thread", ["start_new_thread", "allocate_lock"])
+
+except ImportError:
+
+    start_new_thread, allocate_lock = monkey.get_original("_thread", ["start_new_thread", "allocate_lock"])
+
+native_sleep = monkey.get_original("time", "sleep")
+
+TEXT_FORMAT = "%(asctime)s - %(funcName)s - %(levelname)s - %(message)s"
+"""str: 文本格式"""
+
+
+class Hex(object):
+
+    """推迟到格式化时才转换为十六进制的二进制数据"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+
+        self.data = data
+
+    def __str__(self):
+
+        return hexlify(self.data)
+
+
+class RateLimiter(object):
+
+    """按照(消息模板, 第一个参数)限制每个时间窗口内的日志数量"""
+
+    def __init__(self, interval=10, burst=20, sample=100):
+
+        """
+
+        :param interval: 时间窗口的秒数
+        :param burst: 每个时间窗口内同一个键全部输出的日志数量
+        :param sample: 超过`burst`之后每多少条输出一条,`0`表示全部抑制
+
+        """
+
+        self.interval = interval
+
+        self.burst = burst
+
+        self.sample = sample
+
+        self.suppressed = {}
+
+        self._window = None
+
+        self._counts = {}
+
+        self._total = 0
+
+    @staticmethod
+    def key(record):
+
+        """
+
+        :param record: 日志记录
+        :return: (消息模板, 第一个参数),第一个参数不是字符串时为`None`
+
+        """
+
+        args = record.args
+
+        return record.msg, args[0] if isinstance(args, tuple) and args and isinstance(args[0], basestring) else None
+
+    def allow(self, record):
+
+        """
+
+        :param record: 日志记录
+        :return: 这条日志是否应该输出
+
+        """
+
+        window = int(record.created // self.interval)
+
+        if window != self._window:
+
+            self._window = window
+
+            self._counts = {}
+
+        key = self.key(record)
+
+        count = self._counts.get(key, 0) + 1
+
+        self._counts[key] = count
+
+        if count <= self.burst or self.sample and count % self.sample == 0:
+
+            return True
+
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+
+        self._total += 1
+
+        return False
+
+    def drain(self):
+
+        """取出并清空抑制数量,由写入线程调用,与`allow`之间不加锁,个别计数可能丢失
+
+        :return: 键到抑制数量的字典
+
+        """
+
+        suppressed, self.suppressed = self.suppressed, {}
+
+        return suppressed
+
+    def stats(self):
+
+        """
+
+        :return: 累计抑制的日志数量
+
+        """
+
+        return self._total
+
+
+class JSONFormatter(logging.Formatter):
+
+    """每行一个JSON对象: 时间戳,级别,函数名称,消息,以及异常信息或者抑制数量"""
+
+    def format(self, record):
+
+        entry = {"time": round(record.created, 3), "level": record.levelname, "function": record.funcName, "message": record.getMessage()}
+
+        if record.exc_info:
+
+            entry["exception"] = self.formatException(record.exc_info)
+
+        if hasattr(record, "suppressed"):
+
+            entry["suppressed"] = record.suppressed
+
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class BackgroundHandler(logging.Handler):
+
+    """把日志记录放入队列,由独立的系统线程格式化并且写入"""
+
+    def __init__(self, stream=None, capacity=10000, limiter=None, interval=0.2):
+
+        """
+
+        :param stream: 输出的文件对象,默认为标准输出
+        :param capacity: 队列容量,队列满时丢弃新的日志
+        :param limiter: `RateLimiter`,`None`表示不限制
+        :param interval: 写入线程检查队列的间隔秒数
+
+        """
+
+        logging.Handler.__init__(self)
+
+        self.stream = stream or sys.stdout
+
+        self.capacity = capacity
+
+        self.limiter = limiter
+
+        self.interval = interval
+
+        self.records = deque()
+
+        self._pid = None
+
+        self._stopped = False
+
+        self._writing = allocate_lock()
+
+        self._written = 0
+
+        self._dropped = 0
+
+    def _start(self):
+
+        # fork出来的工作进程没有父进程的写入线程,而且父进程队列中的记录由父进程输出
+
+        self._pid = os.getpid()
+
+        self.records.clear()
+
+        start_new_thread(self._run, (self._pid,))
+
+    def emit(self, record):
+
+        if self._pid != os.getpid():
+
+            self._start()
+
+        if self.limiter is not None and not self.limiter.allow(record):
+
+            return
+
+        if len(self.records) >= self.capacity:
+
+            self._dropped += 1
+
+            return
+
+        self.records.append(record)
+
+    def _summaries(self):
+
+        for (msg, argument), count in sorted(self.limiter.drain().items()):
+
+            record = logging.LogRecord("logs", logging.WARNING, __file__, 0, "%s 条日志被抑制: %s %s", (count, argument or '', msg), None)
+
+            record.funcName = "summary"
+
+            record.suppressed = count
+
+            yield record
+
+    def write(self, summarize=False):
+
+        """格式化并且写入队列中的全部记录
+
+        :param summarize: 是否同时写入抑制数量的汇总
+        :return: 写入的记录数量
+
+        """
+
+        lines = []
+
+        with self._writing:
+
+            records = self.records
+
+            while records:
+
+                lines.append(self._format(records.popleft()))
+
+            if summarize and self.limiter is not None:
+
+                lines.extend(self._format(record) for record in self._summaries())
+
+            if lines:
+
+                self.stream.write('\n'.join(lines) + '\n')
+
+                self.stream.flush()
+
+            self._written += len(lines)
+
+        return len(lines)
+
+    def _format(self, record):
+
+        try:
+
+            line = self.format(record)
+
+        except Exception:
+
+            line = "日志格式化失败: %r %r" % (record.msg, record.args)
+
+        if not isinstance(line, str):
+
+            line = line.encode("utf-8")
+
+        return line
+
+    def _run(self, pid):
+
+        summarized = time.time()
+
+        while not self._stopped and self._pid == pid:
+
+            now = time.time()
+
+            summarize = self.limiter is not None and now - summarized >= self.limiter.interval
+
+            if summarize:
+
+                summarized = now
+
+            try:
+
+                self.write(summarize)
+
+            except Exception:
+
+                self._dropped += len(self.records)
+
+                self.records.clear()
+
+            native_sleep(self.interval)
+
+    def close(self):
+
+        """停止写入线程,写入剩余的记录"""
+
+        self._stopped = True
+
+        if self._pid == os.getpid():
+
+            self.write(True)
+
+        logging.Handler.close(self)
+
+    def stats(self):
+
+        """
+
+        :return: 包含队列中,已经写入,因为队列满丢弃,以及被抑制的日志数量的字典
+
+        """
+
+        return {
+            "queued": len(self.records),
+            "written": self._written,
+            "dropped": self._dropped,
+            "suppressed": self.limiter.stats() if self.limiter is not None else 0,
+        }
+
+
+def setup(structured=False, capacity=10000, interval=10, burst=20, sample=100, level=logging.INFO, stream=None):
+
+    """把后台日志输出安装到根日志记录器
+
+    :param structured: 是否输出JSON行,否则使用`TEXT_FORMAT`
+    :param capacity: 队列容量
+    :param interval: 限流的时间窗口秒数
+    :param burst: 每个时间窗口内同一个键全部输出的日志数量,`0`表示不限流
+    :param sample: 超过`burst`之后每多少条输出一条,`0`表示全部抑制
+    :param level: 日志级别
+    :param stream: 输出的文件对象,默认为标准输出
+    :return: 安装的`BackgroundHandler`
+
+    """
+
+    handler = BackgroundHandler(stream, capacity, RateLimiter(interval, burst, sample) if burst else None)
+
+    handler.setFormatter(JSONFormatter() if structured else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+
+    root.addHandler(handler)
+
+    root.setLevel(level)
+
+    return handler
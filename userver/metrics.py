@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+"""metrics
+
+这个模块实现`tcp_server`和`monitor`共用的运行指标,通过本地HTTP端口以Prometheus文本格式导出.
+
+指标分为计数器,仪表和直方图三种.每组标签值对应一个预先分配的值对象,热点路径上只是对已有对象的属性做加法,直方图的桶是一个定长列表,不会在每次调用时分配新的对象.仪表也可以指定一个函数,在导出时才计算当前值(例如在线会话数量).
+
+    # 模块级别定义指标,常用的标签值预先取出
+    DISCONNECTS = Counter("userver_disconnects_total", "断开链接的数量", ("reason",))
+
+    DISCONNECTS.labels("timeout").inc()
+
+"""
+
+import logging
+
+from bisect import bisect_left
+
+from gevent.pywsgi import WSGIServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""tuple: 直方图默认的桶上界(秒)"""
+
+
+class CounterValue(object):
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+
+        self.value = 0
+
+    def inc(self, amount=1):
+
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+
+    __slots__ = ()
+
+    def set(self, value):
+
+        self.value = value
+
+    def dec(self, amount=1):
+
+        self.value -= amount
+
+
+class HistogramValue(object):
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+
+        self.bounds = bounds
+
+        self.counts = [0] * (len(bounds) + 1)
+
+        self.sum = 0.0
+
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+        self.sum += value
+
+        self.count += 1
+
+
+class Registry(object):
+
+    """一个进程内所有指标的集合"""
+
+    def __init__(self):
+
+        self._metrics = []
+
+    def register(self, metric):
+
+        self._metrics.append(metric)
+
+    def render(self):
+
+        """
+
+        :return: Prometheus文本格式的全部指标
+
+        """
+
+        lines = []
+
+        for metric in self._metrics:
+
+            try:
+
+                metric.render(lines)
+
+            except Exception:
+
+                logging.exception("指标导出失败: %s", metric.name)
+
+        lines.append('')
+
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+"""Registry: 默认的指标集合"""
+
+
+def escape(value):
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=None):
+
+    pairs = ['%s="%s"' % (name, escape(value)) for name, value in zip(names, values)]
+
+    if extra is not None:
+
+        pairs.append('%s="%s"' % extra)
+
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metric(object):
+
+    """指标的基类,`labels`返回(必要时创建)一组标签值对应的值对象,没有标签的指标直接调用值对象的方法"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+
+        """
+
+        :param name: 指标名称
+        :param help: 指标说明
+        :param labels: 标签名称
+        :param registry: 指标所属的集合
+
+        """
+
+        self.name = name
+
+        self.help = help
+
+        self.labelnames = tuple(labels)
+
+        self._children = {}
+
+        if not self.labelnames:
+
+            self._default = self.labels()
+
+        registry.register(self)
+
+    def _new(self):
+
+        raise NotImplementedError
+
+    def labels(self, *values):
+
+        """
+
+        :param values: 与标签名称一一对应的标签值
+        :return: 这组标签值对应的值对象
+
+        """
+
+        child = self._children.get(values)
+
+        if child is None:
+
+            if len(values) != len(self.labelnames):
+
+                raise ValueError("%s 标签数量错误: %s" % (self.name, values))
+
+            child = self._children[values] = self._new()
+
+        return child
+
+    def samples(self):
+
+        return sorted(self._children.iteritems())
+
+    def render(self, lines):
+
+        lines.append("# HELP %s %s" % (self.name, self.help))
+
+        lines.append("# TYPE %s %s" % (self.name, self.kind))
+
+        for values, child in self.samples():
+
+            lines.append("%s%s %s" % (self.name, format_labels(self.labelnames, values), repr(float(child.value))))
+
+
+class Counter(Metric):
+
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def _new(self):
+
+        return CounterValue()
+
+    def inc(self, amount=1):
+
+        self._default.value += amount
+
+
+class Gauge(Metric):
+
+    """可增可减的仪表,指定`function`时在导出时调用这个函数获得当前值"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None, registry=REGISTRY):
+
+        """
+
+        :param function: 导出时调用的函数,没有标签时返回一个数值,否则返回标签值元组到数值的字典
+
+        """
+
+        self.function = function
+
+        Metric.__init__(self, name, help, labels, registry)
+
+    def _new(self):
+
+        return GaugeValue()
+
+    def set(self, value):
+
+        self._default.value = value
+
+    def inc(self, amount=1):
+
+        self._default.value += amount
+
+    def dec(self, amount=1):
+
+        self._default.value -= amount
+
+    def samples(self):
+
+        if self.function is None:
+
+            return Metric.samples(self)
+
+        value = self.function()
+
+        if not self.labelnames:
+
+            value = {(): value}
+
+        samples = []
+
+        for values, number in sorted(value.iteritems()):
+
+            child = GaugeValue()
+
+            child.value = number
+
+            samples.append((values, child))
+
+        return samples
+
+
+class Histogram(Metric):
+
+    """直方图,导出时把各桶的数量累加为Prometheus要求的累计值"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+
+        """
+
+        :param buckets: 递增的桶上界
+
+        """
+
+        self.buckets = tuple(buckets)
+
+        Metric.__init__(self, name, help, labels, registry)
+
+    def _new(self):
+
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+
+        self._default.observe(value)
+
+    def render(self, lines):
+
+        lines.append("# HELP %s %s" % (self.name, self.help))
+
+        lines.append("# TYPE %s %s" % (self.name, self.kind))
+
+        for values, child in self.samples():
+
+            total = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+
+                total += count
+
+                lines.append("%s_bucket%s %s" % (self.name, format_labels(self.labelnames, values, ("le", "+Inf" if bound == float("inf") else repr(float(bound)))), total))
+
+            lines.append("%s_sum%s %s" % (self.name, format_labels(self.labelnames, values), repr(child.sum)))
+
+            lines.append("%s_count%s %s" % (self.name, format_labels(self.labelnames, values), child.count))
+
+
+REDIS_SECONDS = Histogram("userver_redis_seconds", "redis请求耗时(不包括阻塞等待命令的BRPOP)", ("operation",))
+"""Histogram: `redis`请求耗时,按照操作分类"""
+
+MYSQL_SECONDS = Histogram("userver_mysql_seconds", "通过链接池执行一条语句的耗时(包括等待借出链接)")
+"""Histogram: 数据库语句耗时"""
+
+
+ROUTES = {}
+"""dict: 指标端口上的其它路径到处理函数的映射,处理函数没有参数,返回(内容类型, 内容)"""
+
+
+def route(path, handler):
+
+    """在指标端口上增加一个路径,例如协程状态查看(参见`watchdog`)
+
+    :param path: 路径
+    :param handler: 处理函数,没有参数,返回(内容类型, 内容)
+    :return: 无返回值
+
+    """
+
+    ROUTES[path] = handler
+
+
+def application(environ, start_response):
+
+    """导出指标的WSGI应用,`/metrics`返回全部指标,其它路径由`ROUTES`中的处理函数响应"""
+
+    path = environ.get("PATH_INFO")
+
+    if path in ("/", "/metrics"):
+
+        content_type, body = "text/plain; version=0.0.4", REGISTRY.render()
+
+    elif path in ROUTES:
+
+        try:
+
+            content_type, body = ROUTES[path]()
+
+        except Exception:
+
+            logging.exception("%s 处理失败", path)
+
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+
+            return ["error\n"]
+
+    else:
+
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+
+        return ["not found\n"]
+
+    start_response("200 OK", [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+
+    return [body]
+
+
+def serve(port, host="127.0.0.1"):
+
+    """在后台启动导出指标的HTTP服务器
+
+    :param port: 监听端口
+    :param host: 监听地址,默认只允许本机访问
+    :return: 已经启动的`WSGIServer`
+
+    """
+
+    server = WSGIServer((host, port), application, log=None)
+
+    server.start()
+
+    logging.info("指标导出端口: %s:%s", host, port)
+
+    return server
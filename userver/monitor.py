@@ -4,12 +4,22 @@ from __future__ import division  # must occur at the beginning of the file
 
 import sys
 import time
+import zlib
+import signal
+
+import gevent
+
+from gevent.event import Event
 
 from datetime import datetime
 
 sys.path.append("../")
 
 from userver import *
+from userver.index import DeviceIndex
+from userver.scheduler import TimerScheduler
+from userver.directory import SessionDirectory
+from userver.metrics import Gauge, Histogram, REDIS_SECONDS, serve as serve_metrics
 
 
 def total_seconds(td):
@@ -24,17 +34,126 @@ def total_seconds(td):
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
 
 
-def generate_command(device, type, time=0):
+stats = {"devices": 0, "commands": 0, "timers": 0, "busy": 0.0, "lag": 0.0, "duration": 0.0, "sync_lag": None}
+"""dict: 最近一个监控周期的统计: 设备数量,监控命令数量,定时任务数量,生成命令耗时,最大调度延迟,周期总耗时,周期结束时距离设备索引上次同步的秒数"""
+
+index = DeviceIndex(mysql_pool)
+"""DeviceIndex: 设备表内存索引"""
+
+rebuild = Event()
+"""Event: 设置之后,下一个监控周期全量加载设备索引,收到`SIGHUP`信号时设置"""
+
+scheduler = TimerScheduler()
+"""TimerScheduler: 定时模式调度器"""
+
+directory = SessionDirectory(redis_client, None, NODE_NAME, SESSION_LEASE)
+"""SessionDirectory: 集群会话目录,只用来查询设备的所有者,把命令直接放入所有者的收件箱"""
+
+CYCLE_SECONDS = Histogram("userver_monitor_cycle_seconds", "监控周期的总耗时", buckets=(1, 5, 10, 30, 60, 90, 120, 300))
+"""Histogram: 监控周期耗时"""
+
+CYCLE_STATS = Gauge("userver_monitor_cycle", "最近一个监控周期的统计(参见monitor.stats)", ("stat",), function=lambda: dict(((name,), value) for name, value in stats.iteritems() if value is not None))
+"""Gauge: 最近一个监控周期的统计"""
+
+
+def update_timer(MAC):
+
+    """根据设备索引更新一个设备的定时任务,只有在线的定时模式设备才有定时任务
+
+    :param MAC: 设备的物理地址
+    :return: 无返回值
+
+    """
+
+    device = index.get(MAC)
+
+    if device is not None and device[3] and device[0] == 1 and device[1] is not None:
+
+        scheduler.set(MAC, device[1], device[2])
+
+    else:
+
+        scheduler.remove(MAC)
+
+
+def timers():
+
+    """
+
+    :return: 设备索引中所有在线的定时模式设备的物理地址到(定时开始时间, 加热时长)的字典
+
+    """
+
+    result = {}
+
+    for MAC in index.online_devices():
+
+        mode, start, last, _ = index.get(MAC)
+
+        if mode == 1 and start is not None:
+
+            result[MAC] = (start, last)
+
+    return result
+
+
+def offset(device):
+
+    """计算设备在监控周期内的固定偏移秒数,使用物理地址的`crc32`,不同进程以及每次重启结果都相同
+
+    :param device: 设备的物理地址
+    :return: 0到`MONITOR_INTERVAL`之间的整数
+
+    """
+
+    return (zlib.crc32(device) & 0xffffffff) % MONITOR_INTERVAL
+
+
+def owner(device):
+
+    """
+
+    :param device: 设备的物理地址
+    :return: 持有这台设备的进程,没有使用集群会话目录或者设备不在线时返回`None`
+
+    """
+
+    return directory.owners([device])[0] if CLUSTER_DIRECTORY else None
+
+
+def plan(devices):
+
+    """把在线设备的批量监控命令按照固定偏移分配到监控周期的每一秒
+
+    :param devices: 在线设备的物理地址列表
+    :return: 长度为`MONITOR_INTERVAL`的列表,每个元素是这一秒需要生成的命令(`generate_command`的参数)列表
+
+    """
+
+    slots = [[] for _ in xrange(MONITOR_INTERVAL)]
+
+    for MAC in devices:
+
+        slots[offset(MAC)].append((MAC, 5))
+
+    return slots
+
+
+def generate_command(device, type, time=0, pipe=None, owner=None):
 
     """生成监控设备状态的命令以及定时模式下打开加热器的命令
 
     命令格式:
 
-    {"mac": {"id": "mac"+current_time, "type": type, ["time": time]}}
+    {"mac": {"id": "mac"+current_time, "type": type, ["time": time], ["probes": probes]}}
+
+    批量监控命令(`type`为`5`)带有`probes`,即`PROBE_TYPES`中的所有监控命令类型,由`tcp_server`一次性发送
 
     :param device: 设备的物理地址
     :param type: 命令的类型
     :param time: 这个参数只有打开加热器的命令需要, 指定打开加热器的时间
+    :param pipe: `redis`管道,如果指定,命令写入管道,由调用者统一执行
+    :param owner: 持有这台设备的进程,如果指定,命令放入这个进程的收件箱,否则放入以物理地址命名的列表(参见`directory.SessionDirectory.route`)
     :return: 无返回值
 
     """
@@ -43,24 +162,60 @@ def generate_command(device, type, time=0):
 
         command = {"id": '+'.join([device, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")]), "type": type, "time": time}
 
+    elif type == 5:
+
+        command = {"id": '+'.join([device, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")]), "type": type, "probes": PROBE_TYPES}
+
     else:
 
         command = {"id": '+'.join([device, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")]), "type": type}
 
-    logging.info("产生命令: %s" % str(command))
+    logging.debug("产生命令: %s", str(command))
+
+    directory.route(device, command, owner, pipe)
+
+
+def enqueue(commands):
+
+    """使用`redis`管道批量生成命令,每个管道最多包含`MONITOR_BATCH_SIZE`条命令,使用集群会话目录时先批量查询这些设备的所有者
+
+    :param commands: 由`generate_command`的参数(设备的物理地址, 命令的类型[, 加热时间])组成的列表
+    :return: 无返回值
+
+    """
 
-    redis_client.lpush(device, command)
+    for i in xrange(0, len(commands), MONITOR_BATCH_SIZE):
+
+        batch = commands[i: i + MONITOR_BATCH_SIZE]
+
+        owners = directory.owners([command[0] for command in batch]) if CLUSTER_DIRECTORY else [None] * len(batch)
+
+        pipe = redis_client.pipeline(transaction=False)
+
+        for command, holder in zip(batch, owners):
+
+            generate_command(*command, pipe=pipe, owner=holder)
+
+        begin = time.time()
+
+        pipe.execute()
+
+        REDIS_SECONDS.labels("pipeline").observe(time.time() - begin)
 
 
 def monitor():
 
     """
 
-    首先查询数据库,获得所有在线设备的物理地址,对每个在线的设备生成监控状态命令
+    首先同步设备索引(参见`index.DeviceIndex`),启动时,收到`SIGHUP`信号之后以及每隔`DEVICE_REBUILD_INTERVAL`秒全量加载,其它时候只读取发生变化的行,然后对每个在线的设备生成一条批量监控状态命令
+
+    发生变化的定时模式设备的定时时间交给调度器(参见`scheduler.TimerScheduler`),调度器在定时时间到达之后一秒之内生成打开加热器的命令
 
-    然后确定每个在线设备的当前模式,如果是定时模式,那么检测当前时间是否达到定时时间,如果到了,生成打开加热器的命令
+    `POLL_IN_SERVER`为`True`时,监控由`tcp_server`进程内的轮询器负责,这里只同步设备索引以及定时任务
 
-    这个程序每一分钟执行一次
+    监控命令不在周期开始时一次性生成,而是按照每个设备的固定偏移(参见`offset`)分散在整个周期内,同一秒的命令通过`redis`管道批量写入,这样设备会话以及数据库的负载在整个周期内是平稳的
+
+    这个程序每`MONITOR_INTERVAL`秒执行一次,每个周期结束时记录耗时,如果周期超时,输出警告
 
     :return: 无返回值
 
@@ -68,65 +223,93 @@ def monitor():
 
     logging.info("后台启动")
 
+    if MONITOR_METRICS_PORT:
+
+        serve_metrics(MONITOR_METRICS_PORT)
+
+    gevent.spawn(scheduler.run, lambda MAC, last: generate_command(MAC, 1, last, owner=owner(MAC)))
+
+    gevent.signal(signal.SIGHUP, rebuild.set)
+
+    rebuilt_at = 0
+
+    rebuild.set()
+
     while 1:
 
-        connection = pymysql.connect(host="", user="", passwd="", db="")
+        cycle_start = time.time()
+
+        try:
+
+            if rebuild.is_set() or (DEVICE_REBUILD_INTERVAL and cycle_start - rebuilt_at > DEVICE_REBUILD_INTERVAL):
+
+                rebuild.clear()
+
+                index.rebuild()
+
+                rebuilt_at = cycle_start
+
+                logging.info("设备索引全量加载: %s 台设备", len(index))
+
+                scheduler.sync(timers())
+
+            else:
 
-        cursor = connection.cursor()
+                for MAC in index.sync():
 
-        cursor.execute("SELECT mac, mode, start, last, online FROM device where online = 1")
+                    update_timer(MAC)
 
-        logging.debug(cursor._last_executed)
+        except pymysql.MySQLError:
 
-        devices = cursor.fetchall()
+            logging.exception("设备索引同步失败")
 
-        logging.info("%s 台设备在线" % len(devices))
+        devices = index.online_devices()
 
-        for device in devices:
+        logging.info("%s 台设备在线", len(devices))
 
-            MAC = device[0]
+        slots = plan(devices) if not POLL_IN_SERVER else [[] for _ in xrange(MONITOR_INTERVAL)]
 
-            generate_command(MAC, 2)
+        busy = time.time() - cycle_start
 
-            generate_command(MAC, 4)
+        lag = 0.0
 
-            generate_command(MAC, 6)
+        for second, commands in enumerate(slots):
 
-            generate_command(MAC, 7)
+            if not commands:
 
-            mode = device[1]
+                continue
 
-            if mode == 1:
+            delay = cycle_start + second - time.time()
 
-                logging.info("定时模式")
+            if delay > 0:
 
-                start_datetime = device[2]
+                time.sleep(delay)
 
-                start_date = start_datetime.date()
+            else:
 
-                current_datetime = datetime.combine(start_date, datetime.now().time())
+                lag = max(lag, -delay)
 
-                last_time = device[3]
+            begin = time.time()
 
-                interval = total_seconds(start_datetime - current_datetime)
+            enqueue(commands)
 
-                logging.info("时间间隔秒数%d" % interval)
+            busy += time.time() - begin
 
-                if -60 < interval < 60:
+        duration = time.time() - cycle_start
 
-                    generate_command(MAC, 1, last_time)
+        CYCLE_SECONDS.observe(duration)
 
-            elif mode == 0:
+        stats.update(devices=len(devices), commands=sum(len(commands) for commands in slots), timers=scheduler.stats()["timers"], busy=busy, lag=lag, duration=duration, sync_lag=index.stats()["lag"])
 
-                logging.info("普通模式")
+        logging.info("监控周期完成: 生成命令耗时 %.3f 秒, 最大调度延迟 %.3f 秒, 周期耗时 %.3f 秒", busy, lag, duration)
 
-        cursor.close()
+        if duration > MONITOR_INTERVAL or lag > 1:
 
-        connection.close()
+            logging.warning("监控周期超时: %.3f 秒", duration)
 
         logging.info("准备休眠")
 
-        time.sleep(60)
+        time.sleep(max(cycle_start + MONITOR_INTERVAL - time.time(), 0))
 
 
 if __name__ == "__main__":
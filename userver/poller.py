@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""poller
+
+这个模块实现`tcp_server`进程内的监控轮询器.
+
+原来的监控命令由`monitor`生成,写入`redis`列表,再由持有链接的`tcp_server`取出并解析,每台设备每个周期都要经过一次`redis`往返.轮询器使用一个所有会话共享的时间轮,每个会话的每种监控命令按照各自的间隔到期,到期的命令直接放入会话的监控队列,由处理链接的协程调用`probe`执行,`redis`只用来转发用户命令.
+
+时间轮的每个槽对应一个`tick`,到期时间超过一圈的条目记录剩余圈数,添加和到期都是常数时间.每台设备的首次到期时间由物理地址的`crc32`决定,监控命令分散在整个间隔内;间隔相同的监控命令同时到期,可以批量发送.
+
+"""
+
+import time
+import zlib
+import logging
+
+import gevent
+
+
+def spread(MAC, interval):
+
+    """计算设备在监控间隔内的固定偏移秒数,使用物理地址的`crc32`,每次重启结果都相同
+
+    :param MAC: 设备的物理地址
+    :param interval: 监控间隔秒数
+    :return: 0到`interval`之间的整数
+
+    """
+
+    return (zlib.crc32(MAC) & 0xffffffff) % max(int(interval), 1)
+
+
+class Poller(object):
+
+    """基于时间轮的监控轮询器
+
+    会话关闭之后不主动从时间轮中删除,它的条目在下一次到期时直接丢弃
+
+    """
+
+    def __init__(self, intervals, tick=1, slots=512):
+
+        """
+
+        :param intervals: 监控命令类型到间隔秒数的映射
+        :param tick: 时间轮每个槽的秒数,也是轮询的精度
+        :param slots: 时间轮的槽数
+
+        """
+
+        self.intervals = intervals
+
+        self.tick = tick
+
+        self._slots = [[] for _ in xrange(slots)]
+
+        self._cursor = 0
+
+        self._greenlet = None
+
+        self._entries = 0
+
+        self._fired = 0
+
+        self._lag = 0.0
+
+    def add(self, session):
+
+        """开始轮询一个会话,每种监控命令的首次到期时间分散在各自的间隔内(参见`spread`)
+
+        :param session: 设备会话
+        :return: 无返回值
+
+        """
+
+        for kind, interval in self.intervals.iteritems():
+
+            self._schedule(session, kind, spread(session.MAC, interval) or interval)
+
+    def _schedule(self, session, kind, delay):
+
+        ticks = max(int(round(delay / float(self.tick))), 1)
+
+        size = len(self._slots)
+
+        self._slots[(self._cursor + ticks) % size].append([session, kind, (ticks - 1) // size])
+
+        self._entries += 1
+
+    def advance(self):
+
+        """时间轮前进一个槽,到期的监控命令按照会话合并之后放入会话的监控队列,并重新安排到下一个间隔
+
+        :return: 本次到期的监控命令数量
+
+        """
+
+        self._cursor = (self._cursor + 1) % len(self._slots)
+
+        slot, self._slots[self._cursor] = self._slots[self._cursor], []
+
+        due = {}
+
+        for entry in slot:
+
+            session, kind, rounds = entry
+
+            if rounds:
+
+                entry[2] -= 1
+
+                self._slots[self._cursor].append(entry)
+
+                continue
+
+            self._entries -= 1
+
+            if session.closed:
+
+                continue
+
+            due.setdefault(session, []).append(kind)
+
+            self._schedule(session, kind, self.intervals[kind])
+
+        for session, kinds in due.iteritems():
+
+            session.put_probes(kinds)
+
+        fired = sum(len(kinds) for kinds in due.itervalues())
+
+        self._fired += fired
+
+        return fired
+
+    def run(self):
+
+        """轮询循环,在协程中运行,按照绝对时间前进,休眠的误差不会累积,落后时连续前进直到追上"""
+
+        started = time.time()
+
+        ticks = 0
+
+        while 1:
+
+            ticks += 1
+
+            delay = started + ticks * self.tick - time.time()
+
+            self._lag = max(-delay, 0)
+
+            if delay > 0:
+
+                gevent.sleep(delay)
+
+            try:
+
+                self.advance()
+
+            except Exception:
+
+                logging.exception("监控轮询失败")
+
+    def start(self):
+
+        """启动轮询协程"""
+
+        if self._greenlet is None:
+
+            self._greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+
+        """停止轮询协程"""
+
+        if self._greenlet is not None:
+
+            self._greenlet.kill()
+
+            self._greenlet = None
+
+    def stats(self):
+
+        """轮询器的运行统计
+
+        :return: 包含时间轮中的条目数量,累计到期的监控命令数量以及最近一次落后的秒数的字典
+
+        """
+
+        return {
+            "entries": self._entries,
+            "fired": self._fired,
+            "lag": self._lag,
+        }
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""pool
+
+这个模块实现一个可在协程之间共享的MySQL链接池.
+
+原来每个设备链接都持有一个独立的数据库链接和游标,设备数量上万之后,空闲的数据库链接会远远超过`max_connections`.链接池把数据库链接的数量限制在一个固定的上限,每条语句执行之前借出链接,执行之后立刻归还.
+
+`asyncio`引擎(参见`engine`)不替换标准库,在系统线程中调用链接池,这时使用`ThreadSemaphore`代替`gevent`的信号量.
+
+"""
+
+import time
+import logging
+import threading
+
+import pymysql
+
+from gevent.lock import BoundedSemaphore
+
+from userver.metrics import MYSQL_SECONDS
+
+
+class PoolTimeout(pymysql.MySQLError):
+
+    """在指定时间内没有借到数据库链接时抛出的异常,继承`pymysql.MySQLError`,处理数据库错误的地方同样能处理链接池耗尽"""
+
+
+def unsent(error):
+
+    """
+
+    :param error: 执行语句时抛出的`OperationalError`或者`InterfaceError`
+    :return: 语句是否一定没有发送到数据库: 链接已经关闭(`InterfaceError`)或者写入时发现链接失效(`2006`);读取结果时断开(`2013`)的语句可能已经执行
+
+    """
+
+    return isinstance(error, pymysql.err.InterfaceError) or error.args[:1] == (2006,)
+
+
+class ThreadSemaphore(object):
+
+    """系统线程之间使用的有界信号量,`acquire`以及`release`与`gevent.lock.BoundedSemaphore`相同(Python 2的`threading.Semaphore`不支持等待超时)"""
+
+    def __init__(self, value=1):
+
+        """
+
+        :param value: 信号量的初始值以及上限
+
+        """
+
+        self._condition = threading.Condition(threading.Lock())
+
+        self._value = value
+
+        self._limit = value
+
+    def acquire(self, blocking=True, timeout=None):
+
+        """
+
+        :param blocking: 是否等待
+        :param timeout: 最长的等待秒数,`None`表示一直等待
+        :return: 是否得到信号量
+
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._condition:
+
+            while not self._value:
+
+                remaining = None if deadline is None else deadline - time.time()
+
+                if not blocking or remaining is not None and remaining <= 0:
+
+                    return False
+
+                self._condition.wait(remaining)
+
+            self._value -= 1
+
+            return True
+
+    def release(self):
+
+        with self._condition:
+
+            if self._value >= self._limit:
+
+                raise ValueError("信号量释放次数过多")
+
+            self._value += 1
+
+            self._condition.notify()
+
+
+class ConnectionPool(object):
+
+    """基于信号量的MySQL链接池
+
+    信号量限制同时借出的链接数量,空闲链接按照后进先出的顺序复用,这样最近使用过的链接总是优先被借出,长时间空闲的链接留在栈底,超过`idle_timeout`之后借出之前需要重新检查健康状态.
+
+    """
+
+    def __init__(self, size=32, timeout=10, idle_timeout=60, semaphore=BoundedSemaphore, **kwargs):
+
+        """
+
+        :param size: 链接池的容量,即同一时刻最多存在的数据库链接数量
+        :param timeout: 借出链接时最长的等待秒数,超时抛出`PoolTimeout`
+        :param idle_timeout: 链接空闲超过这个秒数之后,借出之前需要`ping`检查
+        :param semaphore: 信号量的类型,在协程之间共享时为`gevent.lock.BoundedSemaphore`,在系统线程之间共享时为`ThreadSemaphore`
+        :param kwargs: 传递给`pymysql.connect`的参数
+
+        """
+
+        self.size = size
+
+        self.timeout = timeout
+
+        self.idle_timeout = idle_timeout
+
+        self.kwargs = kwargs
+
+        self._semaphore = semaphore(size)
+
+        self._idle = []
+
+        self._created = 0
+
+        self._in_use = 0
+
+        self._checkouts = 0
+
+        self._waits = 0
+
+        self._wait_time = 0.0
+
+        self._max_wait = 0.0
+
+        self._broken = 0
+
+        self._busy_time = 0.0
+
+        self._started = time.time()
+
+    def _connect(self):
+
+        connection = pymysql.connect(**self.kwargs)
+
+        connection.autocommit(1)
+
+        self._created += 1
+
+        return connection
+
+    def get(self):
+
+        """从链接池借出一个链接
+
+        如果链接池已满,等待其它协程归还链接,等待时间超过`timeout`抛出`PoolTimeout`.空闲时间过长的链接借出之前先`ping`,检查失败则丢弃并新建链接
+
+        :return: 数据库链接
+
+        """
+
+        begin = time.time()
+
+        if not self._semaphore.acquire(timeout=self.timeout):
+
+            raise PoolTimeout("等待数据库链接超时")
+
+        waited = time.time() - begin
+
+        if waited > 0.001:
+
+            self._waits += 1
+
+            self._wait_time += waited
+
+            self._max_wait = max(self._max_wait, waited)
+
+        try:
+
+            connection = None
+
+            while self._idle:
+
+                try:
+
+                    connection, last_used = self._idle.pop()
+
+                except IndexError:
+
+                    # 系统线程之间共享时,其它线程可能在检查之后取走最后一个空闲链接
+
+                    connection = None
+
+                    break
+
+                if time.time() - last_used < self.idle_timeout:
+
+                    break
+
+                try:
+
+                    connection.ping(False)
+
+                    break
+
+                except pymysql.MySQLError:
+
+                    self._discard(connection)
+
+                    connection = None
+
+            if connection is None:
+
+                connection = self._connect()
+
+        except:
+
+            self._semaphore.release()
+
+            raise
+
+        self._in_use += 1
+
+        self._checkouts += 1
+
+        connection._checkout_time = time.time()
+
+        return connection
+
+    def put(self, connection, broken=False):
+
+        """归还借出的链接
+
+        :param connection: 数据库链接
+        :param broken: 如果链接在使用过程中出错,设置为`True`,链接会被关闭而不是放回链接池
+        :return: 无返回值
+
+        """
+
+        self._in_use -= 1
+
+        self._busy_time += time.time() - connection._checkout_time
+
+        if broken:
+
+            self._discard(connection)
+
+        else:
+
+            self._idle.append((connection, time.time()))
+
+        self._semaphore.release()
+
+    def _discard(self, connection):
+
+        self._broken += 1
+
+        self._created -= 1
+
+        try:
+
+            connection.close()
+
+        except Exception:
+
+            pass
+
+    def execute(self, sql, args=None, idempotent=False):
+
+        """借出链接执行一条语句,返回所有结果行,执行完毕立刻归还链接
+
+        如果链接已经失效(例如数据库重启),丢弃这个链接并使用新链接重试一次.只有语句一定没有发送(参见`unsent`)或者调用者声明语句可以重复执行时才重试,否则丢失响应的`INSERT`会重复插入
+
+        :param sql: 待执行的语句
+        :param args: 语句参数
+        :param idempotent: 语句是否可以重复执行(查询,设置为固定值的更新,删除)
+        :return: 结果行组成的元组
+
+        """
+
+        begin = time.time()
+
+        try:
+
+            for attempt in xrange(2):
+
+                connection = self.get()
+
+                try:
+
+                    cursor = connection.cursor()
+
+                    cursor.execute(sql, args)
+
+                    logging.debug(cursor._last_executed)
+
+                    rows = cursor.fetchall()
+
+                    cursor.close()
+
+                except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as error:
+
+                    self.put(connection, True)
+
+                    if attempt or not (idempotent or unsent(error)):
+
+                        raise
+
+                    continue
+
+                except:
+
+                    self.put(connection, True)
+
+                    raise
+
+                self.put(connection)
+
+                return rows
+
+        finally:
+
+            MYSQL_SECONDS.observe(time.time() - begin)
+
+    def close(self):
+
+        """关闭所有空闲链接"""
+
+        while self._idle:
+
+            connection, _ = self._idle.pop()
+
+            self._created -= 1
+
+            try:
+
+                connection.close()
+
+            except Exception:
+
+                pass
+
+    def stats(self):
+
+        """链接池的运行统计
+
+        :return: 包含容量,已建链接数,借出数量,等待次数,平均等待时间,最长等待时间以及利用率(借出时间占总时间的比例)的字典
+
+        """
+
+        elapsed = max(time.time() - self._started, 1e-6)
+
+        return {
+            "size": self.size,
+            "created": self._created,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "checkouts": self._checkouts,
+            "waits": self._waits,
+            "avg_wait": self._wait_time / self._waits if self._waits else 0.0,
+            "max_wait": self._max_wait,
+            "broken": self._broken,
+            "utilization": self._busy_time / (elapsed * self.size),
+        }
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+"""prefork
+
+这个模块实现`tcp_server`的多进程模式.
+
+单个进程只能使用一个CPU核心,校验和计算,日志输出以及数据库驱动的开销都集中在这个核心上.主进程(`Supervisor`)创建若干个工作进程,每个工作进程运行完整的服务(会话,命令分发器,状态写入器),通过`SO_REUSEPORT`各自监听同一个端口,由内核把新的链接分配给各个工作进程;不支持`SO_REUSEPORT`时,主进程预先监听,工作进程继承这个链接.
+
+每个工作进程的命令分发器只等待自己持有的设备的命令列表,所以命令总是由持有这个设备链接的工作进程执行.
+
+主进程在工作进程退出之后重新创建它,可以把每个工作进程绑定到一个CPU核心,并且在指标端口上汇总所有工作进程的指标以及协程状态.
+
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import logging
+import urllib2
+
+import ctypes
+import ctypes.util
+
+import gevent
+
+from gevent.pywsgi import WSGIServer
+
+
+def listen(address, backlog=256, reuseport=False):
+
+    """创建监听链接
+
+    :param address: 监听地址以及端口
+    :param backlog: 等待接受的链接数量上限
+    :param reuseport: 是否设置`SO_REUSEPORT`,允许多个进程监听同一个端口
+    :return: 已经开始监听的链接
+
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuseport:
+
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    listener.bind(address)
+
+    listener.listen(backlog)
+
+    return listener
+
+
+def set_affinity(cpus):
+
+    """把当前进程绑定到指定的CPU核心,Python 2没有`os.sched_setaffinity`,直接调用`libc`
+
+    :param cpus: CPU核心编号列表
+    :return: 绑定成功返回`True`
+
+    """
+
+    if hasattr(os, "sched_setaffinity"):
+
+        os.sched_setaffinity(0, cpus)
+
+        return True
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    mask = (ctypes.c_ulong * 16)()
+
+    for cpu in cpus:
+
+        mask[cpu // (8 * ctypes.sizeof(ctypes.c_ulong))] |= 1 << cpu % (8 * ctypes.sizeof(ctypes.c_ulong))
+
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+
+        logging.warning("绑定CPU失败: %s", os.strerror(ctypes.get_errno()))
+
+        return False
+
+    return True
+
+
+def label(line, worker):
+
+    """在一行Prometheus文本格式的指标中加入`worker`标签
+
+    :param line: 一行指标
+    :param worker: 工作进程编号
+    :return: 加入标签之后的指标
+
+    """
+
+    name, _, value = line.rpartition(' ')
+
+    if name.endswith('}'):
+
+        name = name.replace('{', '{worker="%s",' % worker, 1)
+
+    else:
+
+        name = '%s{worker="%s"}' % (name, worker)
+
+    return "%s %s" % (name, value)
+
+
+class Supervisor(object):
+
+    """多进程模式的主进程"""
+
+    def __init__(self, workers, target, address, backlog=256, reuseport=True, affinity=False, metrics_port=0):
+
+        """
+
+        :param workers: 工作进程数量
+        :param target: 工作进程运行的函数,参数为工作进程编号以及继承的监听链接(使用`SO_REUSEPORT`时为`None`)
+        :param address: 监听地址以及端口
+        :param backlog: 等待接受的链接数量上限
+        :param reuseport: 是否使用`SO_REUSEPORT`,系统不支持时改为继承主进程的监听链接
+        :param affinity: 是否把第`i`个工作进程绑定到第`i`个CPU核心(按照核心数量取余)
+        :param metrics_port: 汇总指标的端口,第`i`个工作进程使用`metrics_port + 1 + i`,`0`表示不导出
+
+        """
+
+        self.workers = workers
+
+        self.target = target
+
+        self.address = address
+
+        self.backlog = backlog
+
+        self.reuseport = reuseport and hasattr(socket, "SO_REUSEPORT")
+
+        self.affinity = affinity
+
+        self.metrics_port = metrics_port
+
+        self._listener = None
+
+        self._children = {}
+
+        self._started = {}
+
+        self._restarts = 0
+
+        self._stopping = False
+
+    def _spawn(self, index):
+
+        pid = os.fork()
+
+        if pid == 0:
+
+            code = 0
+
+            try:
+
+                if self.affinity:
+
+                    set_affinity([index % os.sysconf("SC_NPROCESSORS_ONLN")])
+
+                self.target(index, self._listener)
+
+            except Exception:
+
+                logging.exception("工作进程 %s 异常退出", index)
+
+                code = 1
+
+            finally:
+
+                os._exit(code)
+
+        logging.info("工作进程 %s 启动: %s", index, pid)
+
+        self._children[pid] = index
+
+        self._started[index] = time.time()
+
+    def run(self):
+
+        """创建所有工作进程,工作进程退出之后重新创建,直到收到`SIGTERM`或者`SIGINT`信号"""
+
+        if not self.reuseport:
+
+            self._listener = listen(self.address, self.backlog)
+
+        for index in xrange(self.workers):
+
+            self._spawn(index)
+
+        gevent.signal(signal.SIGTERM, self.stop)
+
+        gevent.signal(signal.SIGINT, self.stop)
+
+        if self.metrics_port:
+
+            WSGIServer(("127.0.0.1", self.metrics_port), self.application, log=None).start()
+
+        while self._children:
+
+            try:
+
+                pid, status = os.waitpid(-1, os.WNOHANG)
+
+            except OSError:
+
+                break
+
+            if not pid:
+
+                gevent.sleep(0.5)
+
+                continue
+
+            index = self._children.pop(pid, None)
+
+            if index is None or self._stopping:
+
+                continue
+
+            logging.error("工作进程 %s 退出: %s", index, status)
+
+            if time.time() - self._started[index] < 1:
+
+                gevent.sleep(1)
+
+            self._restarts += 1
+
+            self._spawn(index)
+
+    def stop(self):
+
+        """通知所有工作进程退出"""
+
+        self._stopping = True
+
+        for pid in self._children:
+
+            try:
+
+                os.kill(pid, signal.SIGTERM)
+
+            except OSError:
+
+                pass
+
+    def _fetch(self, index, path):
+
+        try:
+
+            return urllib2.urlopen("http://127.0.0.1:%s%s" % (self.metrics_port + 1 + index, path), timeout=2).read()
+
+        except Exception:
+
+            logging.warning("工作进程 %s 的 %s 读取失败", index, path)
+
+            return None
+
+    def aggregate(self, path):
+
+        """汇总所有工作进程的一个指标端口路径
+
+        `/metrics`在每个指标上加入`worker`标签,同一个指标的所有工作进程的值放在一起,说明行只保留一次;JSON列表合并为一个列表,每个元素加入`worker`字段;其它文本按照工作进程依次拼接
+
+        :param path: 路径
+        :return: (内容类型, 内容)
+
+        """
+
+        bodies = [(index, self._fetch(index, path)) for index in sorted(self._children.values())]
+
+        bodies = [(index, body) for index, body in bodies if body is not None]
+
+        if path in ("/", "/metrics"):
+
+            names = []
+
+            groups = {}
+
+            for index, body in bodies:
+
+                name = None
+
+                for line in body.splitlines():
+
+                    if line.startswith("# HELP "):
+
+                        name = line.split(' ', 3)[2]
+
+                        if name not in groups:
+
+                            names.append(name)
+
+                            groups[name] = [line]
+
+                    elif line.startswith("# TYPE "):
+
+                        if len(groups[name]) == 1:
+
+                            groups[name].append(line)
+
+                    elif line:
+
+                        groups[name].append(label(line, index))
+
+            lines = ["# TYPE userver_worker_restarts gauge", "userver_worker_restarts %s" % self._restarts]
+
+            for name in names:
+
+                lines.extend(groups[name])
+
+            return "text/plain; version=0.0.4", '\n'.join(lines) + '\n'
+
+        try:
+
+            merged = []
+
+            for index, body in bodies:
+
+                for item in json.loads(body):
+
+                    item["worker"] = index
+
+                    merged.append(item)
+
+            return "application/json", json.dumps(merged, indent=1)
+
+        except (ValueError, TypeError):
+
+            return "text/plain", ''.join("=== worker %s\n%s\n" % item for item in bodies)
+
+    def application(self, environ, start_response):
+
+        """汇总指标以及协程状态的WSGI应用"""
+
+        content_type, body = self.aggregate(environ.get("PATH_INFO"))
+
+        start_response("200 OK", [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+
+        return [body]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""scheduler
+
+这个模块实现定时模式的调度器.
+
+原来`monitor`每分钟扫描所有在线设备,逐个检查当前时间是否在定时时间前后60秒之内,开销随设备数量增长,而且由于休眠时间的漂移,可能触发两次或者漏掉.调度器按照下一次触发时间把定时任务放在一个最小堆中,每次只取出已经到期的任务,触发之后重新安排到下一天的同一时刻.
+
+"""
+
+import time
+import heapq
+import logging
+
+import gevent
+
+from datetime import datetime, timedelta
+
+
+def next_fire(start, now=None):
+
+    """计算定时任务的下一次触发时间,定时模式每天在`start`的时刻触发(忽略`start`的日期)
+
+    :param start: 定时开始时间(datetime类型)
+    :param now: 当前时间(datetime类型),默认为当前本地时间
+    :return: 下一次触发时间的时间戳
+
+    """
+
+    now = now or datetime.now()
+
+    fire = datetime.combine(now.date(), start.time())
+
+    if fire <= now:
+
+        fire += timedelta(days=1)
+
+    return time.mktime(fire.timetuple()) + fire.microsecond / 1e6
+
+
+class TimerScheduler(object):
+
+    """以下一次触发时间为键的定时任务调度器
+
+    修改或者删除定时任务时不在堆中查找旧的条目,而是增加条目的版本号,旧版本的条目在出堆时直接丢弃
+
+    """
+
+    def __init__(self):
+
+        self._heap = []
+
+        self._entries = {}
+
+        self._version = 0
+
+        self._fired = 0
+
+    def set(self, MAC, start, last):
+
+        """添加或者修改定时任务,定时时间和加热时长都没有变化时不做任何操作
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param start: 定时开始时间(datetime类型)
+        :param last: 加热时长
+        :return: 无返回值
+
+        """
+
+        entry = self._entries.get(MAC)
+
+        if entry is not None and entry[0] == start and entry[1] == last:
+
+            return
+
+        self._version += 1
+
+        self._entries[MAC] = (start, last, self._version)
+
+        heapq.heappush(self._heap, (next_fire(start), self._version, MAC))
+
+    def remove(self, MAC):
+
+        """删除定时任务(设备改为普通模式或者离线)
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: 无返回值
+
+        """
+
+        self._entries.pop(MAC, None)
+
+    def sync(self, timers):
+
+        """使用全部定时任务更新调度器,只修改发生变化的任务
+
+        :param timers: 设备的物理地址到(定时开始时间, 加热时长)的字典
+        :return: 无返回值
+
+        """
+
+        for MAC in [MAC for MAC in self._entries if MAC not in timers]:
+
+            self.remove(MAC)
+
+        for MAC, (start, last) in timers.iteritems():
+
+            self.set(MAC, start, last)
+
+    def due(self, now=None):
+
+        """取出所有已经到期的定时任务,并把它们重新安排到下一天
+
+        :param now: 当前时间戳,默认为当前时间
+        :return: 由(设备的物理地址, 加热时长)组成的列表
+
+        """
+
+        now = now or time.time()
+
+        fired = []
+
+        while self._heap and self._heap[0][0] <= now:
+
+            _, version, MAC = heapq.heappop(self._heap)
+
+            entry = self._entries.get(MAC)
+
+            if entry is None or entry[2] != version:
+
+                continue
+
+            start, last, _ = entry
+
+            fired.append((MAC, last))
+
+            heapq.heappush(self._heap, (next_fire(start, datetime.fromtimestamp(now)), version, MAC))
+
+        self._fired += len(fired)
+
+        return fired
+
+    def delay(self, now=None):
+
+        """
+
+        :param now: 当前时间戳,默认为当前时间
+        :return: 距离最早的触发时间的秒数,没有任务时返回`None`
+
+        """
+
+        if not self._heap:
+
+            return None
+
+        return max(self._heap[0][0] - (now or time.time()), 0)
+
+    def run(self, fire, precision=1):
+
+        """调度循环,在协程中运行,最多休眠`precision`秒,因此新加入或者修改的任务最多延迟这么长时间
+
+        :param fire: 触发回调函数,参数为设备的物理地址以及加热时长
+        :param precision: 最长休眠秒数
+        :return: 无返回值
+
+        """
+
+        while 1:
+
+            for MAC, last in self.due():
+
+                try:
+
+                    fire(MAC, last)
+
+                except Exception:
+
+                    logging.exception("%s 定时任务触发失败", MAC)
+
+            delay = self.delay()
+
+            gevent.sleep(precision if delay is None else min(delay, precision))
+
+    def stats(self):
+
+        """
+
+        :return: 包含定时任务数量,堆大小以及累计触发次数的字典
+
+        """
+
+        return {
+            "timers": len(self._entries),
+            "heap": len(self._heap),
+            "fired": self._fired,
+        }
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+
+"""session
+
+这个模块定义设备会话以及进程内的会话注册表.
+
+每个设备链接对应一个会话,会话包含设备和程序之间的链接,一个接收设备数据的读事件监视器,分别存放用户命令和设备上报信息的两个队列,以及进程内轮询器放入的到期监控命令类型.处理链接的协程只在命令或者上报信息到达之后才会被唤醒.
+
+读事件监视器是唯一读取链接的地方,链接可读时由事件循环直接调用`_read`,不需要为每个会话保留一个阻塞在`recv`上的协程(每个挂起的协程要保存几KB的调用栈).发送命令之前先按照期望的响应类型登记一个`AsyncResult`,收到这个类型的帧之后直接交给等待者;其它帧都是上报信息,放入上报队列,等到当前命令执行完毕再处理,因此处理上报信息不会嵌套在等待响应的过程中.
+
+单个进程需要容纳十万台空闲设备,会话使用`__slots__`,两个队列使用列表(每台设备的队列通常只有几条,空列表只占几十字节,而空的`deque`要预先分配一个数据块),空闲会话不持有数据库链接,也不保留接收缓冲区.每个会话的内存占用可以使用`benchmark.py memory`测量.
+
+命令分为两条通道(参见`enqueue`): 用户命令以及控制命令按照到达顺序放入有长度上限的`tasks`,监控命令只记录类型,放入`probes`,尚未执行的同类型监控命令合并为一条.处理链接的协程总是先执行`tasks`中的命令,设备离线期间堆积的大量心跳和状态查询不会让用户的打开命令排在它们后面.
+
+这个进程持有设备链接,所以会话注册表是设备在线状态的唯一依据,只有在线状态发生变化时才写入数据库.
+
+设备重新接入时新的会话接管原来的会话: 尚未执行的命令转移到新的会话,原来的会话关闭链接,停止读事件监视器,处理链接的协程在短暂等待之后被强制结束.所有尚未被回收的会话都记录在`live`中,已经不在注册表中却仍然持有链接或者协程的会话视为泄漏(参见`SessionRegistry.census`).
+
+"""
+
+import os
+import ast
+import time
+import logging
+
+import errno
+
+import gevent
+import gevent.socket
+
+from binascii import hexlify
+from weakref import WeakSet
+
+from gevent.event import Event, AsyncResult
+
+from userver.codec import FrameDecoder
+
+live = WeakSet()
+"""WeakSet: 所有尚未被回收的会话"""
+
+PROBE_KINDS = (2, 4, 6, 7)
+"""tuple: 监控命令类型: 心跳,温度湿度,状态查询,药量,批量监控命令(`type`为`5`)不带`probes`时表示全部类型"""
+
+
+def enqueue(session, task, limit):
+
+    """把一条命令放入会话的命令通道,`gevent`引擎和`asyncio`引擎(参见`engine`)共用这个函数
+
+    监控命令(类型`2`,`4`,`6`,`7`以及批量监控命令`5`)只把类型加入`probes`,已经在等待的类型直接合并;其它命令解析之后放入`tasks`,用户命令(类型`0`,`1`)在`tasks`已经有`limit`条命令时拒绝,控制命令(下线`-2`,删除`-1`)总是放入
+
+    :param session: 设备会话,需要有`tasks`列表以及`probes`集合
+    :param task: 命令(字符串)
+    :param limit: `tasks`的长度上限
+    :return: `"queued"`,`"coalesced"`(监控命令全部合并),`"rejected"`(命令通道已满)或者`"invalid"`(无法解析)
+
+    """
+
+    try:
+
+        command = ast.literal_eval(task)
+
+        kind = command["type"]
+
+    except (ValueError, SyntaxError, TypeError, KeyError):
+
+        return "invalid"
+
+    if kind == 5 or kind in PROBE_KINDS:
+
+        kinds = set(command.get("probes", PROBE_KINDS) if kind == 5 else [kind])
+
+        if kinds <= session.probes:
+
+            return "coalesced"
+
+        session.probes.update(kinds)
+
+        return "queued"
+
+    if kind in (0, 1) and len(session.tasks) >= limit:
+
+        return "rejected"
+
+    session.tasks.append(command)
+
+    return "queued"
+
+
+class Session(object):
+
+    """设备会话
+
+    除了链接和队列之外,会话还有一个随机的标志(用来在集群会话目录中区分同一台设备的不同会话),记录接入时间,最后一次收到设备数据的时间,正在执行的命令,以及是否允许批量发送监控命令
+
+    """
+
+    __slots__ = ("MAC", "socket", "token", "limit", "tasks", "reports", "probes", "pending", "decoder", "reader", "handler", "closed", "reason",
+                 "connected_at", "last_seen", "task", "task_started", "pipeline", "_event", "__weakref__")
+
+    def __init__(self, MAC, socket, limit=64):
+
+        """
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param socket: 设备和程序之间的链接
+        :param limit: 尚未执行的用户命令数量上限(参见`enqueue`)
+
+        """
+
+        self.MAC = MAC
+
+        self.socket = socket
+
+        self.token = hexlify(os.urandom(6))
+
+        self.limit = limit
+
+        self.tasks = []
+
+        self.reports = []
+
+        self.probes = set()
+
+        self.pending = {}
+
+        self.decoder = FrameDecoder()
+
+        self.reader = None
+
+        self.handler = None
+
+        self.closed = False
+
+        self.reason = None
+
+        self.connected_at = time.time()
+
+        self.last_seen = self.connected_at
+
+        self.task = None
+
+        self.task_started = None
+
+        self.pipeline = True
+
+        self._event = Event()
+
+        live.add(self)
+
+    def start(self, send_timeout=5):
+
+        """启动接收设备数据的读事件监视器,调用者所在的协程视为处理链接的协程
+
+        读事件监视器直接使用底层的非阻塞链接,链接的超时时间只影响发送,设备停止接收数据(接收窗口为零)时,发送最多阻塞`send_timeout`秒
+
+        :param send_timeout: 每次发送的最长秒数
+        :return: 无返回值
+
+        """
+
+        self.socket.settimeout(send_timeout)
+
+        self.handler = gevent.getcurrent()
+
+        self.reader = gevent.get_hub().loop.io(self.socket.fileno(), 1)
+
+        self.reader.start(self._read)
+
+    @property
+    def released(self):
+
+        """会话已经关闭,读事件监视器已经停止,处理链接的协程已经结束"""
+
+        return self.closed and (self.reader is None or not self.reader.active) and (self.handler is None or self.handler.dead)
+
+    def _read(self):
+
+        """链接可读时由事件循环调用,接收一次设备数据,解码之后逐帧分发,链接出错或者断开时停止监视器,通知所有等待者以及处理链接的协程
+
+        这个函数运行在事件循环中,不能切换协程,因此直接使用底层的非阻塞链接接收数据
+
+        """
+
+        try:
+
+            data = self.socket._sock.recv(4096)
+
+        except gevent.socket.error as error:
+
+            if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+
+                return
+
+            logging.critical("%s 接收数据失败: %s", self.MAC, error)
+
+            self.reason = self.reason or "error"
+
+            data = ''
+
+        if not data:
+
+            self.reason = self.reason or "empty"
+
+            self.reader.stop()
+
+            self._abort()
+
+            self.put_report(data)
+
+            return
+
+        self.last_seen = time.time()
+
+        for frame in self.decoder.feed(data):
+
+            result = self.pending.pop(ord(frame[2]), None) if len(frame) > 2 else None
+
+            if result is not None:
+
+                result.set(frame)
+
+            else:
+
+                self.put_report(frame)
+
+    def _abort(self):
+
+        """链接断开,唤醒所有等待响应的协程,响应为空串"""
+
+        pending, self.pending = self.pending, {}
+
+        for result in pending.itervalues():
+
+            result.set('')
+
+    def expect(self, response_type):
+
+        """登记期望的响应类型,必须在发送命令之前调用
+
+        :param response_type: 期望的响应数据的类型
+        :return: `AsyncResult`,收到这个类型的帧之后设置为这个帧,链接断开设置为空串
+
+        """
+
+        result = AsyncResult()
+
+        if self.closed:
+
+            result.set('')
+
+        else:
+
+            self.pending[response_type] = result
+
+        return result
+
+    def forget(self, response_type, result):
+
+        """等待超时之后取消登记,如果这个类型已经被重新登记,不做任何操作
+
+        :param response_type: 期望的响应数据的类型
+        :param result: `expect`返回的`AsyncResult`
+        :return: 无返回值
+
+        """
+
+        if self.pending.get(response_type) is result:
+
+            del self.pending[response_type]
+
+    def put_task(self, task):
+
+        """放入一条命令,由命令分发器调用
+
+        :param task: 命令(字符串)
+        :return: 放入结果(参见`enqueue`)
+
+        """
+
+        status = enqueue(self, task, self.limit)
+
+        if status == "queued":
+
+            self._event.set()
+
+        return status
+
+    def put_probes(self, kinds):
+
+        """放入到期的监控命令类型,由进程内的轮询器调用,尚未执行的同类型监控命令只保留一条
+
+        :param kinds: 监控命令类型列表
+        :return: 无返回值
+
+        """
+
+        self.probes.update(kinds)
+
+        self._event.set()
+
+    def put_report(self, data):
+
+        """放入一条上报信息,由读事件监视器调用
+
+        :param data: 一个完整帧(二进制串),空串表示链接已经断开
+        :return: 无返回值
+
+        """
+
+        self.reports.append(data)
+
+        self._event.set()
+
+    def wait(self, timeout=None):
+
+        """等待命令,监控命令或者上报信息到达,会话关闭时立刻返回
+
+        :param timeout: 最长等待秒数,默认一直等待
+        :return: 有命令,监控命令或者上报信息或者会话已经关闭返回`True`,等待超时返回`False`
+
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        while not self.tasks and not self.probes and not self.reports and not self.closed:
+
+            self._event.clear()
+
+            remaining = None if deadline is None else deadline - time.time()
+
+            if remaining is not None and remaining <= 0:
+
+                return False
+
+            self._event.wait(remaining)
+
+        return True
+
+    def send(self, data):
+
+        """通过链接发送数据
+
+        :param data: 二进制串
+        :return: 无返回值
+        :raise socket.error: 链接出错,或者超过`start`指定的时间仍然没有发送完毕(`ETIMEDOUT`)
+
+        """
+
+        try:
+
+            self.socket.sendall(data)
+
+        except gevent.socket.timeout:
+
+            raise gevent.socket.error(errno.ETIMEDOUT, "%s 发送数据超时" % self.MAC)
+
+    def close(self, reason=None):
+
+        """停止读事件监视器,关闭链接,唤醒所有等待中的协程
+
+        :param reason: 断开原因,只记录第一次的原因(例如已经发现链接出错),默认为`closed`
+        :return: 无返回值
+
+        """
+
+        if self.reason is None:
+
+            self.reason = reason or "closed"
+
+        self.closed = True
+
+        self._abort()
+
+        self._event.set()
+
+        if self.reader is not None:
+
+            self.reader.stop()
+
+        self.socket.close()
+
+    def adopt(self, previous):
+
+        """接管同一台设备的上一个会话尚未执行的命令以及监控命令类型,放在这个会话已有的命令之前
+
+        :param previous: 上一个会话
+        :return: 无返回值
+
+        """
+
+        self.tasks[:0] = previous.tasks
+
+        del previous.tasks[:]
+
+        self.probes.update(previous.probes)
+
+        previous.probes.clear()
+
+        if self.tasks or self.probes:
+
+            self._event.set()
+
+    def terminate(self, reason=None, timeout=1):
+
+        """关闭会话并且结束处理链接的协程,用于被新的会话取代时释放全部资源
+
+        处理链接的协程先有`timeout`秒的时间完成正在执行的操作(等待响应的命令在关闭时已经被唤醒)并且执行清理,超时之后强制结束,清理代码仍然会在`GreenletExit`中执行
+
+        :param reason: 断开原因
+        :param timeout: 等待处理链接的协程自行结束的秒数
+        :return: 处理链接的协程已经结束返回`True`
+
+        """
+
+        self.close(reason)
+
+        handler = self.handler
+
+        if handler is None or handler.dead or handler is gevent.getcurrent():
+
+            return True
+
+        handler.join(timeout)
+
+        if not handler.dead:
+
+            logging.warning("%s 强制结束原来的会话", self.MAC)
+
+            handler.kill(block=True, timeout=timeout)
+
+        return handler.dead
+
+    def info(self):
+
+        """会话的当前状态
+
+        :return: 包含物理地址,接入时间,最后一次收到数据的时间,正在执行的命令及其已经执行的秒数,正在等待的响应类型,命令队列长度,等待执行的监控命令类型以及断开原因的字典
+
+        """
+
+        return {
+            "mac": self.MAC,
+            "connected_at": self.connected_at,
+            "last_seen": self.last_seen,
+            "task": self.task,
+            "busy": time.time() - self.task_started if self.task is not None and self.task_started else None,
+            "waiting": sorted(self.pending),
+            "depth": len(self.tasks),
+            "probes": sorted(self.probes),
+            "reason": self.reason,
+        }
+
+
+class SessionRegistry(object):
+
+    """进程内的会话注册表,物理地址到会话的映射"""
+
+    def __init__(self):
+
+        self._sessions = {}
+
+    def add(self, session):
+
+        """注册会话
+
+        :param session: 设备会话
+        :return: 这个物理地址之前注册的会话,如果没有返回`None`
+
+        """
+
+        previous = self._sessions.get(session.MAC)
+
+        self._sessions[session.MAC] = session
+
+        return previous
+
+    def remove(self, session):
+
+        """注销会话,如果这个物理地址已经被新的会话注册,不做任何操作
+
+        :param session: 设备会话
+        :return: 注销成功返回`True`,即设备由在线变为离线
+
+        """
+
+        if self._sessions.get(session.MAC) is session:
+
+            del self._sessions[session.MAC]
+
+            return True
+
+        return False
+
+    def get(self, MAC):
+
+        """
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: 对应的会话,如果设备不在线返回`None`
+
+        """
+
+        return self._sessions.get(MAC)
+
+    def __contains__(self, MAC):
+
+        return MAC in self._sessions
+
+    def __len__(self):
+
+        return len(self._sessions)
+
+    def __iter__(self):
+
+        return iter(self._sessions.values())
+
+    def census(self):
+
+        """
+
+        :return: 包含在线会话数量,尚未被回收的会话数量,以及已经注销却仍然持有链接,读事件监视器或者协程的会话数量的字典
+
+        """
+
+        leaked = 0
+
+        total = 0
+
+        for session in list(live):
+
+            total += 1
+
+            if self._sessions.get(session.MAC) is not session and not session.released:
+
+                leaked += 1
+
+        return {
+            "active": len(self._sessions),
+            "objects": total,
+            "leaked": leaked,
+        }
+
+    def snapshot(self):
+
+        """
+
+        :return: 所有在线会话的状态列表
+
+        """
+
+        return [session.info() for session in self._sessions.values()]
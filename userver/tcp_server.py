@@ -6,15 +6,17 @@
 
 """
 
+import os
 import re
 import sys
 import ast
 import json
-import struct
+import signal
+import time
 
 import gevent
 
-from binascii import hexlify
+from binascii import unhexlify
 from datetime import datetime
 
 from gevent.server import StreamServer
@@ -23,105 +25,210 @@ from gevent import socket
 sys.path.append("../")
 
 from userver import *
+from userver.codec import checksum_ok, counters, encode
+from userver.session import Session, SessionRegistry
+from userver.dispatcher import Dispatcher
+from userver.poller import Poller
+from userver.metrics import Counter, Gauge, Histogram, REDIS_SECONDS, route, serve as serve_metrics
+from userver.watchdog import Watchdog
+from userver.prefork import Supervisor, listen
+from userver.directory import SessionDirectory
+from userver.logs import Hex
 
 socket.setdefaulttimeout(5)
 
-greenlets = {}
-"""list: 全局变量`greenlets`
+sessions = SessionRegistry()
+"""SessionRegistry: 全局变量`sessions`
 
-存储设备和设备对应的链接,用来分辨是否是新设备
+存储在线设备的会话,是设备在线状态的唯一依据,设备重新接入时新的会话接管原来的会话
 
 """
 
+dispatcher = Dispatcher(redis_client, sessions, DISPATCH_WORKERS, DISPATCH_TIMEOUT, reject=lambda MAC, task: reject_task(MAC, task))
+"""Dispatcher: 全局变量`dispatcher`
 
-def translate(data, flag="server"):
+阻塞等待所有在线设备的命令列表,把命令分发给对应的会话,会话的命令通道已满时立刻返回执行失败
 
-    """把一个十六进制字符串以两位为整体进行切割,同时把切割结果转换成为十进制整数
+"""
 
-    :param data: 十六进制字符串
-    :param flag: 由于程序产生字符串,而设备发送二进制串,需要使用标志区分数据来源,当数据来自设备,需要先使用`binascii.hexlify`进行格式转换.取值范围:{"server"(默认值), "client"}
-    :return: 返回一个整数列表
+poller = Poller(PROBE_INTERVALS, POLL_TICK)
+"""Poller: 全局变量`poller`
 
-    """
+`POLL_IN_SERVER`为`True`时,按照`PROBE_INTERVALS`定期把到期的监控命令放入在线会话,不经过`redis`
+
+"""
+
+directory = SessionDirectory(redis_client, sessions, NODE_NAME, SESSION_LEASE)
+"""SessionDirectory: 全局变量`directory`
+
+`CLUSTER_DIRECTORY`为`True`时,在`redis`中记录每台设备由哪个进程持有,接管其它进程(或者其它节点)上原来的会话
+
+"""
+
+watchdog = Watchdog(WATCHDOG_THRESHOLD)
+"""Watchdog: 全局变量`watchdog`
+
+检测阻塞事件循环的协程,处理链接的协程使用设备的物理地址命名
+
+"""
+
+SESSIONS = Gauge("userver_sessions", "在线会话数量", function=lambda: len(sessions))
+"""Gauge: 在线会话数量"""
+
+LEAKED = Gauge("userver_sessions_leaked", "已经注销却仍然持有链接或者协程的会话数量", function=lambda: sessions.census()["leaked"])
+"""Gauge: 泄漏的会话数量,重新接入频繁时应该保持为零"""
+
+SESSION_OBJECTS = Gauge("userver_session_objects", "尚未被回收的会话对象数量", function=lambda: sessions.census()["objects"])
+"""Gauge: 尚未被回收的会话对象数量,应该和在线会话数量接近"""
+
+TAKEOVERS = Counter("userver_takeovers_total", "设备重新接入时接管同一个进程内原来的会话的次数")
+"""Counter: 会话接管次数"""
+
+ACCEPTS = Counter("userver_accepts_total", "接入的链接数量")
+"""Counter: 接入的链接数量"""
+
+DISCONNECTS = Counter("userver_disconnects_total", "断开的链接数量", ("reason",))
+"""Counter: 断开的链接数量,按照原因分类: timeout, error, empty, delete, offline, replaced(被同一个进程内新的会话接管), evicted(被其它进程接管), closed, handshake(没有通过物理地址检测)"""
+
+COMMAND_SECONDS = Histogram("userver_command_seconds", "从发送命令到收到有效响应的耗时", ("type",))
+"""Histogram: 命令响应耗时,按照命令类型(帧的第三个字节,十六进制)分类"""
+
+COMMAND_RETRIES = Counter("userver_command_retries_total", "等待超时或者响应校验出错之后重新发送命令的次数", ("type",))
+"""Counter: 命令重发次数,按照命令类型分类"""
+
+REPORT_ERRORS = Counter("userver_report_errors_total", "上报信息校验出错(f5aa0802)以及类型错误(f5aa0801)的数量", ("reason",))
+"""Counter: 上报信息错误数量"""
+
+QUEUE_DEPTH = Gauge("userver_queue_depth", "每组设备每条通道尚未执行的命令数量(分组参见dispatcher,通道参见session.enqueue)", ("bucket", "lane"), function=lambda: dispatcher.depths())
+"""Gauge: 命令队列长度,按照分发器的分组以及命令通道统计"""
 
-    if flag == "client":
+QUEUE_DEPTH_MAX = Gauge("userver_queue_depth_max", "单个会话尚未执行的用户命令以及控制命令的最大数量", function=lambda: dispatcher.deepest())
+"""Gauge: 最长的命令队列"""
 
-        data = hexlify(data)
+QUEUE_OUTCOMES = Gauge("userver_queue_outcomes", "没有放入命令通道的命令累计数量: 合并的监控命令,拒绝的用户命令,无法解析的命令", ("outcome",),
+                       function=lambda: dict(((outcome,), dispatcher.stats()[outcome]) for outcome in ("coalesced", "rejected", "invalid")))
+"""Gauge: 命令合并以及拒绝的次数"""
 
-    tmp = []
+HUB_BLOCKS = Gauge("userver_hub_blocks", "事件循环被阻塞超过WATCHDOG_THRESHOLD秒的累计次数", function=lambda: watchdog.stats()["blocks"])
+"""Gauge: 事件循环阻塞次数"""
 
-    for i in xrange(len(data) / 2):
+LOG_RECORDS = Gauge("userver_log_records", "日志数量: 等待写入,已经写入,队列满丢弃,限流抑制", ("state",), function=lambda: dict(((state,), count) for state, count in log_handler.stats().iteritems()))
+"""Gauge: 后台日志输出的统计(参见logs)"""
 
-        tmp.append(int(data[i * 2: i * 2 + 2], 16))
+MYSQL_POOL = Gauge("userver_mysql_pool", "数据库链接池: 容量,已建链接,空闲,借出,累计借出,等待次数,平均等待秒数,最长等待秒数,损坏链接,利用率", ("stat",), function=lambda: dict(((stat,), value) for stat, value in mysql_pool.stats().iteritems()))
+"""Gauge: 数据库链接池的统计(参见pool),等待次数和利用率持续升高时应该增大`MYSQL_POOL_SIZE`"""
 
-    return tmp
+STATE_WRITER = Gauge("userver_state_writer", "设备状态写入: 更新次数,丢弃的重复更新,写入行数,语句数量,待写入设备,最后一次写入的时间戳", ("stat",), function=lambda: dict(((stat,), value) for stat, value in state_writer.stats().iteritems()))
+"""Gauge: 设备状态写入器的统计(参见writer),写入行数和更新次数的差是合并掉的更新"""
+
+FRAMES = Gauge("userver_frames", "本进程所有链接累计解析的帧: 完整帧,丢弃无效数据重新同步,校验失败", ("outcome",), function=lambda: dict(((outcome,), count) for outcome, count in counters.iteritems()))
+"""Gauge: 拆帧统计(参见codec),重新同步和校验失败的比例升高说明链路质量下降"""
+
+REPORT_CHECKSUM = REPORT_ERRORS.labels("checksum")
+
+REPORT_TYPE = REPORT_ERRORS.labels("type")
+
+COMMAND_TYPES = ("01", "03", "04", "07", "08")
+"""tuple: 程序发送的命令类型(帧的第三个字节,十六进制),每种类型的指标在这里预先取得,发送命令时不再查找标签"""
+
+COMMAND_SECONDS_BY_TYPE = dict((kind, COMMAND_SECONDS.labels(kind)) for kind in COMMAND_TYPES)
+
+COMMAND_RETRIES_BY_TYPE = dict((kind, COMMAND_RETRIES.labels(kind)) for kind in COMMAND_TYPES)
+
+RETURN_STATUS_SECONDS = REDIS_SECONDS.labels("return_status")
+
+
+def translate(data, flag="server"):
+
+    """把数据转换成为整数列表,每个字节对应一个整数
+
+    :param data: 十六进制字符串或者二进制串
+    :param flag: 由于程序产生字符串,而设备发送二进制串,需要使用标志区分数据来源,当数据来自程序,需要先使用`binascii.unhexlify`进行格式转换.取值范围:{"server"(默认值), "client"}
+    :return: 返回一个整数列表
+
+    """
+
+    if flag == "server":
+
+        data = unhexlify(data)
+
+    return list(bytearray(data))
 
 
 def get_checksum(data):
 
     """检验设备响应数据的校验和
 
-    首先调用`translate`函数获得响应数据的整数列表表示,然后对这个列表的除了最后一个元素之外所有元素求和,求和结果与`0xff`做位与操作,所得结果即为校验和,最后与整数列表的末尾元素比较,一致返回`True`,否则返回`False`
+    对除了最后一个字节之外所有字节求和,求和结果与`0xff`做位与操作,所得结果即为校验和,最后与末尾字节比较,一致返回`True`,否则返回`False`(具体实现参见`codec.checksum_ok`)
 
     :param data: 设备响应数据(二进制串)
     :return: 如果计算结果与设备上报的校验和一致返回`True`,否则返回`False`
 
     """
 
-    data = translate(data, "client")
-
-    checksum = sum(data[:-1]) & 0xff
-
-    return 1 if data[-1] == checksum else 0
+    return 1 if checksum_ok(data) else 0
 
 
 def set_checksum(data):
 
     """计算即将发送的命令的校验和并附加到命令末尾
 
-    首先调用`translate`函数获得命令的整数列表表示,然后对这个列表的所有元素求和,求和结果与`0xff`做位与操作,所得结果即为校验和,把校验和附加到整数列表的末尾,最后把整数列表转换为二进制串
+    固定命令直接从`codec.FRAMES`中取出预先生成的二进制串,其它命令对所有字节求和,求和结果与`0xff`做位与操作,所得结果即为校验和,附加到二进制串的末尾
 
     :param data: 即将发送的命令
     :return: 带有校验和的命令
 
     """
 
-    data = translate(data)
+    return encode(data)
 
-    checksum = sum(data) & 0xff
 
-    data.append(checksum)
+def handle_report(MAC, session, data):
 
-    sequence = map(lambda x: struct.pack("!B", x), data)
+    """处理上报信息
 
-    return ''.join(sequence)
+    首先检验上报信息的校验和,如果校验失败,发送`f5aa0802`命令,然后检查命令类型,如果命令类型不符,发送`f5aa0801`,如果上述两个检查通过,发送`f5aa0800`
+    然后根据协议处理上报事件(参见`on_report`),药水已经更新时重新读取药量
 
+    :param MAC: 设备的物理地址(唯一标志)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
+    :param data: 设备上报数据
+    :return: 根据上报数据执行某项操作, 无返回值
+
+    """
 
-def handle_report(MAC, socket, connection, cursor, data):
+    command, refresh = on_report(MAC, data)
 
-    """处理上报信息
+    if refresh:
 
-    首先检验上报信息的校验和,如果校验失败,发送`f5aa0802`命令,然后检查命令类型,如果命令类型不符,发送`f5aa0801`,如果上述两个检查通过,发送`f5aa0800`
-    然后根据协议处理上报事件:
+        read_remaining_potion(MAC, session)
+
+    send_command(MAC, session, command)
+
+
+def on_report(MAC, data):
+
+    """解析上报信息并且更新设备状态,`gevent`引擎和`asyncio`引擎(参见`engine`)共用这个函数
+
+    根据协议处理上报事件:
     
         如果事件类型为`1`,表示读取药量错误(设备接触不良);
         如果事件类型为`2`,表示用户按下设备物理按键,然后根据按键位置的不同相应的更新`power`字段;
         如果事件类型为`3`,表示药水已经用完;
-        如果事件类型为`4`,表示药水已经更新,调用读取药量函数,更新数据;
+        如果事件类型为`4`,表示药水已经更新,需要重新读取药量;
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
     :param data: 设备上报数据
-    :return: 根据上报数据执行某项操作, 无返回值
+    :return: (回复上报信息的命令, 是否需要重新读取药量)
 
     """
 
-    logging.info("%s 处理上报信息" % MAC)
+    logging.info("%s 处理上报信息", MAC)
 
     data = data[:6]
 
+    refresh = False
+
     if get_checksum(data):
 
         data = translate(data, "client")
@@ -132,7 +239,7 @@ def handle_report(MAC, socket, connection, cursor, data):
 
             if data[3] == 1:
 
-                logging.error("%s 读取药水错误" % MAC)
+                logging.error("%s 读取药水错误", MAC)
 
             if data[3] == 2:
 
@@ -140,46 +247,46 @@ def handle_report(MAC, socket, connection, cursor, data):
 
                 if key == 0:
 
-                    cursor.execute("UPDATE device SET power = 0 WHERE mac = %s", MAC)
+                    state_writer.update(MAC, power=0)
 
                 else:
 
-                    cursor.execute("UPDATE device SET power = %s WHERE mac = %s", (2 * key, MAC))
-
-                logging.debug(cursor._last_executed)
+                    state_writer.update(MAC, power=2 * key)
 
-                logging.info("%s 用户按下%s键" % (MAC, key))
+                logging.info("%s 用户按下%s键", MAC, key)
 
             if data[3] == 3:
 
-                cursor.execute("UPDATE device SET dosage = 0 WHERE mac = %s", MAC)
+                state_writer.update(MAC, dosage=0)
 
-                logging.debug(cursor._last_executed)
-
-                logging.warning("%s 药水已经用完" % MAC)
+                logging.warning("%s 药水已经用完", MAC)
 
             if data[3] == 4:
 
-                read_remaining_potion(MAC, socket, connection, cursor)
+                refresh = True
 
-                logging.info("%s 药水已经更新" % MAC)
+                logging.info("%s 药水已经更新", MAC)
 
         else:
 
             command = "f5aa0801"
 
-            logging.error("%s 上报命令错误" % MAC)
+            REPORT_TYPE.inc()
+
+            logging.error("%s 上报命令错误", MAC)
 
     else:
 
         command = "f5aa0802"
 
-        logging.error("%s 上报校验错误" % MAC)
+        REPORT_CHECKSUM.inc()
+
+        logging.error("%s 上报校验错误", MAC)
 
-    send_command(MAC, socket, connection, cursor, command)
+    return command, refresh
 
 
-def send_command(MAC, socket, connection, cursor, command, response_length=0, response_type=0, times=5):
+def send_command(MAC, session, command, response_length=0, response_type=0, times=5):
 
     """通过链接发送命令,等待响应,返回有效响应数据
 
@@ -187,47 +294,50 @@ def send_command(MAC, socket, connection, cursor, command, response_length=0, re
 
     下面介绍每次循环的流程:
 
-        首先通过链接尝试发送数据,如果出现异常,关闭连接,清理资源;
-        然后通过链接尝试接收数据,如果出现异常,关闭连接,清理资源,如果等待超时,进入下次循环,重新发送命令;
-        获得响应数据,如果响应数据为空,关闭连接,清理资源;
-        然后检验响应数据类型是否与期望相符,如果相符,则验证校验和,如果校验通过,返回有效响应数据,否则进入下次循环,重新发送命令;
-        如果响应数据类型与期望不符,把设备响应信息当作上报信息处理
+        首先在会话中登记期望的响应类型,然后通过链接尝试发送数据,如果出现异常,关闭连接,清理资源;
+        然后等待会话的读事件监视器交来这个类型的响应,如果等待超时,进入下次循环,重新发送命令;
+        获得响应数据,如果响应数据为空(链接出错或者断开),关闭连接,清理资源;
+        然后验证校验和,如果校验通过,返回有效响应数据,否则进入下次循环,重新发送命令;
 
-        *因为处理上报信息过程中发送的命令无需返回,所以发送之后,函数直接返回,不进行后续操作*
+        *其它类型的帧由读事件监视器放入上报队列,当前命令执行完毕之后由`serve`处理,不会嵌套在这里*
+
+        *回复上报信息的命令无需等待响应,所以发送之后,函数直接返回,不进行后续操作*
 
     如果五次循环过后,仍未获得有效响应数据,关闭链接,清理资源
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param command: 待发送的命令
     :param response_length: 因为设备返回的响应数据不遵循标准,所以需要根据协议手动获取有效响应数据
-    :param response_type: 期望的响应数据的类型,用来检查响应数据是否是上报信息
+    :param response_type: 期望的响应数据的类型,读事件监视器根据这个类型把响应交给当前函数
     :param times: 循环发送命令的次数,默认值`5`
     :return: 如果一切正常,返回有效响应数据;如果指定循环次数过后,仍未获得有效响应数据,返回`None`
 
     """
 
-    for _ in xrange(times):
+    frame = set_checksum(command)
 
-        try:
+    kind = command[4:6]
 
-            socket.send(set_checksum(command))
+    for attempt in xrange(times):
 
-        except:
+        if attempt:
 
-            cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+            COMMAND_RETRIES_BY_TYPE[kind].inc()
 
-            logging.debug(cursor._last_executed)
+        begin = time.time()
 
-            logging.critical(sys.exc_info()[1][1])
+        result = session.expect(response_type) if response_type else None
 
-            cursor.close()
+        try:
+
+            session.send(frame)
+
+        except:
 
-            connection.close()
+            logging.critical(sys.exc_info()[1][1])
 
-            socket.close()
+            session.close("error")
 
             return
 
@@ -235,94 +345,117 @@ def send_command(MAC, socket, connection, cursor, command, response_length=0, re
 
             return
 
-        else:
+        logging.info("%s 尝试接收数据", MAC)
 
-            while 1:
+        response = result.wait(socket.getdefaulttimeout())
 
-                logging.info("%s 尝试接收数据" % MAC)
+        if not result.ready():
 
-                try:
+            session.forget(response_type, result)
 
-                    response = socket.recv(4096)
+            continue
 
-                except gevent.socket.timeout:
+        logging.info("%s 发送 %s", MAC, Hex(response[:response_length]))
 
-                    break
+        if not response:
 
-                except gevent.socket.error:
+            logging.critical("%s 设备返回空值", MAC)
 
-                    cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+            session.close("empty")
 
-                    logging.debug(cursor._last_executed)
+            return
 
-                    logging.critical(sys.exc_info()[1][1])
+        if not get_checksum(response[:response_length]):
 
-                    cursor.close()
+            logging.error("%s 响应校验出错", MAC)
 
-                    connection.close()
+            continue
 
-                    socket.close()
+        COMMAND_SECONDS_BY_TYPE[kind].observe(time.time() - begin)
 
-                    return
+        return translate(response, "client")[3:-1]
 
-                logging.info("%s 发送 %s" % (MAC, str(hexlify(response[:response_length]))))
+    logging.critical("%s 等待响应超时", MAC)
 
-                if response:
+    session.close("timeout")
 
-                    data = translate(response, "client")
+    return None
 
-                    if data[2] != response_type:
 
-                        handle_report(MAC, socket, connection, cursor, response)
+def send_batch(MAC, session, commands):
 
-                        break
+    """把多条命令一次性连续写入链接,按照响应类型匹配陆续到达的响应
 
-                    else:
+    只发送一次,所有响应共用一个超时时间,没有收到或者校验失败的响应不在返回结果中,由调用者决定是否单独重试
 
-                        if not get_checksum(response[:response_length]):
+    :param MAC: 设备的物理地址(唯一标志)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
+    :param commands: 由(待发送的命令, 响应长度, 响应类型)组成的列表,响应类型不能重复
+    :return: 响应类型到有效响应数据的字典;如果链接出错,返回空字典并关闭链接
 
-                            logging.error("%s 响应校验出错" % MAC)
+    """
 
-                            break
+    results = [(command[4:6], length, response_type, session.expect(response_type)) for command, length, response_type in commands]
 
-                        else:
+    try:
 
-                            return data[3:-1]
-                else:
+        session.send(''.join(set_checksum(command) for command, _, _ in commands))
 
-                    cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+    except:
 
-                    logging.debug(cursor._last_executed)
+        logging.critical(sys.exc_info()[1][1])
 
-                    logging.critical("%s 设备返回空值" % MAC)
+        session.close("error")
 
-                    cursor.close()
+        return {}
 
-                    connection.close()
+    logging.info("%s 批量接收数据", MAC)
 
-                    socket.close()
+    begin = time.time()
 
-                    return
+    deadline = begin + socket.getdefaulttimeout()
 
-    cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+    responses = {}
 
-    logging.debug(cursor._last_executed)
+    for kind, length, response_type, result in results:
 
-    logging.critical("%s 等待响应超时" % MAC)
+        response = result.wait(max(deadline - time.time(), 0))
 
-    cursor.close()
+        if not result.ready():
 
-    connection.close()
+            session.forget(response_type, result)
 
-    socket.close()
+            continue
 
-    return None
+        logging.info("%s 发送 %s", MAC, Hex(response[:length]))
+
+        if not response:
+
+            logging.critical("%s 设备返回空值", MAC)
+
+            session.close("empty")
+
+            return {}
+
+        if not get_checksum(response[:length]):
+
+            logging.error("%s 响应校验出错", MAC)
+
+            continue
+
+        COMMAND_SECONDS_BY_TYPE[kind].observe(time.time() - begin)
+
+        responses[response_type] = translate(response, "client")[3:-1]
+
+    return responses
 
 
 def return_status(key, code, msg):
 
     """返回设备执行用户命令的结果
 
+    结果放入以命令标志命名的列表并且设置`RESULT_TTL`过期时间,同时发布到`RESULT_CHANNEL`频道,三个操作在一个管道中一次发送.订阅频道的后台立刻得到结果;没有订阅的后台仍然可以阻塞等待(`BLPOP`)这个列表,放弃等待的命令的结果会自动删除
+
     :param key: 用户命令唯一标志
     :param code: 执行结果的状态,`0` 表示执行成功,`1` 表示执行错误
     :param msg: 执行结果的信息
@@ -330,44 +463,69 @@ def return_status(key, code, msg):
 
     """
 
-    redis_client.rpush(key, json.dumps({"code": code, "msg": msg}))
+    begin = time.time()
+
+    pipe = redis_client.pipeline(transaction=False)
+
+    pipe.rpush(key, json.dumps({"code": code, "msg": msg}))
+
+    pipe.expire(key, RESULT_TTL)
 
+    pipe.publish(RESULT_CHANNEL, json.dumps({"id": key, "code": code, "msg": msg}))
 
-def test_connection(MAC, socket, connection, cursor):
+    pipe.execute()
+
+    RETURN_STATUS_SECONDS.observe(time.time() - begin)
+
+
+def reject_task(MAC, task):
+
+    """会话的命令通道已满时返回用户命令执行失败,由命令分发器调用
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param task: 被拒绝的命令(字符串)
+    :return: 无返回值
+
+    """
+
+    task = ast.literal_eval(task)
+
+    if "id" in task:
+
+        return_status(task["id"], 1, "%s 命令队列已满" % MAC)
+
+
+def test_connection(MAC, session):
 
     """设备上电连接至服务器，服务器端立刻发送这个命令，并且打开蜂鸣器一声响，提示用户设备已经连接至服务器
 
     由于设备问题时常断连,然后重连,现在只在新的设备首次发起链接之时发送这个命令
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
     """
 
     command = "f5aa010001"
 
-    response = send_command(MAC, socket, connection, cursor, command, 5, 1)
+    response = send_command(MAC, session, command, 5, 1)
 
     if type(response) == list:
 
-        logging.info("%s 测试链接成功" % MAC)
+        logging.info("%s 测试链接成功", MAC)
 
     else:
 
-        logging.critical("%s 测试链接失败" % MAC)
+        logging.critical("%s 测试链接失败", MAC)
 
 
-def heartbeat(MAC, socket, connection, cursor, task={}):
+def heartbeat(MAC, session, task={}):
 
     """心跳命令,检测设备是否在线,每一分钟检测一次,这个命令后台生成,属于监控设备状态的命令之一
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 由于这个命令后台生成,所以`task`为空
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -375,29 +533,38 @@ def heartbeat(MAC, socket, connection, cursor, task={}):
 
     command = "f5aa010000"
 
-    response = send_command(MAC, socket, connection, cursor, command, 5, 1)
+    response = send_command(MAC, session, command, 5, 1)
 
-    if type(response) == list:
+    on_heartbeat(MAC, response)
 
-        cursor.execute("UPDATE device SET online = 1 WHERE mac = %s", MAC)
 
-        logging.debug(cursor._last_executed)
+def on_heartbeat(MAC, response):
 
-        logging.info("%s 心跳测试成功" % MAC)
+    """处理心跳命令的响应,单独发送命令和批量发送命令(参见`probe`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
+
+    if type(response) == list:
+
+        state_writer.update(MAC, online=1)
+
+        logging.info("%s 心跳测试成功", MAC)
 
     else:
 
-        logging.critical("%s 心跳测试失败" % MAC)
+        logging.critical("%s 心跳测试失败", MAC)
 
 
-def check_status(MAC, socket, connection, cursor, task={}):
+def check_status(MAC, session, task={}):
 
     """检查加热器当前状态的命令,每一分钟检测一次,这个命令后台生成,属于监控设备状态的命令之一
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 由于这个命令后台生成,所以`task`为空
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -405,7 +572,20 @@ def check_status(MAC, socket, connection, cursor, task={}):
 
     command = "f5aa030000"
 
-    response = send_command(MAC, socket, connection, cursor, command, 8, 3)
+    response = send_command(MAC, session, command, 8, 3)
+
+    on_status(MAC, response)
+
+
+def on_status(MAC, response):
+
+    """处理检查加热器当前状态命令的响应,单独发送命令和批量发送命令(参见`probe`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
 
     if type(response) == list:
 
@@ -413,53 +593,45 @@ def check_status(MAC, socket, connection, cursor, task={}):
 
             if response[1] == 0:
 
-                cursor.execute("UPDATE device SET power = %s WHERE mac = %s", (0, MAC))
+                state_writer.update(MAC, power=0)
 
             else:
 
-                cursor.execute("UPDATE device SET power = %s WHERE mac = %s", (response[2], MAC))
-
-            logging.debug(cursor._last_executed)
+                state_writer.update(MAC, power=response[2])
 
-            logging.info("%s 开关状态: %s; 应开时间: %s; 已开时间: %s" % (MAC, response[1], response[2], response[3]))
+            logging.info("%s 开关状态: %s; 应开时间: %s; 已开时间: %s", MAC, response[1], response[2], response[3])
 
         elif response[0] == 1:
 
-            logging.error("%s 命令校验出错" % MAC)
+            logging.error("%s 命令校验出错", MAC)
 
         elif response[0] == 2:
 
-            cursor.execute("UPDATE device SET dosage = -1 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, dosage=-1)
 
-            logging.warning("%s 药水已被拔出" % MAC)
+            logging.warning("%s 药水已被拔出", MAC)
 
         elif response[0] == 3:
 
-            cursor.execute("UPDATE device SET dosage = 0 WHERE mac = %s", MAC)
+            state_writer.update(MAC, dosage=0)
 
-            logging.debug(cursor._last_executed)
-
-            logging.warning("%s 药水已经用完" % MAC)
+            logging.warning("%s 药水已经用完", MAC)
 
         elif response[0] == 4:
 
-            logging.error("%s 读取药水错误" % MAC)
+            logging.error("%s 读取药水错误", MAC)
 
     else:
 
-        logging.critical("%s 状态查询失败" % MAC)
+        logging.critical("%s 状态查询失败", MAC)
 
 
-def turnon(MAC, socket, connection, cursor, task):
+def turnon(MAC, session, task):
 
     """打开加热器的命令,这个命令由用户通过移动应用发送,发送该命令的时候需要指定加热时长
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 打开加热器命令的具体内容(json类型)
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -467,7 +639,7 @@ def turnon(MAC, socket, connection, cursor, task):
 
     if task["time"] not in [1, 2, 3, 4, 5, 6, 7, 8]:
 
-        logging.error("%s 加热持续时间超出预定范围" % MAC)
+        logging.error("%s 加热持续时间超出预定范围", MAC)
 
         return_status(task["id"], 1, "%s 加热持续时间超出预定范围" % MAC)
 
@@ -475,67 +647,73 @@ def turnon(MAC, socket, connection, cursor, task):
 
     command = "f5aa0301" + '0' + str(task["time"])
 
-    response = send_command(MAC, socket, connection, cursor, command, 8, 3)
+    response = send_command(MAC, session, command, 8, 3)
+
+    on_turnon(MAC, task, response)
+
+
+def on_turnon(MAC, task, response):
+
+    """处理打开加热器命令的响应,返回执行结果,`gevent`引擎和`asyncio`引擎(参见`engine`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param task: 打开加热器命令的具体内容(json类型)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
 
     if type(response) == list:
 
         if response[0] == 0:
 
-            cursor.execute("UPDATE device SET power = %s WHERE mac = %s", (task["time"], MAC))
-
-            logging.debug(cursor._last_executed)
+            state_writer.commit(MAC, power=task["time"])
 
-            logging.info("%s 设备已经打开" % MAC)
+            logging.info("%s 设备已经打开", MAC)
 
             return_status(task["id"], 0, "%s 设备已经打开" % MAC)
 
         elif response[0] == 1:
 
-            logging.error("%s 命令校验出错" % MAC)
+            logging.error("%s 命令校验出错", MAC)
 
             return_status(task["id"], 1, "%s 命令校验出错" % MAC)
 
         elif response[0] == 2:
 
-            cursor.execute("UPDATE device SET dosage = -1 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, dosage=-1)
 
-            logging.warning("%s 药水已被拔出" % MAC)
+            logging.warning("%s 药水已被拔出", MAC)
 
             return_status(task["id"], 1, "%s 药水已被拔出" % MAC)
 
         elif response[0] == 3:
 
-            cursor.execute("UPDATE device SET dosage = 0 WHERE mac = %s", MAC)
+            state_writer.update(MAC, dosage=0)
 
-            logging.debug(cursor._last_executed)
-
-            logging.warning("%s 药水已经用完" % MAC)
+            logging.warning("%s 药水已经用完", MAC)
 
             return_status(task["id"], 1, "%s 药水已经用完" % MAC)
 
         elif response[0] == 4:
 
-            logging.error("%s 读取药水错误" % MAC)
+            logging.error("%s 读取药水错误", MAC)
 
             return_status(task["id"], 1, "%s 读取药水错误" % MAC)
 
     else:
 
-        logging.critical("%s 设备开启失败" % MAC)
+        logging.critical("%s 设备开启失败", MAC)
 
         return_status(task["id"], 1, "%s 设备开启失败" % MAC)
 
 
-def turnof(MAC, socket, connection, cursor, task):
+def turnof(MAC, session, task):
 
     """关闭加热器的命令,这个命令由用户通过移动应用发送
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 关闭加热器命令的具体内容(json类型)
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -543,90 +721,125 @@ def turnof(MAC, socket, connection, cursor, task):
 
     command = "f5aa030100"
 
-    response = send_command(MAC, socket, connection, cursor, command, 8, 3)
+    response = send_command(MAC, session, command, 8, 3)
+
+    on_turnof(MAC, task, response)
+
+
+def on_turnof(MAC, task, response):
+
+    """处理关闭加热器命令的响应,返回执行结果,`gevent`引擎和`asyncio`引擎(参见`engine`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param task: 关闭加热器命令的具体内容(json类型)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
 
     if type(response) == list:
 
         if response[0] == 0:
 
-            cursor.execute("UPDATE device SET power = 0 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.commit(MAC, power=0)
 
-            logging.info("%s 设备已经关闭" % MAC)
+            logging.info("%s 设备已经关闭", MAC)
 
             return_status(task["id"], 0, "%s 设备已经关闭" % MAC)
 
         elif response[0] == 1:
 
-            logging.error("%s 命令校验出错" % MAC)
+            logging.error("%s 命令校验出错", MAC)
 
             return_status(task["id"], 1, "%s 命令校验出错" % MAC)
 
         elif response[0] == 2:
 
-            cursor.execute("UPDATE device SET dosage = -1 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, dosage=-1)
 
-            logging.warning("%s 药水已被拔出" % MAC)
+            logging.warning("%s 药水已被拔出", MAC)
 
             return_status(task["id"], 1, "%s 药水已被拔出" % MAC)
 
         elif response[0] == 3:
 
-            cursor.execute("UPDATE device SET dosage = 0 WHERE mac = %s", MAC)
+            state_writer.update(MAC, dosage=0)
 
-            logging.debug(cursor._last_executed)
-
-            logging.warning("%s 药水已经用完" % MAC)
+            logging.warning("%s 药水已经用完", MAC)
 
             return_status(task["id"], 1, "%s 药水已经用完" % MAC)
 
         elif response[0] == 4:
 
-            logging.error("%s 读取药水错误" % MAC)
+            logging.error("%s 读取药水错误", MAC)
 
             return_status(task["id"], 1, "%s 读取药水错误" % MAC)
 
     else:
 
-        logging.critical("%s 设备关闭失败" % MAC)
+        logging.critical("%s 设备关闭失败", MAC)
 
         return_status(task["id"], 1, "%s 设备关闭失败" % MAC)
 
 
-def delete(MAC, socket, connection, cursor, task):
+def delete(MAC, session, task):
 
-    """删除设备命令,这个命令由用户通过移动应用发送,从全局变量`greenlets`以及数据库删除这个设备
+    """删除设备命令,这个命令由用户通过移动应用发送,从会话注册表以及数据库删除这个设备
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 删除设备命令的具体内容(json类型)
     :return: 无返回值
 
     """
 
-    del greenlets[MAC]
+    dispatcher.unregister(session)
+
+    sessions.remove(session)
 
-    cursor.execute("DELETE FROM device WHERE mac = %s", MAC)
+    remove_device(MAC, task)
 
-    logging.debug(cursor._last_executed)
+    session.close("delete")
 
-    logging.info("%s 设备已被删除" % MAC)
+
+def remove_device(MAC, task):
+
+    """从数据库删除设备并返回执行结果,`gevent`引擎和`asyncio`引擎(参见`engine`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param task: 删除设备命令的具体内容(json类型)
+    :return: 无返回值
+
+    """
+
+    state_writer.discard(MAC)
+
+    mysql_pool.execute("DELETE FROM device WHERE mac = %s", MAC, idempotent=True)
+
+    logging.info("%s 设备已被删除", MAC)
 
     return_status(task["id"], 0, "%s 设备已被删除" % MAC)
 
-    cursor.close()
 
-    connection.close()
+def offline(MAC, session, task):
+
+    """断开设备链接的控制命令,由其它组件(例如后台管理程序)发送,代替直接修改数据库中的`online`字段
+
+    会话关闭之后,`handle`把设备从会话注册表注销,同时把`online`字段更新为`0`
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
+    :param task: 断开链接命令的具体内容(json类型)
+    :return: 无返回值
+
+    """
+
+    logging.info("%s 设备被要求下线", MAC)
 
-    socket.close()
+    session.close("offline")
 
 
-def read_temperature_humidity(MAC, socket, connection, cursor, task={}):
+def read_temperature_humidity(MAC, session, task={}):
 
     """读取设备所处环境的温度和湿度的命令,每一分钟读取一次,这个命令后台生成,属于监控设备状态的命令之一
 
@@ -635,9 +848,7 @@ def read_temperature_humidity(MAC, socket, connection, cursor, task={}):
     其中温度等于`-273`和湿度等于`0`表示传感器有故障
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 由于这个命令后台生成,所以`task`为空
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -645,7 +856,20 @@ def read_temperature_humidity(MAC, socket, connection, cursor, task={}):
 
     command = "f5aa04"
 
-    response = send_command(MAC, socket, connection, cursor, command, 9, 4)
+    response = send_command(MAC, session, command, 9, 4)
+
+    on_temperature_humidity(MAC, response)
+
+
+def on_temperature_humidity(MAC, response):
+
+    """处理读取温度和湿度命令的响应,单独发送命令和批量发送命令(参见`probe`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
 
     if type(response) == list:
 
@@ -665,30 +889,26 @@ def read_temperature_humidity(MAC, socket, connection, cursor, task={}):
 
             humidity = (response[3] * 256 + response[4]) / float(10)
 
-            cursor.execute("UPDATE device SET temperature = %s, humidity = %s WHERE mac = %s", (temperature, humidity, MAC))
+            state_writer.update(MAC, temperature=temperature, humidity=humidity)
 
-            logging.debug(cursor._last_executed)
-
-            logging.info("%s 温度湿度读取成功" % MAC)
+            logging.info("%s 温度湿度读取成功", MAC)
 
         elif response[0] == 1:
 
-            cursor.execute("UPDATE device SET temperature = -273, humidity = 0 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, temperature=-273, humidity=0)
 
-            logging.error("%s 传感器有故障" % MAC)
+            logging.error("%s 传感器有故障", MAC)
 
         elif response[0] == 2:
 
-            logging.error("%s 命令校验出错" % MAC)
+            logging.error("%s 命令校验出错", MAC)
 
     else:
 
-        logging.critical("%s 温度湿度读取失败" % MAC)
+        logging.critical("%s 温度湿度读取失败", MAC)
 
 
-def read_remaining_potion(MAC, socket, connection, cursor, task={}):
+def read_remaining_potion(MAC, session, task={}):
 
     """读取剩余药量的命令,每一分钟读取一次,这个命令后台生成,属于监控设备状态的命令之一
 
@@ -697,9 +917,7 @@ def read_remaining_potion(MAC, socket, connection, cursor, task={}):
     其中药量等于`-1`表示并未插入药水
 
     :param MAC: 设备的物理地址(唯一标志)
-    :param socket: 设备和程序之间的链接
-    :param connection: 当前协程的数据库链接(每个协程使用独立的数据库链接)
-    :param cursor:  当前协程的数据库游标(每个协程使用独立的数据库游标)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
     :param task: 由于这个命令后台生成,所以`task`为空
     :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
 
@@ -707,7 +925,20 @@ def read_remaining_potion(MAC, socket, connection, cursor, task={}):
 
     command = "f5aa07"
 
-    response = send_command(MAC, socket, connection, cursor, command, 7, 7)
+    response = send_command(MAC, session, command, 7, 7)
+
+    on_remaining_potion(MAC, response)
+
+
+def on_remaining_potion(MAC, response):
+
+    """处理读取剩余药量命令的响应,单独发送命令和批量发送命令(参见`probe`)共用这个函数
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param response: `send_command`返回的有效响应数据,发送失败为`None`
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
 
     if type(response) == list:
 
@@ -719,55 +950,151 @@ def read_remaining_potion(MAC, socket, connection, cursor, task={}):
 
             remain = round(remain, 2)
 
-            cursor.execute("UPDATE device SET dosage = %s WHERE mac = %s", (remain, MAC))
+            state_writer.update(MAC, dosage=remain)
 
-            logging.debug(cursor._last_executed)
-
-            logging.info("%s 药量读取成功" % MAC)
+            logging.info("%s 药量读取成功", MAC)
 
         elif response[0] == 1:
 
-            logging.error("%s 命令校验出错" % MAC)
+            logging.error("%s 命令校验出错", MAC)
 
         elif response[0] == 2:
 
-            cursor.execute("UPDATE device SET dosage = -1 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, dosage=-1)
 
-            logging.warning("%s 药水已被拔出" % MAC)
+            logging.warning("%s 药水已被拔出", MAC)
 
         elif response[0] == 3:
 
-            cursor.execute("UPDATE device SET dosage = 0 WHERE mac = %s", MAC)
-
-            logging.debug(cursor._last_executed)
+            state_writer.update(MAC, dosage=0)
 
-            logging.warning("%s 药水已经用完" % MAC)
+            logging.warning("%s 药水已经用完", MAC)
 
         elif response[0] == 4:
 
-            logging.error("%s 读取药水错误" % MAC)
+            logging.error("%s 读取药水错误", MAC)
 
     else:
 
-        logging.critical("%s 药量读取失败" % MAC)
+        logging.critical("%s 药量读取失败", MAC)
+
+
+PROBES = {
+    2: ("f5aa010000", 5, 1, on_heartbeat),
+    4: ("f5aa04", 9, 4, on_temperature_humidity),
+    6: ("f5aa030000", 8, 3, on_status),
+    7: ("f5aa07", 7, 7, on_remaining_potion),
+}
+"""dict: 监控命令类型到(命令, 响应长度, 响应类型, 响应处理函数)的映射,四种监控命令的响应类型互不相同,可以批量发送"""
+
+
+def probe(MAC, session, task):
+
+    """批量监控命令,一次性发送`task["probes"]`中的所有监控命令,这个命令由`monitor`生成,或者由进程内轮询器直接放入会话(参见`POLL_IN_SERVER`)
+
+    如果会话允许批量发送(参见`PROBE_PIPELINE`),所有命令连续写入链接,响应按照类型匹配,一个往返时间即可完成全部监控;没有收到有效响应的命令再单独发送重试.如果批量发送一个响应都没有收到,而单独发送收到了响应,说明设备固件不支持连续的帧,这个会话之后改为逐条发送.
+
+    所有响应收集完毕之后统一处理
+
+    :param MAC: 设备的物理地址(唯一标志)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
+    :param task: 批量监控命令的具体内容(json类型),`probes`为监控命令类型列表,默认为全部四种
+    :return: 根据响应数据,执行某项操作,无返回值(具体规则参见<<设备控制通信协议>>)
+
+    """
+
+    probes = [PROBES[kind] for kind in task.get("probes", sorted(PROBES)) if kind in PROBES]
+
+    responses = {}
+
+    pipelined = session.pipeline and len(probes) > 1
+
+    if pipelined:
+
+        responses = send_batch(MAC, session, [(command, length, response_type) for command, length, response_type, _ in probes])
+
+    batched = len(responses)
+
+    for command, length, response_type, _ in probes:
+
+        if session.closed:
+
+            return
+
+        if response_type not in responses:
+
+            response = send_command(MAC, session, command, length, response_type)
+
+            if response is not None:
+
+                responses[response_type] = response
+
+    if pipelined and not batched and responses:
+
+        logging.warning("%s 设备不支持批量发送,改为逐条发送", MAC)
+
+        session.pipeline = False
+
+    for _, _, response_type, apply in probes:
+
+        apply(MAC, responses.get(response_type))
+
+
+def inspect_sessions():
+
+    """协程状态查看: 所有在线会话正在执行的命令,正在等待的响应类型以及等待的秒数
+
+    :return: (内容类型, JSON)
+
+    """
+
+    return "application/json", json.dumps(sessions.snapshot(), indent=1)
+
+
+def inspect_stacks():
+
+    """协程状态查看: 所有协程的当前调用栈
+
+    :return: (内容类型, 文本)
+
+    """
+
+    return "text/plain", '\n'.join("--- %s\n%s" % item for item in watchdog.stacks())
+
+
+def inspect_blocks():
+
+    """协程状态查看: 最近几次阻塞事件循环的协程,阻塞的秒数以及调用栈
+
+    :return: (内容类型, JSON)
+
+    """
+
+    return "application/json", json.dumps(list(watchdog.blocks), indent=1)
+
+
+route("/sessions", inspect_sessions)
+
+route("/stacks", inspect_stacks)
+
+route("/blocks", inspect_blocks)
 
 
 def handle(socket, address):
 
     """每个协程运行的主函数,每当某个设备发起链接,服务器创建一个新的协程运行该函数
 
-    这个函数首先检测是否是有效设备发起的链接,正常设备发起链接,首先需要上报该设备的物理地址,通过这个检测之后,然后使用全局变量`greenlets`以及数据库来确定该设备的具体情况
+    这个函数首先检测是否是有效设备发起的链接,正常设备发起链接,首先需要上报该设备的物理地址,通过这个检测之后,新建会话并且注册,如果这个设备已经有会话(链接断开之后还没有被发现),新的会话接管原来的会话,原来的会话立刻关闭并且释放全部资源,然后使用会话注册表以及数据库来确定该设备的具体情况
 
     接下来是这个函数的主要部分: 一个无限循环,在循环过程中转发用户命令,监控设备状态,处理设备上报信息
 
     单次循环具体流程描述如下:
 
-        首先检查`redis`是否含有发向当前设备的命令:
+        等待命令分发器放入命令或者读事件监视器放入上报信息:
 
-            如果有,执行相应命令;
-            如果没有,则尝试接收设备的上报信息(具体流程参见`send_command`);
+            如果有命令,执行相应命令(等待响应期间到达的上报信息留在上报队列中);
+            如果没有命令,但是进程内轮询器放入了到期的监控命令,批量执行这些监控命令(参见`probe`);
+            否则处理设备的上报信息;
             执行下次循环;
 
     :param socket: 设备和程序之间的链接
@@ -776,7 +1103,9 @@ def handle(socket, address):
 
     """
 
-    logging.info("设备接入: %s" % socket)
+    ACCEPTS.inc()
+
+    logging.info("设备接入: %s", socket)
 
     try:
 
@@ -788,200 +1117,339 @@ def handle(socket, address):
 
         logging.critical("接收数据失败")
 
+        DISCONNECTS.labels("handshake").inc()
+
         socket.close()
 
         return
 
     if not re.match("[0-9A-F]{12}", MAC):
 
-        logging.critical("物理地址无效: %s" % MAC)
+        logging.critical("物理地址无效: %s", MAC)
+
+        DISCONNECTS.labels("handshake").inc()
 
         socket.close()
 
         return
 
-    logging.info("物理地址: %s" % MAC)
+    logging.info("物理地址: %s", MAC)
 
     # time.sleep(2)
     #
     # logging.info("发送测试命令: %s" % MAC)  #
     #
-    # test_connection(MAC, socket, connection, cursor)  #
+    # test_connection(MAC, session)  #
 
-    connection = pymysql.connect(host="", user="", passwd="", db="")
+    session = Session(MAC, socket, QUEUE_LIMIT)
 
-    connection.autocommit(1)
+    session.pipeline = PROBE_PIPELINE and MAC not in PROBE_SEQUENTIAL
 
-    cursor = connection.cursor()
+    session.start(SEND_TIMEOUT)
 
-    if MAC not in greenlets:
+    watchdog.name(gevent.getcurrent(), MAC)
 
-        greenlets[MAC] = gevent.getcurrent()
+    replaced = sessions.add(session)
 
-        cursor.execute("SELECT id FROM device WHERE mac = %s", MAC)
+    # 会话已经注册并且开始读取,之后任何一步失败(例如`redis`不可用时取得所有权失败)都要经过下面的清理,否则链接和读事件监视器泄漏,设备一直显示在线
 
-        logging.debug(cursor._last_executed)
+    try:
 
-        if not cursor.fetchall():
+        if replaced is not None:
 
-            logging.info("新的设备: %s" % MAC)
+            TAKEOVERS.inc()
 
-            logging.info("发送测试命令: %s" % MAC)  #
+            logging.warning("%s 重新接入,接管原来的会话", MAC)
 
-            test_connection(MAC, socket, connection, cursor)  #
+            session.adopt(replaced)
 
-            current_time = str(datetime.now()).split('.')[0]
+            replaced.terminate("replaced")
 
-            cursor.execute("INSERT INTO device (mac, online, ctime, utime, ip) VALUES (%s, %s, %s, %s, %s)", (MAC, 1, current_time, current_time, address[0]))
+        if CLUSTER_DIRECTORY:
 
-            logging.debug(cursor._last_executed)
+            directory.claim(session)
 
-        else:
+        dispatcher.register(session)
 
-            logging.info("程序重启")
+        if POLL_IN_SERVER:
 
-            cursor.execute("UPDATE device SET online = 1 WHERE mac = %s", MAC)
+            poller.add(session)
 
-            logging.debug(cursor._last_executed)
+        serve(MAC, session, address, replaced)
 
-    else:
+    finally:
 
-        greenlets[MAC] = gevent.getcurrent()
+        session.close()
 
-        logging.info("旧的设备: %s" % MAC)
+        dispatcher.unregister(session)
 
-        cursor.execute("UPDATE device SET online = 1 WHERE mac = %s", MAC)
+        dispatcher.requeue(session)
 
-        logging.debug(cursor._last_executed)
+        DISCONNECTS.labels(session.reason or "closed").inc()
 
-    while 1:
+        owned = directory.release(session) if CLUSTER_DIRECTORY else True
 
-        connection.ping()
+        if sessions.remove(session):
 
-        task = redis_client.rpop(MAC)
+            try:
 
-        if not task:
+                if owned:
 
-            cursor.execute("SELECT online FROM device WHERE mac = %s", MAC)
+                    state_writer.commit(MAC, online=0)
 
-            logging.debug(cursor._last_executed)
+            finally:
 
-            online = cursor.fetchone()[0]
+                # 失去所有权(被其它进程驱逐或者接管)时尚未写入的状态已经过时,不能在下次批量写入时覆盖新的所有者写入的值
+                state_writer.forget(MAC, not owned)
 
-            logging.info("%s 设备当前状态: %s" % (MAC, online))
 
-            if online:
+def known_device(MAC):
 
-                logging.info("%s 尝试接收数据" % MAC)
+    """
 
-                try:
+    :param MAC: 设备的物理地址(唯一标志)
+    :return: 数据库中已经有这个设备返回`True`
 
-                    data = socket.recv(4096)
+    """
 
-                except gevent.socket.timeout:
+    return bool(mysql_pool.execute("SELECT id FROM device WHERE mac = %s", MAC, idempotent=True))
 
-                    continue
 
-                except gevent.socket.error:
+def register_device(MAC, ip):
 
-                    cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+    """把新的设备写入数据库,状态为在线
 
-                    logging.debug(cursor._last_executed)
+    :param MAC: 设备的物理地址(唯一标志)
+    :param ip: 设备的`IP`地址
+    :return: 无返回值
 
-                    logging.critical(sys.exc_info()[1][1])
+    """
 
-                    cursor.close()
+    current_time = str(datetime.now()).split('.')[0]
 
-                    connection.close()
+    mysql_pool.execute("INSERT INTO device (mac, online, ctime, utime, ip) VALUES (%s, %s, %s, %s, %s)", (MAC, 1, current_time, current_time, ip))
 
-                    socket.close()
 
-                    return
+def serve(MAC, session, address, replaced=None):
 
-                logging.info("%s 发送 %s" % (MAC, data))
+    """处理已经通过物理地址检测的设备链接
 
-                if data:
+    首先使用会话注册表以及数据库来确定该设备的具体情况,然后等待命令或者设备数据到达,用户命令以及控制命令优先,然后是合并之后的监控命令,最后处理上报信息
 
-                    handle_report(MAC, socket, connection, cursor, data)
+    :param MAC: 设备的物理地址(唯一标志)
+    :param session: 设备会话(包含设备和程序之间的链接以及命令队列)
+    :param address: 设备具体`IP`地址以及端口
+    :param replaced: 这个设备在会话注册表中的上一个会话,如果不为`None`,设备已经在线,无需更新`online`字段
+    :return: 无返回值
 
-                else:
+    """
 
-                    cursor.execute("UPDATE device SET online = 0 WHERE mac = %s", MAC)
+    if replaced is None:
 
-                    logging.debug(cursor._last_executed)
+        if not known_device(MAC):
 
-                    logging.critical("设备返回空值")
+            logging.info("新的设备: %s", MAC)
 
-                    cursor.close()
+            logging.info("发送测试命令: %s", MAC)  #
 
-                    connection.close()
+            test_connection(MAC, session)  #
 
-                    socket.close()
+            register_device(MAC, address[0])
 
-                    return
+        else:
 
-            else:
+            logging.info("旧的设备: %s", MAC)
 
-                logging.critical("设备已经离线")
+            state_writer.commit(MAC, online=1)
 
-                cursor.close()
+    else:
 
-                connection.close()
+        logging.info("旧的设备重新接入: %s", MAC)
 
-                socket.close()
+    while not session.closed:
 
-                return
+        session.wait()
 
-        else:
+        if session.tasks:
 
-            task = ast.literal_eval(task)
+            task = session.tasks.pop(0)
 
-            logging.info("命令: %s" % str(task))
+            logging.info("%s 命令: %s", MAC, task)
 
-            if task["type"] == -1:
+            session.task = task
 
-                delete(MAC, socket, connection, cursor, task)
+            session.task_started = time.time()
+
+            if task["type"] == -2:
+
+                offline(MAC, session, task)
 
                 return
 
-            elif task["type"] == 0:
+            elif task["type"] == -1:
 
-                turnof(MAC, socket, connection, cursor, task)
+                delete(MAC, session, task)
 
-                continue
+                return
 
-            elif task["type"] == 1:
+            elif task["type"] == 0:
 
-                turnon(MAC, socket, connection, cursor, task)
+                turnof(MAC, session, task)
 
-                continue
+            elif task["type"] == 1:
+
+                turnon(MAC, session, task)
 
             elif task["type"] == 2:
 
-                heartbeat(MAC, socket, connection, cursor, task)
+                heartbeat(MAC, session, task)
 
-                continue
+            elif task["type"] == 5:
 
-            elif task["type"] == 4:
+                probe(MAC, session, task)
 
-                read_temperature_humidity(MAC, socket, connection, cursor, task)
+            elif task["type"] == 4:
 
-                continue
+                read_temperature_humidity(MAC, session, task)
 
             elif task["type"] == 6:
 
-                check_status(MAC, socket, connection, cursor, task)
-
-                continue
+                check_status(MAC, session, task)
 
             elif task["type"] == 7:
 
-                read_remaining_potion(MAC, socket, connection, cursor, task)
+                read_remaining_potion(MAC, session, task)
+
+            session.task = None
+
+        elif session.probes:
+
+            task = {"type": 5, "probes": sorted(session.probes)}
+
+            session.probes.clear()
+
+            session.task = task
+
+            session.task_started = time.time()
+
+            probe(MAC, session, task)
+
+            session.task = None
+
+        elif session.reports:
+
+            data = session.reports.pop(0)
+
+            logging.info("%s 发送 %s", MAC, Hex(data))
+
+            if data:
+
+                handle_report(MAC, session, data)
+
+            else:
+
+                logging.critical("%s 设备返回空值", MAC)
+
+                session.close("empty")
+
+                return
+
+
+def run(index=None, listener=None):
+
+    """启动服务,单进程模式直接调用,多进程模式由`prefork.Supervisor`在每个工作进程中调用
+
+    多进程模式下每个工作进程的指标端口为`METRICS_PORT + 1 + index`(主进程在`METRICS_PORT`汇总),遥测数据历史记录写入各自的文件
 
-                continue
+    :param index: 工作进程编号,单进程模式为`None`
+    :param listener: 从主进程继承的监听链接,多进程模式下为`None`时使用`SO_REUSEPORT`自己监听
+    :return: 无返回值
+
+    """
+
+    if index is None:
+
+        server = StreamServer(("0.0.0.0", 9009), handle, backlog=256, spawn=65536)
+
+    else:
+
+        server = StreamServer(listener or listen(("0.0.0.0", 9009), 256, True), handle, spawn=65536)
+
+        history.worker = index
+
+    if CLUSTER_DIRECTORY:
+
+        dispatcher.inbox = directory.inbox
+
+        directory.start()
+
+    dispatcher.start()
+
+    if METRICS_PORT:
+
+        serve_metrics(METRICS_PORT if index is None else METRICS_PORT + 1 + index)
+
+    if WATCHDOG_THRESHOLD:
+
+        watchdog.start()
+
+    if POLL_IN_SERVER:
+
+        poller.start()
+
+    gevent.signal(signal.SIGTERM, server.stop)
+
+    gevent.signal(signal.SIGINT, server.stop)
+
+    state_writer.start()
+
+    history.start()
+
+    server.serve_forever()
+
+    state_writer.close()
+
+    history.close()
+
+
+def run_asyncio(index=None, listener=None):
+
+    """使用`asyncio`引擎启动服务(参见`engine`),参数与`run`相同
+
+    :param index: 工作进程编号,单进程模式为`None`
+    :param listener: 从主进程继承的监听链接,多进程模式下为`None`时使用`SO_REUSEPORT`自己监听
+    :return: 无返回值
+
+    """
+
+    from userver.engine import AsyncServer
+
+    if index is not None:
+
+        listener = listener or listen(("0.0.0.0", 9009), 256, True)
+
+        history.worker = index
+
+    AsyncServer(sys.modules[__name__], ("0.0.0.0", 9009), 256).run(listener, METRICS_PORT if index is None else METRICS_PORT + 1 + index)
 
 
 if __name__ == "__main__":
 
-    StreamServer(("0.0.0.0", 9009), handle, backlog=256, spawn=65536).serve_forever()
+    target = run_asyncio if ENGINE == "asyncio" else run
+
+    if ENGINE == "asyncio":
+
+        from userver.engine import unsupported
+
+        # 在创建工作进程之前检查,否则主进程会不断重启启动失败的工作进程
+        if unsupported(sys.modules[__name__]):
+
+            sys.exit("asyncio引擎不支持 %s,需要在userver中关闭" % ", ".join(unsupported(sys.modules[__name__])))
+
+    if PREFORK_WORKERS == 1:
+
+        target()
+
+    else:
 
+        Supervisor(PREFORK_WORKERS or os.sysconf("SC_NPROCESSORS_ONLN"), target, ("0.0.0.0", 9009), 256, PREFORK_REUSEPORT, PREFORK_AFFINITY, METRICS_PORT).run()
@@ -1,53 +1,548 @@
 # -*- coding: utf-8 -*-
 
+"""test
+
+设备模拟器以及负载测试工具
+
+模拟器实现<<设备控制通信协议>>的设备一端: 接入之后上报物理地址,回复心跳,测试链接,状态查询,打开/关闭,温度湿度以及药量命令(带有正确的校验和,收到校验错误的命令时按照协议回复校验出错),并且不定期发送上报信息(按键,药水用完,药水更新,读取药水错误).每台模拟设备可以配置响应延迟,延迟抖动,丢弃命令的比例,以及平均多长时间断开重连一次.
+
+驱动器通过`redis`向模拟设备发送用户命令(打开或者关闭),阻塞等待`tcp_server`返回的执行结果,统计吞吐量以及从放入命令到取得结果的耗时分布.
+
+运行方法:
+
+    # 只运行模拟器,1000台设备,响应延迟50毫秒,抖动20毫秒,丢弃1%的命令,平均每300秒重连一次
+    python test.py simulate --devices 1000 --latency 0.05 --jitter 0.02 --drop 0.01 --churn 300
+
+    # 只运行驱动器,向同样的1000台设备发送命令
+    python test.py drive --devices 1000 --concurrency 50 --duration 60
+
+    # 模拟器和驱动器运行在同一个进程
+    python test.py run --devices 1000 --concurrency 50 --duration 60
+
+    # 驱动器订阅结果频道,不再阻塞等待每条命令的结果列表
+    python test.py drive --devices 1000 --notify
+
+模拟设备的物理地址为`--prefix`加上六位十六进制序号,模拟器和驱动器使用相同的`--prefix`以及`--devices`即可对应
+
+"""
+
 import sys
-import gevent
-import socket
+import json
+import time
+import uuid
 import random
-import string
+import argparse
 
+import gevent
 import gevent.monkey
 
+from gevent.event import AsyncResult
+
 gevent.monkey.patch_all()
 
+import socket
+
+import redis
+
 sys.path.append("../")
 
 from userver import *
+from userver.codec import COMMAND_LENGTHS, FrameDecoder, checksum_ok, encode
 
-candidates = string.digits + "ABCDEF"
-"""string: 生成物理地址的候选集
+stats = dict.fromkeys(["connects", "failures", "disconnects", "commands", "responses", "dropped", "reports"], 0)
+"""dict: 所有模拟设备的累计统计: 接入次数,接入失败次数,断开次数,收到的命令数量,回复的响应数量,丢弃的命令数量,发送的上报信息数量"""
 
-使用这个集合产生符合验证规则的物理地址
+REPORTS = [(2, 0), (2, 1), (2, 2), (2, 3), (2, 4), (2, 0), (2, 1), (3, 0), (4, 0), (1, 0)]
+"""list: 上报信息的(事件类型, 按键)候选,按键事件占大多数"""
 
-"""
 
+def fleet(prefix, devices):
+
+    """
+
+    :param prefix: 物理地址前缀(六位十六进制)
+    :param devices: 设备数量
+    :return: 模拟设备的物理地址列表
+
+    """
+
+    return ["%s%06X" % (prefix, index) for index in xrange(devices)]
+
+
+class Device(object):
+
+    """一台模拟设备,保存开关状态,加热时长,已经使用的药量以及环境温度湿度"""
+
+    def __init__(self, MAC, address, latency=0.0, jitter=0.0, drop=0.0, churn=0.0, report=0.0):
+
+        """
+
+        :param MAC: 设备的物理地址
+        :param address: 服务器地址以及端口
+        :param latency: 响应延迟秒数
+        :param jitter: 延迟抖动秒数,实际延迟在`latency ± jitter`之间均匀分布
+        :param drop: 丢弃命令(不回复)的比例
+        :param churn: 平均每隔多少秒主动断开并且重新接入,`0`表示不断开
+        :param report: 平均每隔多少秒发送一条上报信息,`0`表示不发送
+
+        """
+
+        self.MAC = MAC
+
+        self.address = address
+
+        self.latency = latency
+
+        self.jitter = jitter
+
+        self.drop = drop
+
+        self.churn = churn
+
+        self.report = report
+
+        self.power = 0
+
+        self.powered_at = 0
+
+        self.used = random.randint(0, 100 * 60)
+
+        self.temperature = round(random.uniform(-10, 35), 1)
+
+        self.humidity = round(random.uniform(20, 90), 1)
+
+    def answer(self, frame):
+
+        """根据协议生成一条命令的响应
+
+        :param frame: 程序发送的完整命令帧
+        :return: 带有校验和的响应帧,不需要回复时返回`None`
+
+        """
+
+        kind = ord(frame[2])
+
+        if not checksum_ok(frame):
+
+            return {3: encode("f5aa0301000000"), 4: encode("f5aa040200000000"), 7: encode("f5aa07010000")}.get(kind)
+
+        if kind == 1:
+
+            return encode("f5aa0100")
+
+        if kind == 3:
+
+            if ord(frame[3]) == 1:
+
+                self.power = ord(frame[4])
+
+                self.powered_at = time.time()
+
+            elapsed = min(int(time.time() - self.powered_at) // 60, 255) if self.power else 0
+
+            return encode("f5aa0300%02x%02x%02x" % (1 if self.power else 0, self.power, elapsed))
+
+        if kind == 4:
+
+            temperature = int(abs(self.temperature) * 10)
+
+            return encode("f5aa0400%02x%02x%04x" % (temperature >> 8 | (0x80 if self.temperature < 0 else 0), temperature & 0xff, int(self.humidity * 10)))
+
+        if kind == 7:
+
+            return encode("f5aa0700%02x%02x" % divmod(self.used, 60))
+
+        return None
+
+    def send(self, client, frame):
+
+        try:
+
+            client.sendall(frame)
+
+        except socket.error:
+
+            return
+
+        stats["responses"] += 1
+
+    def respond(self, client, frame):
+
+        """回复一条命令,按照配置丢弃或者延迟
+
+        :param client: 模拟设备的链接
+        :param frame: 程序发送的完整命令帧
+        :return: 无返回值
+
+        """
+
+        stats["commands"] += 1
+
+        response = self.answer(frame)
+
+        if response is None:
+
+            return
+
+        if self.drop and random.random() < self.drop:
+
+            stats["dropped"] += 1
+
+            return
+
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+        if delay:
+
+            gevent.spawn_later(delay, self.send, client, response)
+
+        else:
+
+            self.send(client, response)
+
+    def _report(self, client):
+
+        while 1:
+
+            gevent.sleep(random.expovariate(1.0 / self.report))
+
+            event, key = random.choice(REPORTS)
+
+            if event == 2:
+
+                self.power = 2 * key
+
+                self.powered_at = time.time()
+
+            elif event == 4:
+
+                self.used = 0
+
+            try:
+
+                client.sendall(encode("f5aa08%02x%02x" % (event, key)))
+
+            except socket.error:
+
+                return
+
+            stats["reports"] += 1
+
+    def connect(self):
+
+        """接入服务器并且上报物理地址,接收命令直到链接断开或者到达重连时间
+
+        :return: 无返回值
+
+        """
+
+        client = socket.create_connection(self.address)
+
+        client.settimeout(None)
+
+        client.sendall(self.MAC)
+
+        stats["connects"] += 1
+
+        decoder = FrameDecoder(COMMAND_LENGTHS)
+
+        reporter = gevent.spawn(self._report, client) if self.report else None
+
+        timeout = gevent.Timeout(random.expovariate(1.0 / self.churn)) if self.churn else None
+
+        try:
+
+            if timeout is not None:
+
+                timeout.start()
+
+            while 1:
+
+                data = client.recv(4096)
+
+                if not data:
+
+                    return
+
+                for frame in decoder.feed(data):
+
+                    self.respond(client, frame)
+
+        except gevent.Timeout as error:
 
-def test(pid):
+            if error is not timeout:
 
-    """模拟设备链接
+                raise
 
-    创建一个`socket`链接,然后发送模拟物理地址.
+        finally:
 
-    真实模拟设备需要实现<<设备控制通信协议>>中的各项协议
+            if timeout is not None:
 
-    :param pid: 当前协程序号
-    :return: 无返回值
+                timeout.cancel()
+
+            if reporter is not None:
+
+                reporter.kill(block=False)
+
+            client.close()
+
+            stats["disconnects"] += 1
+
+    def run(self):
+
+        """不断接入服务器,断开之后等待一秒左右重新接入"""
+
+        while 1:
+
+            try:
+
+                self.connect()
+
+            except socket.error:
+
+                stats["failures"] += 1
+
+            gevent.sleep(random.uniform(0.5, 1.5))
+
+
+def simulate(MACs, address, ramp=10.0, **options):
+
+    """启动一组模拟设备
+
+    :param MACs: 物理地址列表
+    :param address: 服务器地址以及端口
+    :param ramp: 在多少秒之内陆续接入全部设备,避免同时发起大量链接
+    :param options: 传给`Device`的延迟,抖动,丢弃比例,重连以及上报配置
+    :return: 模拟设备的协程列表
 
     """
 
-    MAC = ''.join([random.choice(candidates) for _ in xrange(12)])
+    step = ramp / len(MACs) if MACs else 0
 
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    return [gevent.spawn_later(index * step, Device(MAC, address, **options).run) for index, MAC in enumerate(MACs)]
 
-    client.connect(("120.25.205.115", 9009))
 
-    client.send(MAC)
+def percentile(values, q):
 
-    logging.info(pid)
+    """
 
+    :param values: 已经排序的数值列表
+    :param q: 分位(0到1之间)
+    :return: 分位数,列表为空时返回`0`
 
-if __name__ == "__main__":
+    """
+
+    if not values:
+
+        return 0.0
+
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def listen(client, waiting):
+
+    """订阅`RESULT_CHANNEL`,把收到的执行结果交给等待这条命令的协程
+
+    :param client: `redis`客户端
+    :param waiting: 命令标志到`AsyncResult`的字典
+    :return: 已经确认订阅的协程
+
+    """
+
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+
+    pubsub.subscribe(RESULT_CHANNEL)
+
+    pubsub.parse_response()
+
+    def run():
+
+        try:
+
+            for message in pubsub.listen():
+
+                result = json.loads(message["data"])
+
+                if result["id"] in waiting:
+
+                    waiting[result["id"]].set(result)
+
+        finally:
+
+            pubsub.close()
+
+    return gevent.spawn(run)
+
+
+def drive(client, MACs, concurrency=50, duration=60.0, timeout=30.0, notify=False):
+
+    """通过`redis`向设备发送用户命令,等待执行结果
+
+    每个并发协程随机选择一台设备,交替发送打开(随机加热时长)和关闭命令,命令格式与移动应用后台相同,然后阻塞等待`tcp_server`放入以命令标志命名的列表的结果,或者等待`RESULT_CHANNEL`频道发布的结果
+
+    :param client: `redis`客户端
+    :param MACs: 物理地址列表
+    :param concurrency: 并发的命令数量
+    :param duration: 持续秒数
+    :param timeout: 等待一条命令结果的最长秒数
+    :param notify: 是否订阅结果频道,否则阻塞等待结果列表
+    :return: 包含命令数量,成功数量,失败数量,超时数量,吞吐量(每秒成功的命令数量),以及耗时的p50/p99/最大值(秒)的字典
+
+    """
+
+    latencies = []
+
+    counts = {"sent": 0, "ok": 0, "failed": 0, "timeouts": 0}
+
+    deadline = time.time() + duration
+
+    waiting = {} if notify else None
+
+    listener = listen(client, waiting) if notify else None
+
+    def worker():
+
+        while time.time() < deadline:
+
+            MAC = random.choice(MACs)
+
+            key = "%s+%s" % (MAC, uuid.uuid4().hex)
+
+            task = {"type": 1, "id": key, "time": random.randint(1, 8)} if random.random() < 0.5 else {"type": 0, "id": key}
+
+            begin = time.time()
+
+            if notify:
+
+                waiting[key] = AsyncResult()
+
+            client.lpush(MAC, str(task))
+
+            counts["sent"] += 1
 
-    gevents = [gevent.spawn(test, i) for i in xrange(1000)]
+            if notify:
+
+                result = waiting[key].wait(timeout)
+
+                del waiting[key]
+
+            else:
+
+                result = client.blpop(key, int(timeout))
+
+                result = json.loads(result[1]) if result else None
+
+            if result is None:
+
+                counts["timeouts"] += 1
+
+                continue
+
+            latencies.append(time.time() - begin)
+
+            counts["ok" if result["code"] == 0 else "failed"] += 1
+
+    begin = time.time()
+
+    gevent.joinall([gevent.spawn(worker) for _ in xrange(concurrency)])
+
+    elapsed = time.time() - begin
+
+    if listener is not None:
+
+        listener.kill()
+
+    latencies.sort()
+
+    result = dict(counts)
+
+    result.update({
+        "throughput": counts["ok"] / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+    })
+
+    return result
+
+
+def report(interval=10):
+
+    """每隔`interval`秒输出一次模拟设备的累计统计"""
+
+    while 1:
+
+        gevent.sleep(interval)
+
+        logging.info("模拟设备: %s" % json.dumps(stats, sort_keys=True))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="设备模拟器以及负载测试工具")
+
+    parser.add_argument("mode", choices=["simulate", "drive", "run"], help="只运行模拟器,只运行驱动器,或者两者同时运行")
+
+    parser.add_argument("--host", default="127.0.0.1", help="tcp_server地址")
+
+    parser.add_argument("--port", type=int, default=9009, help="tcp_server端口")
+
+    parser.add_argument("--redis-host", default="127.0.0.1")
+
+    parser.add_argument("--redis-port", type=int, default=6379)
+
+    parser.add_argument("--prefix", default="5E0000", help="模拟设备物理地址的前六位")
+
+    parser.add_argument("--devices", type=int, default=1000, help="模拟设备数量")
+
+    parser.add_argument("--ramp", type=float, default=10.0, help="在多少秒之内陆续接入全部设备")
+
+    parser.add_argument("--latency", type=float, default=0.0, help="响应延迟秒数")
+
+    parser.add_argument("--jitter", type=float, default=0.0, help="响应延迟抖动秒数")
+
+    parser.add_argument("--drop", type=float, default=0.0, help="丢弃命令的比例")
+
+    parser.add_argument("--churn", type=float, default=0.0, help="平均每隔多少秒断开重连一次,0表示不断开")
+
+    parser.add_argument("--report", type=float, default=0.0, help="平均每隔多少秒发送一条上报信息,0表示不发送")
+
+    parser.add_argument("--concurrency", type=int, default=50, help="驱动器并发的命令数量")
+
+    parser.add_argument("--duration", type=float, default=60.0, help="驱动器持续秒数")
+
+    parser.add_argument("--timeout", type=float, default=30.0, help="等待一条命令结果的最长秒数")
+
+    parser.add_argument("--notify", action="store_true", help="驱动器订阅结果频道,否则阻塞等待结果列表")
+
+    options = parser.parse_args(argv)
+
+    MACs = fleet(options.prefix, options.devices)
+
+    if options.mode in ("simulate", "run"):
+
+        simulate(MACs, (options.host, options.port), options.ramp, latency=options.latency, jitter=options.jitter,
+                 drop=options.drop, churn=options.churn, report=options.report)
+
+        gevent.spawn(report)
+
+    if options.mode == "simulate":
+
+        gevent.wait()
+
+        return
+
+    if options.mode == "run":
+
+        gevent.sleep(options.ramp + 1)
+
+    result = drive(redis.Redis(options.redis_host, options.redis_port), MACs, options.concurrency, options.duration, options.timeout, options.notify)
+
+    print(json.dumps(result, indent=1, sort_keys=True))
+
+    return result
+
+
+if __name__ == "__main__":
 
-    gevent.joinall(gevents)
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""watchdog
+
+这个模块实现事件循环阻塞检测以及协程状态查看.
+
+所有设备会话共用一个`gevent`事件循环,任何一个不让出的调用(C层面的域名解析,较慢的`pymysql`操作,大量的日志输出)都会让整个进程的所有会话停顿.`Watchdog`使用`greenlet.settrace`记录每次协程切换,一个独立的系统线程(不受`monkey.patch_all`影响)定期检查,如果当前运行的不是事件循环本身,并且超过`threshold`秒没有发生切换,说明这个协程阻塞了事件循环,记录它的调用栈以及名称(设备会话的协程以物理地址命名).
+
+检测线程不能使用被替换的日志模块,记录放入一个线程安全的`deque`,由事件循环中的协程输出日志.
+
+"""
+
+import gc
+import sys
+import time
+import logging
+import traceback
+
+from collections import deque
+from weakref import WeakKeyDictionary
+
+import gevent
+import greenlet
+
+from gevent import monkey
+
+try:
+
+    start_new_thread, get_ident = monkey.get_original("thread", ["start_new_thread", "get_ident"])
+
+except ImportError:
+
+    start_new_thread, get_ident = monkey.get_original("_thread", ["start_new_thread", "get_ident"])
+
+native_sleep = monkey.get_original("time", "sleep")
+
+
+class Watchdog(object):
+
+    """事件循环阻塞检测器"""
+
+    def __init__(self, threshold=0.1, history=32):
+
+        """
+
+        :param threshold: 事件循环没有切换协程的最长秒数
+        :param history: 保留的阻塞记录数量
+
+        """
+
+        self.threshold = threshold
+
+        self.blocks = deque(maxlen=history)
+
+        self.names = WeakKeyDictionary()
+
+        self._switches = 0
+
+        self._switched_at = time.time()
+
+        self._current = None
+
+        self._hub = None
+
+        self._thread_ident = None
+
+        self._count = 0
+
+        self._reported = 0
+
+        self._running = False
+
+    def name(self, target, label):
+
+        """为协程命名,阻塞记录以及调用栈中显示这个名称
+
+        :param target: 协程
+        :param label: 名称,设备会话使用物理地址
+        :return: 无返回值
+
+        """
+
+        self.names[target] = label
+
+    def label(self, target):
+
+        """
+
+        :param target: 协程
+        :return: 协程的名称,没有命名时返回协程的`repr`
+
+        """
+
+        if target is self._hub:
+
+            return "hub"
+
+        return self.names.get(target) or repr(target)
+
+    def _trace(self, event, args):
+
+        if event in ("switch", "throw"):
+
+            self._switches += 1
+
+            self._switched_at = time.time()
+
+            self._current = args[1]
+
+    def _watch(self):
+
+        seen = None
+
+        record = None
+
+        while self._running:
+
+            native_sleep(self.threshold / 2.0)
+
+            switches, current = self._switches, self._current
+
+            blocked = time.time() - self._switched_at
+
+            if current is None or current is self._hub or blocked < self.threshold:
+
+                seen = None
+
+                continue
+
+            if seen == switches:
+
+                record["duration"] = blocked
+
+                continue
+
+            seen = switches
+
+            frame = sys._current_frames().get(self._thread_ident)
+
+            self._count += 1
+
+            record = {
+                "id": self._count,
+                "time": self._switched_at,
+                "duration": blocked,
+                "greenlet": self.label(current),
+                "stack": ''.join(traceback.format_stack(frame)) if frame is not None else '',
+            }
+
+            self.blocks.append(record)
+
+    def _report(self):
+
+        while self._running:
+
+            gevent.sleep(1)
+
+            for record in list(self.blocks):
+
+                if record["id"] > self._reported:
+
+                    self._reported = record["id"]
+
+                    logging.warning("事件循环被 %s 阻塞 %.3f 秒:\n%s", record["greenlet"], record["duration"], record["stack"])
+
+    def start(self):
+
+        """开始记录协程切换,启动检测线程以及输出日志的协程,只能在主线程中调用"""
+
+        if self._running:
+
+            return
+
+        self._hub = gevent.get_hub()
+
+        self._thread_ident = get_ident()
+
+        self._running = True
+
+        greenlet.settrace(self._trace)
+
+        start_new_thread(self._watch, ())
+
+        gevent.spawn(self._report)
+
+    def stop(self):
+
+        """停止检测"""
+
+        self._running = False
+
+        greenlet.settrace(None)
+
+    def stacks(self):
+
+        """所有协程的当前调用栈
+
+        :return: 由(名称, 调用栈)组成的列表,正在运行的协程的调用栈来自当前线程
+
+        """
+
+        result = []
+
+        for target in gc.get_objects():
+
+            if not isinstance(target, greenlet.greenlet) or target.dead:
+
+                continue
+
+            frame = target.gr_frame if target is not greenlet.getcurrent() else sys._getframe()
+
+            if frame is None:
+
+                continue
+
+            result.append((self.label(target), ''.join(traceback.format_stack(frame))))
+
+        return result
+
+    def stats(self):
+
+        """
+
+        :return: 包含协程切换次数,累计阻塞次数,最近一次阻塞的秒数的字典
+
+        """
+
+        return {
+            "switches": self._switches,
+            "blocks": self._count,
+            "last_block": self.blocks[-1]["duration"] if self.blocks else 0.0,
+        }
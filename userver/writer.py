@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""writer
+
+这个模块实现设备状态的延迟合并写入.
+
+每次轮询设备都会产生一条`UPDATE device SET ... WHERE mac = %s`,其中绝大多数写入的值和上一次相同.`StateWriter`在内存中保存每个设备最后一次写入的状态,丢弃没有变化的写入,把同一个设备的多个字段合并成一行,然后定期把所有变化的行合并成少量批量语句写入数据库.
+
+"""
+
+import time
+import logging
+
+import gevent
+
+
+class StateWriter(object):
+
+    """设备状态的延迟合并写入器
+
+    `update`只修改内存状态并把设备标记为脏,后台协程每隔`interval`秒调用一次`flush`;`commit`用于上线/下线这类需要立刻落库的状态变化
+
+    """
+
+    def __init__(self, pool, interval=5, batch_size=500, history=None):
+
+        """
+
+        :param pool: 数据库链接池
+        :param interval: 两次批量写入之间的秒数
+        :param batch_size: 每条批量语句最多包含的设备数量
+        :param history: 遥测数据历史记录(参见`history.TelemetryHistory`),如果指定,每次状态更新(包括没有变化的)都记录一个样本
+
+        """
+
+        self.pool = pool
+
+        self.history = history
+
+        self.interval = interval
+
+        self.batch_size = batch_size
+
+        self._state = {}
+
+        self._dirty = {}
+
+        self._discarded = set()
+
+        self._greenlet = None
+
+        self._updates = 0
+
+        self._dropped = 0
+
+        self._rows = 0
+
+        self._statements = 0
+
+        self._last_flush = 0.0
+
+    def update(self, MAC, **fields):
+
+        """记录设备状态的变化,与上次写入的值相同的字段直接丢弃
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param fields: 字段名以及对应的新值
+        :return: 无返回值
+
+        """
+
+        self._updates += 1
+
+        if self.history is not None:
+
+            self.history.record(MAC, **fields)
+
+        state = self._state.setdefault(MAC, {})
+
+        changed = {}
+
+        for field, value in fields.iteritems():
+
+            if field not in state or state[field] != value:
+
+                state[field] = value
+
+                changed[field] = value
+
+        if changed:
+
+            self._dirty.setdefault(MAC, {}).update(changed)
+
+        else:
+
+            self._dropped += 1
+
+    def commit(self, MAC, **fields):
+
+        """立刻写入设备状态,同时带上这个设备尚未写入的其它字段
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param fields: 字段名以及对应的新值
+        :return: 无返回值
+
+        """
+
+        if self.history is not None:
+
+            self.history.record(MAC, **fields)
+
+        self._state.setdefault(MAC, {}).update(fields)
+
+        row = self._dirty.pop(MAC, {})
+
+        row.update(fields)
+
+        try:
+
+            self._write({MAC: row}, True)
+
+        except:
+
+            row.update(self._dirty.get(MAC, {}))
+
+            self._dirty[MAC] = row
+
+            raise
+
+    def forget(self, MAC, pending=False):
+
+        """忘记设备最后一次写入的状态,会话结束并且从注册表注销之后调用
+
+        设备可能重新接入其它进程或者节点并且修改了数据库中的这一行,再次接入这个进程时第一次更新必须完整写入,不能与这个进程以前写入的值比较;同时最后写入的状态不会随着接入过的设备数量一直增长
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :param pending: 是否同时丢弃尚未写入的状态.设备已经被其它进程接管时为`True`,这些值已经过时,写入会覆盖新的所有者写入的值;否则保留,由下次批量写入完成
+        :return: 无返回值
+
+        """
+
+        self._state.pop(MAC, None)
+
+        if pending:
+
+            self._dirty.pop(MAC, None)
+
+            self._discarded.add(MAC)
+
+    def discard(self, MAC):
+
+        """忘记设备的状态,删除设备时调用,避免尚未写入的状态在设备删除之后被写回
+
+        :param MAC: 设备的物理地址(唯一标志)
+        :return: 无返回值
+
+        """
+
+        self._state.pop(MAC, None)
+
+        self._dirty.pop(MAC, None)
+
+        self._discarded.add(MAC)
+
+        if self.history is not None:
+
+            self.history.discard(MAC)
+
+    def flush(self):
+
+        """把所有脏设备按照`batch_size`分批写入数据库
+
+        写入失败的设备重新标记为脏,等待下次写入(不会覆盖在此期间产生的更新的值),写入期间被删除(`discard`)或者被其它进程接管(`forget`)的设备除外
+
+        :return: 无返回值
+
+        """
+
+        if not self._dirty:
+
+            return
+
+        dirty, self._dirty = self._dirty, {}
+
+        self._discarded = set()
+
+        MACs = dirty.keys()
+
+        for i in xrange(0, len(MACs), self.batch_size):
+
+            batch = dict((MAC, dirty[MAC]) for MAC in MACs[i: i + self.batch_size])
+
+            try:
+
+                self._write(batch)
+
+            except Exception:
+
+                logging.exception("设备状态写入失败: %s 台设备", len(batch))
+
+                for MAC, row in batch.iteritems():
+
+                    if MAC not in self._discarded:
+
+                        row.update(self._dirty.get(MAC, {}))
+
+                        self._dirty[MAC] = row
+
+        self._last_flush = time.time()
+
+    def _write(self, batch, stamp=False):
+
+        """使用一条语句更新多个设备的多个字段
+
+        UPDATE device SET power = CASE mac WHEN %s THEN %s ... ELSE power END, ... WHERE mac IN (%s, ...)
+
+        `stamp`为`True`时同时更新`utime`,立刻写入的状态(上线/下线,用户命令)需要让`monitor`的增量同步发现
+
+        """
+
+        fields = sorted(set(field for row in batch.itervalues() for field in row))
+
+        if not fields:
+
+            return
+
+        assignments = []
+
+        args = []
+
+        for field in fields:
+
+            cases = []
+
+            for MAC, row in batch.iteritems():
+
+                if field in row:
+
+                    cases.append("WHEN %s THEN %s")
+
+                    args.extend((MAC, row[field]))
+
+            assignments.append("%s = CASE mac %s ELSE %s END" % (field, ' '.join(cases), field))
+
+        if stamp:
+
+            assignments.append("utime = NOW()")
+
+        args.extend(batch.keys())
+
+        sql = "UPDATE device SET %s WHERE mac IN (%s)" % (", ".join(assignments), ", ".join(["%s"] * len(batch)))
+
+        self.pool.execute(sql, args, idempotent=True)
+
+        self._rows += len(batch)
+
+        self._statements += 1
+
+    def _run(self):
+
+        while 1:
+
+            gevent.sleep(self.interval)
+
+            self.flush()
+
+    def start(self):
+
+        """启动后台写入协程"""
+
+        if self._greenlet is None:
+
+            self._greenlet = gevent.spawn(self._run)
+
+    def close(self):
+
+        """停止后台写入协程,并把所有尚未写入的状态强制写入数据库,程序退出时调用"""
+
+        if self._greenlet is not None:
+
+            self._greenlet.kill()
+
+            self._greenlet = None
+
+        self.flush()
+
+    def stats(self):
+
+        """写入器的运行统计
+
+        :return: 包含更新次数,丢弃次数,写入行数,语句数量,待写入设备数量的字典
+
+        """
+
+        return {
+            "updates": self._updates,
+            "dropped": self._dropped,
+            "rows": self._rows,
+            "statements": self._statements,
+            "pending": len(self._dirty),
+            "last_flush": self._last_flush,
+        }